@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""bench_extract.py
+对 extract_bilibili_from_qce.py 的各阶段做基准测试：提取、CSV 写出、Excel 导出、聚合，以及端到端运行。
+报告每阶段耗时、消息/秒、MB/秒与截至该阶段结束时的累计峰值 RSS，结果写成 JSON（附带 git commit），便于跨提交比较。
+各阶段在同一进程中依次运行，而 ru_maxrss 是整个进程的最高水位，因此 cumulative_peak_rss_mb 不是单个阶段的峰值：
+某个阶段之后的各阶段都至少报告它的值，只有数值上升的阶段才说明它抬高了内存峰值。
+用法示例：
+  python benchmarks/bench_extract.py --messages 200000 -o bench_results.json
+  python benchmarks/bench_extract.py -i /tmp/qce_bench -o new.json --compare old.json
+"""
+import argparse
+import contextlib
+import csv
+import datetime
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import extract_bilibili_from_qce as qce  # noqa: E402
+
+try:
+    from benchmarks.gen_qce_export import generate_export
+except ImportError:  # 直接以脚本方式运行时
+    from gen_qce_export import generate_export
+
+ALL_STAGES = ['extract', 'find_links', 'csv', 'parquet', 'excel', 'aggregate', 'end_to_end']
+
+
+def git_commit(repo: Path = ROOT):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def count_messages(chunk_files):
+    total = 0
+    for p in chunk_files:
+        with qce.open_chunk(p) as f:
+            total += sum(1 for line in f if line.strip())
+    return total
+
+
+def _timed(fn, repeat: int):
+    """运行 fn repeat 次，返回 (最短耗时, 最后一次的返回值)。被测代码的 print 输出被丢弃。"""
+    best = None
+    result = None
+    for _ in range(max(1, repeat)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _write_csv(rows, path: Path):
+    with path.open('w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=qce.CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _write_parquet(rows, path: Path):
+    writer = qce.ParquetRowWriter(path)
+    for row in rows:
+        writer.writerow(row)
+    writer.close()
+
+
+def _bench_parquet(rows, csv_path: Path, pq_path: Path, repeat: int):
+    """Parquet 与 CSV 对比：写出耗时、文件大小、整表回读与按列（聚合所需列）回读的耗时。"""
+    try:
+        import pandas as pd
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return None
+    write_pq, _ = _timed(lambda: _write_parquet(rows, pq_path), repeat)
+    write_csv, _ = _timed(lambda: _write_csv(rows, csv_path), repeat)
+    cols = qce.AGG_COLUMNS
+    return {
+        'write_seconds': round(write_pq, 4),
+        'csv_write_seconds': round(write_csv, 4),
+        'bytes': pq_path.stat().st_size,
+        'csv_bytes': csv_path.stat().st_size,
+        'reload_seconds': round(_timed(lambda: pd.read_parquet(pq_path), repeat)[0], 4),
+        'csv_reload_seconds': round(_timed(lambda: pd.read_csv(csv_path, dtype=str, keep_default_na=False), repeat)[0], 4),
+        'projected_reload_seconds': round(_timed(lambda: pd.read_parquet(pq_path, columns=cols), repeat)[0], 4),
+        'csv_projected_reload_seconds': round(_timed(
+            lambda: pd.read_csv(csv_path, usecols=cols, dtype=str, keep_default_na=False), repeat)[0], 4),
+    }
+
+
+def _with_titles(rows, titles: int = 200):
+    """聚合需要 bili_title；不联网时按 video_id 合成一个标题。"""
+    out = []
+    for row in rows:
+        row = dict(row)
+        key = row.get('video_id') or row.get('link', '')
+        row['bili_title'] = f'标题 {zlib.crc32(key.encode()) % titles}'
+        out.append(row)
+    return out
+
+
+def run_benchmarks(export_dir: Path, stages=None, repeat: int = 1, work_dir: Path = None):
+    """对 export_dir 运行所选阶段，返回结果 dict（可直接写成 JSON）。"""
+    stages = list(stages or ALL_STAGES)
+    export_dir = Path(export_dir)
+    _, chat_name, _, chunk_files = qce.read_export_manifest(export_dir)
+    chunk_files = [p for p in chunk_files if p.exists()]
+    total_bytes = sum(p.stat().st_size for p in chunk_files)
+    messages = count_messages(chunk_files)
+    mb = total_bytes / (1 << 20)
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'export': {'path': str(export_dir), 'chunks': len(chunk_files), 'bytes': total_bytes, 'messages': messages},
+        'repeat': repeat,
+        'stages': {},
+    }
+
+    def record(name, seconds, **extra):
+        entry = {
+            'seconds': round(seconds, 4),
+            'messages_per_sec': round(messages / seconds, 1) if seconds else None,
+            'mb_per_sec': round(mb / seconds, 2) if seconds else None,
+            # 进程级最高水位，包含之前各阶段（见模块说明）
+            'cumulative_peak_rss_mb': qce.peak_rss_mb(),
+        }
+        entry.update(extra)
+        results['stages'][name] = entry
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        tmp = Path(tmp)
+        rows = None
+        need_rows = {'extract', 'csv', 'parquet', 'excel', 'aggregate'} & set(stages)
+        if need_rows:
+            seconds, rows = _timed(lambda: list(qce.iter_export_rows(chunk_files, chat_name)), repeat)
+            if 'extract' in stages:
+                record('extract', seconds, rows=len(rows))
+
+        if 'find_links' in stages:
+            # 只计链接查找本身：先解码候选消息，再分别计时 schema-aware 与通用递归两种方式
+            msgs = [m for p in chunk_files for m in qce.iter_candidate_messages(p)]
+            for name, aware in (('find_links', True), ('find_links_generic', False)):
+                seconds, found = _timed(lambda: sum(len(qce.find_links_in_message(m, schema_aware=aware)) for m in msgs), repeat)
+                record(name, seconds, candidate_messages=len(msgs), links=found)
+
+        csv_path = tmp / 'bench.csv'
+        if rows is not None and {'csv', 'excel'} & set(stages):
+            seconds, _ = _timed(lambda: _write_csv(rows, csv_path), repeat)
+            if 'csv' in stages:
+                record('csv', seconds, csv_bytes=csv_path.stat().st_size)
+
+        if 'parquet' in stages:
+            parquet = _bench_parquet(rows, tmp / 'cmp.csv', tmp / 'bench.parquet', repeat)
+            if parquet is None:
+                results['stages']['parquet'] = {'skipped': '需要 pandas 与 pyarrow'}
+            else:
+                record('parquet', parquet.pop('write_seconds'), **parquet)
+
+        if 'excel' in stages:
+            seconds, ok = _timed(lambda: qce.write_excel_from_csv(csv_path, tmp / 'bench.xlsx'), repeat)
+            if ok:
+                record('excel', seconds)
+            else:
+                results['stages']['excel'] = {'skipped': '需要 pandas 与 openpyxl'}
+
+        if 'aggregate' in stages:
+            titled = tmp / 'titled.csv'
+            _write_csv(_with_titles(rows), titled)
+            agg_path = tmp / 'agg.xlsx'
+            seconds, _ = _timed(lambda: qce.write_aggregated_excel(titled, agg_path), repeat)
+            if agg_path.exists():
+                record('aggregate', seconds)
+            else:
+                results['stages']['aggregate'] = {'skipped': '需要 pandas 与 openpyxl'}
+
+        if 'end_to_end' in stages:
+            seconds, rc = _timed(lambda: qce.process_export_dir(export_dir, tmp / 'e2e.csv'), repeat)
+            record('end_to_end', seconds, exit_code=rc)
+
+    results['peak_rss_mb'] = qce.peak_rss_mb()
+    return results
+
+
+def compare_results(old: dict, new: dict) -> str:
+    """生成逐阶段耗时对比表（new / old，小于 1 表示变快）。"""
+    lines = [f"旧 {old.get('commit', '')[:12] or '?'} -> 新 {new.get('commit', '')[:12] or '?'}",
+             f"{'阶段':<20}{'旧(s)':>10}{'新(s)':>10}{'新/旧':>10}"]
+    for name, entry in new.get('stages', {}).items():
+        before = old.get('stages', {}).get(name, {}).get('seconds')
+        after = entry.get('seconds')
+        if before is None or after is None:
+            lines.append(f"{name:<20}{'-' if before is None else before:>10}{'-' if after is None else after:>10}{'-':>10}")
+        else:
+            ratio = after / before if before else float('inf')
+            lines.append(f"{name:<20}{before:>10.4f}{after:>10.4f}{ratio:>10.2f}")
+    return '\n'.join(lines)
+
+
+def format_results(results: dict) -> str:
+    exp = results['export']
+    lines = [f"commit {results['commit'] or '?'}  消息 {exp['messages']}  大小 {exp['bytes'] / (1 << 20):.1f} MB  chunk {exp['chunks']}"]
+    for name, entry in results['stages'].items():
+        if 'skipped' in entry:
+            lines.append(f"  {name:<20} 跳过（{entry['skipped']}）")
+            continue
+        lines.append(f"  {name:<20} {entry['seconds']:>9.3f}s  {entry['messages_per_sec'] or 0:>12.0f} msg/s"
+                     f"  {entry['mb_per_sec'] or 0:>8.1f} MB/s  累计峰值RSS {entry['cumulative_peak_rss_mb']} MB")
+        if name == 'parquet':
+            lines.append(f"  {'':<20} 对比 CSV：写出 {entry['csv_write_seconds']:.3f}s，大小 {entry['bytes'] / (1 << 20):.1f} MB"
+                         f" vs {entry['csv_bytes'] / (1 << 20):.1f} MB，回读 {entry['reload_seconds']:.3f}s vs {entry['csv_reload_seconds']:.3f}s，"
+                         f"按列回读 {entry['projected_reload_seconds']:.3f}s vs {entry['csv_projected_reload_seconds']:.3f}s")
+    return '\n'.join(lines)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='extract_bilibili_from_qce 基准测试')
+    ap.add_argument('-i', '--input', help='已有的导出目录；不指定则按下列参数生成合成导出')
+    ap.add_argument('-o', '--output', default='bench_results.json', help='结果 JSON 路径')
+    ap.add_argument('--stages', default=','.join(ALL_STAGES), help=f"逗号分隔的阶段（{','.join(ALL_STAGES)}）")
+    ap.add_argument('--repeat', type=int, default=1, help='每个阶段重复次数，取最短耗时')
+    ap.add_argument('--compare', help='与之前保存的结果 JSON 对比')
+    ap.add_argument('--messages', type=int, default=100000)
+    ap.add_argument('--chunk-messages', type=int, default=50000)
+    ap.add_argument('--link-density', type=float, default=0.01)
+    ap.add_argument('--nesting-depth', type=int, default=1)
+    ap.add_argument('--card-size', type=int, default=512)
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(ALL_STAGES)
+    if unknown:
+        ap.error(f"未知阶段：{','.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.input:
+            export_dir = Path(args.input)
+            gen = None
+        else:
+            export_dir = Path(tmp) / 'export'
+            gen = generate_export(export_dir, messages=args.messages, chunk_messages=args.chunk_messages,
+                                  link_density=args.link_density, nesting_depth=args.nesting_depth,
+                                  card_size=args.card_size, seed=args.seed)
+        results = run_benchmarks(export_dir, stages=stages, repeat=args.repeat)
+        if gen is not None:
+            results['generator'] = dict(gen, link_density=args.link_density, nesting_depth=args.nesting_depth,
+                                        card_size=args.card_size, seed=args.seed)
+
+    Path(args.output).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(format_results(results))
+    print(f"结果已写入 {args.output}")
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        print(compare_results(old, results))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
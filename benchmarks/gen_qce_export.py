@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""gen_qce_export.py
+生成用于基准测试的合成 QQ Chat Exporter（chunked-jsonl）导出目录：manifest.json + chunks/*.jsonl。
+消息结构模仿 QCE 导出（sender / content.text / content.elements / resources 等），可调节消息数、
+含链接消息的比例、回复/转发的嵌套深度以及 JSON 卡片大小。
+用法示例：
+  python benchmarks/gen_qce_export.py -o /tmp/qce_bench --messages 200000 --link-density 0.01 --card-size 2048
+  python benchmarks/gen_qce_export.py -o /tmp/qce_bench_gz --compress gz   # chunk 写成 .jsonl.gz
+"""
+import argparse
+import datetime
+import gzip
+import json
+import random
+import string
+import zipfile
+from pathlib import Path
+
+_WORDS = ['哈哈', '今天', '这个', '视频', '好看', '有人吗', '晚上', '开黑', '收到', '笑死', '真的', '可以', 'ok', 'lol', '打卡']
+_LINK_TEMPLATES = [
+    'https://www.bilibili.com/video/BV1{vid}?spm_id_from=333.999.0.0&share_source=qq',
+    'https://www.bilibili.com/video/BV1{vid}/?p=2',
+    'https://b23.tv/{short}',
+    'https://m.bilibili.com/video/BV1{vid}',
+    'https://space.bilibili.com/{num}',
+    'https://www.bilibili.com/video/av{num}',
+]
+_BASE_TIME = datetime.datetime(2024, 1, 1)
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _link(rng: random.Random, videos: int) -> str:
+    vid = f'{rng.randrange(videos):09d}'
+    return rng.choice(_LINK_TEMPLATES).format(
+        vid=vid, short=''.join(rng.choice(string.ascii_letters) for _ in range(7)), num=rng.randrange(1, 10 ** 8))
+
+
+def _card(rng: random.Random, size: int, link: str = '') -> dict:
+    """模拟 QQ 小程序/分享卡片（json 元素），content 为 JSON 字符串，长度约为 size。"""
+    meta = {'detail_1': {'title': '哔哩哔哩', 'desc': _text(rng, 4), 'qqdocurl': link, 'preview': 'pubminishare-30161.picsz.qpic.cn/x'}}
+    payload = {'app': 'com.tencent.miniapp_01', 'view': 'view_8C8E89B49BE609866298ADDFF2DBABA4', 'meta': meta,
+               'config': {'ctime': 1700000000, 'token': ''}}
+    pad = size - len(json.dumps(payload, ensure_ascii=False))
+    if pad > 0:
+        payload['config']['token'] = ''.join(rng.choice(string.hexdigits) for _ in range(pad))
+    return {'type': 'json', 'data': {'content': json.dumps(payload, ensure_ascii=False)}}
+
+
+def _reply(rng: random.Random, depth: int, link: str) -> dict:
+    """回复/转发元素，depth 控制嵌套层数。"""
+    data = {'senderName': f'成员{rng.randrange(500)}', 'content': _text(rng, 5) + (' ' + link if link else '')}
+    if depth > 1:
+        data['elements'] = [_reply(rng, depth - 1, '')]
+    return {'type': 'reply', 'data': data}
+
+
+def make_message(rng: random.Random, seq: int, ts: datetime.datetime, with_link: bool, nesting_depth: int,
+                 card_size: int, videos: int) -> dict:
+    uin = rng.randrange(10000, 10500)
+    text = _text(rng, rng.randint(2, 12))
+    link = _link(rng, videos) if with_link else ''
+    placement = rng.random() if with_link else 1.0
+    elements = []
+    if link and placement < 0.7:
+        text = f'{text} {link}'
+    elements.append({'type': 'text', 'data': {'text': text}})
+    if rng.random() < 0.15:
+        elements.append({'type': 'image', 'data': {'filename': f'{rng.getrandbits(64):016X}.jpg', 'size': rng.randrange(10 ** 6),
+                                                   'url': f'https://multimedia.nt.qq.com.cn/download?appid=1407&fileid={rng.getrandbits(128):032x}'}})
+    if link and 0.7 <= placement < 0.9:
+        elements.append(_card(rng, card_size, link))
+    elif rng.random() < 0.05:
+        elements.append(_card(rng, card_size))
+    if nesting_depth and (link and placement >= 0.9 or rng.random() < 0.05):
+        elements.append(_reply(rng, nesting_depth, link if placement >= 0.9 else ''))
+    resources = [{'type': 'image', 'filename': e['data']['filename'], 'size': e['data']['size'], 'url': e['data']['url']}
+                 for e in elements if e['type'] == 'image']
+    return {
+        'id': str(7300000000000000000 + seq),
+        'seq': str(seq),
+        'timestamp': int(ts.timestamp() * 1000),
+        'time': ts.strftime('%Y-%m-%d %H:%M:%S'),
+        'sender': {'uid': f'u_{uin:022d}', 'uin': str(uin), 'name': f'成员{uin - 10000}'},
+        'type': 'normal',
+        'content': {'text': text, 'html': f'<span>{text}</span>', 'elements': elements, 'resources': resources, 'mentions': []},
+        'recalled': False,
+        'system': False,
+    }
+
+
+def generate_export(out_dir: Path, messages: int = 10000, chunk_messages: int = 50000, link_density: float = 0.01,
+                    nesting_depth: int = 1, card_size: int = 512, videos: int = 2000, seed: int = 0,
+                    chat_name: str = 'bench_group', compress: str = None) -> dict:
+    """写出合成导出目录，返回统计信息：messages / link_messages / chunks / bytes（未压缩的 chunk 字节数）。
+    compress 为 'gz' / 'zst' 时把每个 chunk 压缩为 <fileName>.gz / .zst（manifest 仍列出原文件名，
+    与导出后单独压缩 chunk 的情况相同）；为 'zip' 时再把整个目录打包为 <out_dir>.zip，返回值中 archive 为其路径。"""
+    out_dir = Path(out_dir)
+    chunks_dir = out_dir / 'chunks'
+    chunks_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    ts = _BASE_TIME
+    chunks = []
+    link_messages = 0
+    total_bytes = 0
+    seq = 0
+    while seq < messages:
+        name = f'chunk_{len(chunks) + 1:04d}.jsonl'
+        count = min(chunk_messages, messages - seq)
+        with (chunks_dir / name).open('w', encoding='utf-8', newline='\n') as f:
+            for _ in range(count):
+                ts += datetime.timedelta(seconds=rng.randint(1, 600))
+                with_link = rng.random() < link_density
+                link_messages += with_link
+                f.write(json.dumps(make_message(rng, seq, ts, with_link, nesting_depth, card_size, videos), ensure_ascii=False) + '\n')
+                seq += 1
+        total_bytes += (chunks_dir / name).stat().st_size
+        if compress in ('gz', 'zst'):
+            _compress_chunk(chunks_dir / name, compress)
+        chunks.append({'fileName': name, 'messageCount': count})
+    manifest = {
+        'chatInfo': {'name': chat_name, 'type': 'group'},
+        'chunked': {'chunksDir': 'chunks', 'chunks': chunks},
+        'statistics': {'totalMessages': messages},
+    }
+    (out_dir / 'manifest.json').write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding='utf-8')
+    info = {'messages': messages, 'link_messages': link_messages, 'chunks': len(chunks), 'bytes': total_bytes}
+    if compress == 'zip':
+        archive = out_dir.with_name(out_dir.name + '.zip')
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for p in sorted(out_dir.rglob('*')):
+                if p.is_file():
+                    zf.write(p, f'{out_dir.name}/{p.relative_to(out_dir).as_posix()}')
+        info['archive'] = str(archive)
+    return info
+
+
+def _compress_chunk(path: Path, compress: str):
+    data = path.read_bytes()
+    if compress == 'gz':
+        path.with_name(path.name + '.gz').write_bytes(gzip.compress(data, compresslevel=6))
+    else:
+        import zstandard
+        path.with_name(path.name + '.zst').write_bytes(zstandard.ZstdCompressor(level=3).compress(data))
+    path.unlink()
+
+
+def main():
+    ap = argparse.ArgumentParser(description='生成合成的 QCE chunked-jsonl 导出，用于基准测试')
+    ap.add_argument('-o', '--output', required=True, help='输出导出目录')
+    ap.add_argument('--messages', type=int, default=100000, help='消息总数')
+    ap.add_argument('--chunk-messages', type=int, default=50000, help='每个 chunk 的消息数')
+    ap.add_argument('--link-density', type=float, default=0.01, help='含 bilibili 链接的消息比例')
+    ap.add_argument('--nesting-depth', type=int, default=1, help='回复/转发元素的嵌套深度（0 表示不生成）')
+    ap.add_argument('--card-size', type=int, default=512, help='JSON 卡片内容的大致字节数')
+    ap.add_argument('--videos', type=int, default=2000, help='不同视频 ID 的数量（控制重复分享程度）')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--compress', choices=['gz', 'zst', 'zip'], help='压缩 chunk（gz / zst，zst 需要 zstandard）或打包为 zip')
+    args = ap.parse_args()
+    info = generate_export(Path(args.output), messages=args.messages, chunk_messages=args.chunk_messages,
+                           link_density=args.link_density, nesting_depth=args.nesting_depth,
+                           card_size=args.card_size, videos=args.videos, seed=args.seed, compress=args.compress)
+    print(json.dumps(info, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -5,28 +5,405 @@
   python extract_bilibili_from_qce.py -i "C:/Users/ASUS/.qq-chat-exporter/exports/group_..." -o bilibili.csv --excel bilibili.xlsx
 """
 import argparse
+import codecs
+import contextlib
 import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import io
 import json
+import math
+import mmap
 import os
+import posixpath
+import queue
+import random
 import re
+import select
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
 from pathlib import Path
 from typing import Any, Dict, Iterable
+from urllib.parse import unquote, urljoin
 
 # 匹配 bilibili 的多种域名（含子域）以及短域名 b23.tv
 BILI_RE = re.compile(r"https?://(?:[\w.-]+\.)?(?:bilibili\.com|b23\.tv)[^\s,，；;\"'<>]*", re.I)
 
 
-def iter_jsonl_messages(chunk_path: Path) -> Iterable[Dict[str, Any]]:
-    with chunk_path.open('r', encoding='utf-8', errors='ignore') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
+# chunk 可以是压缩文件（按扩展名识别；.zst 需要 zstandard 或 Python 3.14+），
+# 整个导出目录也可以打包成 zip（manifest.json 与 chunk 都直接从归档中流式读取，不解压到磁盘）
+_CHUNK_CODECS = {'.gz': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+CHUNK_SUFFIXES = ('.jsonl', '.jsonl.gz', '.jsonl.zst')
+# 后台解压线程每次读取的块大小，以及最多预读的块数
+_READ_BLOCK = 1 << 20
+_READ_AHEAD = 8
+
+
+def chunk_codec(name: str):
+    """按文件名判断 chunk 的压缩格式：'gzip'、'zstd' 或 None（未压缩）。"""
+    return _CHUNK_CODECS.get(os.path.splitext(name)[1].lower())
+
+
+def is_export_archive(path: Path) -> bool:
+    path = Path(path)
+    return path.is_file() and zipfile.is_zipfile(str(path))
+
+
+_ZIP_INFOS = {}
+
+
+def _zip_infos(archive: Path) -> Dict[str, zipfile.ZipInfo]:
+    """归档中的文件列表（按归档的大小与修改时间缓存，避免每个 chunk 都重新读取中央目录）。"""
+    st = archive.stat()
+    key = (str(archive), st.st_size, st.st_mtime_ns)
+    infos = _ZIP_INFOS.get(key)
+    if infos is None:
+        with zipfile.ZipFile(str(archive)) as zf:
+            infos = {i.filename: i for i in zf.infolist() if not i.is_dir()}
+        _ZIP_INFOS[key] = infos
+    return infos
+
+
+_MemberStat = namedtuple('_MemberStat', 'st_size st_mtime_ns')
+
+
+class ArchiveMember:
+    """zip 归档中的一个文件，提供 chunk 处理用到的那部分 Path 接口（name / stat / open / exists / resolve / '/'）。
+    root 为 manifest.json 在归档中所在目录的前缀（如 'group_x/'），relative_name 是相对它的路径。
+    只保存路径字符串，可以传给工作进程；每次 open 都单独打开归档，不在线程间共享 ZipFile。"""
+
+    __slots__ = ('archive', 'member', 'root')
+
+    def __init__(self, archive: Path, member: str, root: str = ''):
+        self.archive = Path(archive)
+        self.member = member
+        self.root = root
+
+    @property
+    def name(self) -> str:
+        return posixpath.basename(self.member)
+
+    @property
+    def relative_name(self) -> str:
+        return self.member[len(self.root):]
+
+    def __truediv__(self, other) -> 'ArchiveMember':
+        return ArchiveMember(self.archive, posixpath.join(self.member, str(other)), self.root)
+
+    def _info(self):
+        return _zip_infos(self.archive).get(self.member)
+
+    def exists(self) -> bool:
+        try:
+            return self._info() is not None
+        except (OSError, zipfile.BadZipFile):
+            return False
+
+    def stat(self) -> _MemberStat:
+        info = self._info()
+        if info is None:
+            raise FileNotFoundError(f"归档中不存在 {self}")
+        # zip 记录的修改时间精度只有 2 秒，把 CRC 计入签名，内容变化时签名一定变化
+        mtime = int(datetime.datetime(*info.date_time).timestamp())
+        return _MemberStat(info.file_size, mtime * 10 ** 9 + info.CRC)
+
+    @contextlib.contextmanager
+    def open(self, mode: str = 'rb'):
+        if mode != 'rb':
+            raise ValueError('归档中的文件只能以 rb 方式打开')
+        with zipfile.ZipFile(str(self.archive)) as zf, zf.open(self.member) as f:
+            yield f
+
+    def resolve(self) -> 'ArchiveMember':
+        return ArchiveMember(self.archive.resolve(), self.member, self.root)
+
+    def __eq__(self, other):
+        return isinstance(other, ArchiveMember) and (self.archive, self.member) == (other.archive, other.member)
+
+    def __hash__(self):
+        return hash((self.archive, self.member))
+
+    def __str__(self):
+        return f"{self.archive}!/{self.member}"
+
+    def __repr__(self):
+        return f"ArchiveMember({str(self.archive)!r}, {self.member!r})"
+
+
+def _open_zstd(raw):
+    try:
+        from compression import zstd  # Python 3.14+
+        return zstd.ZstdFile(raw)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("读取 .zst 需要 zstandard。请安装：pip install zstandard") from None
+    # zstd 命令行工具（如 pzstd）可能写出多个帧
+    return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+
+
+@contextlib.contextmanager
+def open_chunk(chunk_path):
+    """以二进制流打开 chunk（Path 或 ArchiveMember），.gz / .zst 透明解压。"""
+    codec = chunk_codec(chunk_path.name)
+    with chunk_path.open('rb') as raw:
+        if codec is None:
+            yield raw
+        elif codec == 'gzip':
+            with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+                yield f
+        else:
+            with _open_zstd(raw) as f:
+                yield f
+
+
+def _is_plain_file(chunk_path) -> bool:
+    return isinstance(chunk_path, Path) and chunk_codec(chunk_path.name) is None
+
+
+def iter_chunk_blocks(chunk_path, block_size: int = _READ_BLOCK, read_ahead: int = _READ_AHEAD) -> Iterable[bytes]:
+    """在后台线程中读取并解压 chunk，按块产出解压后的字节，使 I/O 与解压和调用方的解析并行进行
+    （zlib / zstd 解压时会释放 GIL）。队列有界，调用方提前停止时后台线程也随之退出。"""
+    blocks = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
             try:
-                yield json.loads(line)
-            except Exception:
-                # 忽略解析错误的行
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
+        return False
+
+    def reader():
+        try:
+            with open_chunk(chunk_path) as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    if not put(block):
+                        return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    thread = threading.Thread(target=reader, name='chunk-reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = blocks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_line_windows(blocks: Iterable[bytes], window_size: int = None) -> Iterable[tuple]:
+    """把任意切分的字节块重新拼成按行尾对齐的窗口，产出 (窗口在流中的偏移, 窗口)。
+    窗口约 window_size 字节（默认同 mmap 扫描）；只有最后一个窗口可能不以行尾结束。"""
+    window_size = window_size or _SCAN_WINDOW
+    pending = []
+    size = 0
+    offset = 0
+    for block in blocks:
+        pending.append(block)
+        size += len(block)
+        if size < window_size:
+            continue
+        # 只在最新的块中找行尾，超长的行会继续累积而不是反复拼接；优先在 \n 处切，\r\n 不会被拆开
+        cut = block.rfind(b'\n')
+        if cut < 0:
+            cut = block.rfind(b'\r')
+        if cut < 0:
+            continue
+        pending[-1] = block[:cut + 1]
+        window = b''.join(pending)
+        yield offset, window
+        offset += len(window)
+        rest = block[cut + 1:]
+        pending = [rest]
+        size = len(rest)
+    if size:
+        yield offset, b''.join(pending)
+
+
+def iter_chunk_windows(chunk_path) -> Iterable[tuple]:
+    """产出 (字节偏移, 窗口)：普通文件只产出一次整个文件的 mmap；压缩或归档中的 chunk
+    由后台线程解压，产出按行尾对齐的窗口。偏移都相对于（解压后的）chunk 内容。"""
+    if not _is_plain_file(chunk_path):
+        yield from iter_line_windows(iter_chunk_blocks(chunk_path))
+        return
+    with chunk_path.open('rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件无法 mmap
+            return
+        except OSError:
+            yield from iter_line_windows(iter(lambda: f.read(_READ_BLOCK), b''))
+            return
+        with buf:
+            yield 0, buf
+
+
+def _parse_jsonl(f) -> Iterable[Dict[str, Any]]:
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except Exception:
+            # 忽略解析错误的行
+            continue
+
+
+def iter_jsonl_messages(chunk_path: Path) -> Iterable[Dict[str, Any]]:
+    if _is_plain_file(chunk_path):
+        with chunk_path.open('r', encoding='utf-8', errors='ignore') as f:
+            yield from _parse_jsonl(f)
+        return
+    with open_chunk(chunk_path) as raw:
+        yield from _parse_jsonl(io.TextIOWrapper(raw, encoding='utf-8', errors='ignore'))
+
+
+# 字节级预筛：BILI_RE 的任何匹配都必然包含 bilibili.com 或 b23.tv（忽略大小写）。
+# 原始 JSON 字节中这些字符也可能写成 \u00xx 转义；另外 re.I 下 'ı'/'İ' 也能匹配 'i'。
+# 只要覆盖这几种形式，未命中的行就不可能产出结果，可以跳过解码与 json.loads。
+# 两个模式都以单个字面量开头（在转成小写的字节上搜索），这样 re 可以走快速的字面量扫描。
+_BYTE_I = rb'(?:i|\xc4[\xb0\xb1])'
+_BILI_BYTES_RE = re.compile(rb'b(?:' + _BYTE_I + rb'l' + _BYTE_I + rb'b' + _BYTE_I + rb'l' + _BYTE_I + rb'\.com|23\.tv)')
+_ESCAPE_BYTES_RE = re.compile(rb'\\u(?:00[2-7][0-9a-f]|013[01])')
+# 文本模式读取时 \r、\r\n 与 \n 都会被视为行尾
+_EOL_RE = re.compile(rb'[\r\n]')
+# mmap 扫描时每次转小写的窗口大小（按行尾对齐）
+_SCAN_WINDOW = 8 << 20
+
+
+def line_may_contain_bili(raw: bytes) -> bool:
+    """判断一行原始字节是否可能包含 bilibili 链接（宁可多报，不会漏报）。"""
+    low = raw.lower()
+    return bool(_BILI_BYTES_RE.search(low) or _ESCAPE_BYTES_RE.search(low))
+
+
+def _scan_window_spans(window: bytes) -> Iterable[tuple]:
+    """产出窗口内命中预筛的各行的 (起始, 结束) 位置（不含行尾）。"""
+    low = window.lower()
+    n = len(window)
+    pos = 0
+    mb = _BILI_BYTES_RE.search(low)
+    me = _ESCAPE_BYTES_RE.search(low)
+    while mb or me:
+        s = min(m.start() for m in (mb, me) if m)
+        start = max(pos, window.rfind(b'\n', pos, s) + 1, window.rfind(b'\r', pos, s) + 1)
+        e = _EOL_RE.search(window, s)
+        end = e.start() if e else n
+        yield start, end
+        pos = end + 1
+        if mb and mb.start() < pos:
+            mb = _BILI_BYTES_RE.search(low, pos)
+        if me and me.start() < pos:
+            me = _ESCAPE_BYTES_RE.search(low, pos)
+
+
+def iter_candidate_line_offsets(buf, counts: dict = None) -> Iterable[tuple]:
+    """在整块字节（bytes/mmap）上直接搜索预筛模式，只切出命中的行，产出 (行首字节偏移, 原始行)。
+    传入 counts 时在 counts['lines'] 中累计扫描过的行数（--stats 使用）。"""
+    n = len(buf)
+    w0 = 0
+    while w0 < n:
+        w1 = n
+        if w0 + _SCAN_WINDOW < n:
+            e = _EOL_RE.search(buf, w0 + _SCAN_WINDOW)
+            if e:
+                w1 = e.end()
+        window = buf[w0:w1]
+        if counts is not None:
+            counts['lines'] = counts.get('lines', 0) + window.count(b'\n') + (w1 == n and not window.endswith(b'\n'))
+        for start, end in _scan_window_spans(window):
+            yield w0 + start, window[start:end]
+        w0 = w1
+
+
+def iter_candidate_lines(buf, counts: dict = None) -> Iterable[bytes]:
+    """与 iter_candidate_line_offsets 相同，只产出原始行。"""
+    for _, line in iter_candidate_line_offsets(buf, counts):
+        yield line
+
+
+def iter_candidate_lines_stream(f, counts: dict = None) -> Iterable[bytes]:
+    """流式版本（用于无法 mmap 的文件对象）：逐行读取字节，只产出命中的行。"""
+    for raw in f:
+        if counts is not None:
+            counts['lines'] = counts.get('lines', 0) + 1
+        if not line_may_contain_bili(raw):
+            continue
+        parts = _EOL_RE.split(raw) if b'\r' in raw else [raw]
+        for part in parts:
+            if line_may_contain_bili(part):
+                yield part
+
+
+def _decode_candidate_lines(lines: Iterable[bytes]) -> Iterable[Dict[str, Any]]:
+    for raw in lines:
+        line = raw.decode('utf-8', errors='ignore').strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except Exception:
+            continue
+
+
+def iter_candidate_raw_lines(chunk_path: Path, counts: dict = None) -> Iterable[bytes]:
+    """以字节方式扫描 chunk（普通文件尽量 mmap，压缩或归档中的 chunk 边解压边扫描），
+    产出可能包含 bilibili 链接的原始行。"""
+    for _, window in iter_chunk_windows(chunk_path):
+        yield from iter_candidate_lines(window, counts)
+
+
+def iter_candidate_messages_at(chunk_path: Path) -> Iterable[tuple]:
+    """产出 (字节偏移, 字节长度, 消息)：消息所在行在 chunk（解压后）内容中的位置，可用于之后 seek 读回原始消息。"""
+    spans = ((base + offset, raw) for base, window in iter_chunk_windows(chunk_path)
+             for offset, raw in iter_candidate_line_offsets(window))
+    yield from _decode_messages_at(spans)
+
+
+def _decode_messages_at(spans: Iterable[tuple]) -> Iterable[tuple]:
+    for offset, raw in spans:
+        line = raw.decode('utf-8', errors='ignore').strip()
+        if not line:
+            continue
+        try:
+            msg = json.loads(line)
+        except Exception:
+            continue
+        yield offset, len(raw), msg
+
+
+def iter_candidate_messages(chunk_path: Path) -> Iterable[Dict[str, Any]]:
+    """快速路径：只解码并解析原始字节中可能包含 bilibili 链接的行（见 iter_candidate_raw_lines）。
+    对提取结果而言与 iter_jsonl_messages 等价：被跳过的行不可能产出链接。"""
+    return _decode_candidate_lines(iter_candidate_raw_lines(chunk_path))
 
 
 def extract_strings(obj: Any) -> Iterable[str]:
@@ -48,6 +425,76 @@ def extract_strings(obj: Any) -> Iterable[str]:
             return
 
 
+# 链接分析：一次得到类型、视频 ID、规范化地址与分 P 序号；热门链接在消息中大量重复，结果按链接做有界 LRU 缓存
+BiliLink = namedtuple('BiliLink', 'link_type video_id canonical_url page')
+LINK_MEMO_SIZE = 1 << 16
+# BV 号优先于 av 号（即使 av 号出现在前面）；两个模式都以字面量开头，搜索很快
+_BV_RE = re.compile(r'BV[0-9A-Za-z]+')
+_AV_RE = re.compile(r'av(\d+)', re.I)
+# 分享/统计用的查询参数，规范化地址中去掉
+_TRACKING_PARAMS = frozenset({
+    'spm_id_from', 'from_spmid', 'spmid', 'share_source', 'share_medium', 'share_plat', 'share_session_id',
+    'share_from', 'share_tag', 'share_times', 'unique_k', 'vd_source', 'bbid', 'buvid', 'mid', 'up_id',
+    'is_story_h5', 'plat_id', 'timestamp', 'ts', 'seid', 'from', 'msource', 'bsource', 'launch_id',
+})
+# 拆出 (域名, 路径, 查询串)；锚点丢弃
+_URL_PARTS_RE = re.compile(r'[a-z][a-z0-9+.-]*://([^/?#]*)([^?#]*)(?:\?([^#]*))?', re.I)
+# 这些域名指向同一套页面，统一为 www.bilibili.com
+_WWW_HOSTS = frozenset({'bilibili.com', 'www.bilibili.com', 'm.bilibili.com'})
+
+
+@functools.lru_cache(maxsize=LINK_MEMO_SIZE)
+def analyze_bili_link(link: str) -> BiliLink:
+    """分析一个 b站 链接，返回 BiliLink(link_type, video_id, canonical_url, page)：
+    - link_type / video_id 与 classify_bili_link / extract_video_id 相同；
+    - canonical_url：https、统一域名（m./无前缀 → www.）、去掉分享跟踪参数与锚点；视频页规范为
+      https://www.bilibili.com/video/<ID>，分 P 大于 1 时带 ?p=N；
+    - page：视频页的分 P 序号（默认 1），非视频页为 None。"""
+    l = link.lower()
+    if 'b23.tv' in l:
+        link_type = 'short'
+    elif '/video/' in l or '/bv' in l or '/av' in l:
+        link_type = 'video'
+    elif l.startswith(('https://m.', 'https://t.')) or '.m.bilibili.' in l:
+        link_type = 'mobile'
+    else:
+        link_type = 'other'
+
+    m = _BV_RE.search(link)
+    if m:
+        video_id = m.group(0)
+    else:
+        m = _AV_RE.search(link)
+        video_id = 'av' + m.group(1) if m else ''
+
+    parts = _URL_PARTS_RE.match(link)
+    if parts is None:
+        return BiliLink(link_type, video_id, link, None)
+    netloc, path, qs = parts.groups()
+    host = netloc.rpartition('@')[2].lower()
+    if host in _WWW_HOSTS:
+        host = 'www.bilibili.com'
+    page = None
+    query = []
+    for piece in (qs or '').split('&'):
+        if not piece:
+            continue
+        key, _, value = piece.partition('=')
+        key = unquote(key).lower()
+        if key == 'p' and value.isdigit():
+            page = int(value)
+        elif key not in _TRACKING_PARAMS:
+            query.append(piece)
+    if video_id and host == 'www.bilibili.com' and path[:7].lower() == '/video/':
+        page = page or 1
+        return BiliLink(link_type, video_id, f'https://{host}/video/{video_id}' + (f'?p={page}' if page > 1 else ''), page)
+    if page is not None:
+        query.append(f'p={page}')
+    path = path.rstrip('/')
+    canonical = f'https://{host}{path}' + ('?' + '&'.join(query) if query else '')
+    return BiliLink(link_type, video_id, canonical, page if video_id else None)
+
+
 def classify_bili_link(link: str) -> str:
     """简单分类 b站 链接类型：
     - 'short'：b23.tv 短链
@@ -55,48 +502,108 @@ def classify_bili_link(link: str) -> str:
     - 'mobile'：m.bilibili.com 或 t.bilibili.com 等移动/社交子域
     - 'other'：其他 bilibili 链接
     """
-    l = link.lower()
-    if 'b23.tv' in l:
-        return 'short'
-    if '/video/' in l or '/bv' in l or '/av' in l:
-        return 'video'
-    if l.startswith('https://m.') or l.startswith('https://t.') or '.m.bilibili.' in l:
-        return 'mobile'
-    return 'other'
+    return analyze_bili_link(link).link_type
 
 
 def extract_video_id(link: str) -> str:
     """从链接中提取 BV/AV 视频 ID（若存在）。返回字符串如 'BV1xxx' 或 'av1234'，若无则返回空字符串。"""
-    import re
-    l = link
-    # 常见格式： /video/BV... , BV... 也可能出现在路径
-    m = re.search(r'BV[0-9A-Za-z]+', l)
-    if m:
-        return m.group(0)
-    m2 = re.search(r'av(\d+)', l, re.I)
-    if m2:
-        return 'av' + m2.group(1)
-    # 也尝试从查询参数或片段中查找
-    m3 = re.search(r'(?:video/)(BV[0-9A-Za-z]+)', l)
-    if m3:
-        return m3.group(1)
-    return ''
+    return analyze_bili_link(link).video_id
+
+
+def canonical_bili_url(link: str) -> str:
+    """链接的规范化形式（见 analyze_bili_link），用于去重与按地址聚合。"""
+    return analyze_bili_link(link).canonical_url
+
+
+CONTEXT_RADIUS = 120
+
+
+def is_qce_message(msg: Any) -> bool:
+    content = msg.get('content') if isinstance(msg, dict) else None
+    return isinstance(content, dict) and isinstance(content.get('elements'), list)
+
+
+def _collect_strings(obj: Any, out: list):
+    """与 extract_strings 相同的遍历顺序与取值，但直接追加到列表（避免逐层生成器的开销）。"""
+    if obj is None:
+        return
+    if isinstance(obj, str):
+        out.append(obj)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _collect_strings(v, out)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _collect_strings(v, out)
+    else:
+        try:
+            out.append(str(obj))
+        except Exception:
+            return
+
+
+def _collect_text_strings(obj: Any, out: list):
+    """与 _collect_strings 相同，但跳过数字、布尔值与 None（ID、时间戳、标志位等不可能包含链接的字段）。"""
+    if isinstance(obj, str):
+        out.append(obj)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _collect_text_strings(v, out)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _collect_text_strings(v, out)
+    elif obj is not None and not isinstance(obj, (int, float)):
+        try:
+            out.append(str(obj))
+        except Exception:
+            return
+
+
+def message_texts(msg: Any) -> list:
+    """收集消息中可能包含链接的字符串，顺序与 extract_strings 一致。
+    QCE 结构的消息跳过数值型字段（数字 ID、时间戳、标志位），其余字段（包括发送者资料、文件/视频元素、
+    资源元数据）照常访问，因此找到的链接与 extract_strings 完全相同；其它结构回退为通用递归。"""
+    out = []
+    if is_qce_message(msg):
+        _collect_text_strings(msg, out)
+    else:
+        _collect_strings(msg, out)
+    return out
+
+
+def find_links_in_message(msg: Dict[str, Any], schema_aware: bool = True):
+    """返回消息中的 [(link, context, link_type), ...]，context 为链接前后各 CONTEXT_RADIUS 个字符。
+    schema_aware=True 时 QCE 消息不拼接数值型字段（见 message_texts），链接与 schema_aware=False 相同，
+    只是上下文中不再夹杂时间戳等数字；schema_aware=False 为原先的全字段行为。"""
+    pieces = message_texts(msg) if schema_aware else list(extract_strings(msg))
+    return find_links_in_text("\n".join(pieces))
+
 
+def find_links_in_text(text: str):
+    """在已拼接好的消息文本中查找链接，返回值同 find_links_in_message。"""
+    return [(link, link_context(text, start, end), info.link_type) for link, start, end, info in find_link_spans(text)]
 
-def find_links_in_message(msg: Dict[str, Any]):
-    text = "\n".join([s for s in extract_strings(msg)])
-    results = []
-    for m in BILI_RE.finditer(text):
-        link = m.group(0)
-        start = max(0, m.start() - 120)
-        end = min(len(text), m.end() + 120)
-        ctx = text[start:end].replace('\n', ' ')
-        ltype = classify_bili_link(link)
-        results.append((link, ctx, ltype))
-    return results
+
+def find_link_spans(text: str):
+    """返回 [(link, start, end, BiliLink), ...]：链接、其在 text 中的位置与 analyze_bili_link 的结果，
+    context 可之后再用 link_context 切取。"""
+    return [(m.group(0), m.start(), m.end(), analyze_bili_link(m.group(0))) for m in BILI_RE.finditer(text)]
+
+
+def link_context(text: str, start: int, end: int) -> str:
+    """链接前后各 CONTEXT_RADIUS 个字符（换行替换为空格）。"""
+    return text[max(0, start - CONTEXT_RADIUS):min(len(text), end + CONTEXT_RADIUS)].replace('\n', ' ')
 
 
 def guess_sender(msg: Dict[str, Any]):
+    for c in sender_candidates(msg):
+        if c and isinstance(c, str) and c.strip():
+            return c
+    return ''
+
+
+def sender_candidates(msg: Dict[str, Any]) -> list:
+    """按优先级列出消息中可能表示发送者的字段值（昵称、uin 等），guess_sender 取第一个非空字符串。"""
     # 常见字段
     candidates = []
     if isinstance(msg, dict):
@@ -112,10 +619,7 @@ def guess_sender(msg: Dict[str, Any]):
         candidates.append(msg.get('nickname'))
         candidates.append(msg.get('sender_uin'))
         candidates.append(msg.get('sender_qq'))
-    for c in candidates:
-        if c and isinstance(c, str) and c.strip():
-            return c
-    return ''
+    return candidates
 
 
 def guess_time(msg: Dict[str, Any]):
@@ -125,8 +629,6 @@ def guess_time(msg: Dict[str, Any]):
             return v
     # 有些导出会把时间放成 number 字段
     if isinstance(msg.get('timeMs'), int):
-        import datetime
-
         try:
             return datetime.datetime.utcfromtimestamp(msg['timeMs'] / 1000).isoformat()
         except Exception:
@@ -134,245 +636,3181 @@ def guess_time(msg: Dict[str, Any]):
     return ''
 
 
-def fetch_bilibili_metadata(link: str):
-    """Try to fetch and extract title and uploader from a bilibili link.
-    Returns (title, uploader, final_url) or ('','','') if not available or on error.
-    Uses a short timeout and best-effort HTML parsing (og:title, meta name=author, <title>).
-    final_url is the resolved URL after redirects (useful for short links like b23.tv)."""
-    try:
-        import requests
-        from bs4 import BeautifulSoup
-        have_bs4 = True
-    except Exception:
-        # we'll fall back to regex parsing if bs4 not installed
-        have_bs4 = False
+def guess_message_id(msg: Dict[str, Any]) -> str:
+    """消息 ID（QCE 的 id / msgId 等字段），没有时返回空串。"""
+    if isinstance(msg, dict):
+        for key in ('id', 'msgId', 'message_id', 'messageId', 'msg_id'):
+            v = msg.get(key)
+            if isinstance(v, (str, int)) and not isinstance(v, bool) and v != '':
+                return str(v)
+    return ''
+
 
+def time_sort_key(value) -> str:
+    """把 guess_time 的结果规范为可按字典序比较的 'YYYY-MM-DD HH:MM:SS'。
+    数字（秒或毫秒时间戳）按 UTC 换算（与 guess_time 处理 timeMs 一致）；无法识别的值原样转成字符串。"""
+    if value is None or value == '':
+        return ''
+    text = str(value).strip()
     try:
-        resp = requests.get(link, timeout=6, headers={"User-Agent": "qq-bili-extractor/1.0"}, allow_redirects=True)
-        resp.raise_for_status()
-        final_url = getattr(resp, 'url', link)
-        text = resp.text
-        title = ''
-        uploader = ''
-        if have_bs4:
-            soup = BeautifulSoup(text, 'html.parser')
-            t = soup.find('meta', property='og:title') or soup.find('meta', attrs={'name': 'title'})
-            if t and t.get('content'):
-                title = t['content']
-            if not title and soup.title and soup.title.string:
-                title = soup.title.string.strip()
-            a = soup.find('meta', attrs={'name': 'author'})
-            if a and a.get('content'):
-                uploader = a['content']
-            if not uploader:
-                sel = soup.select_one('.username, .user-name, .up-name')
-                if sel:
-                    uploader = sel.get_text(strip=True)
+        if isinstance(value, (int, float)) or (text.isdigit() and len(text) >= 9):
+            ts = float(text)
+            if ts > 1e11:
+                ts /= 1000
+            dt = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
         else:
-            # simple regex fallbacks
-            import re
-            m = re.search(r'<meta[^>]*property=["\']og:title["\'][^>]*content=["\']([^"\']+)["\']', text, re.I)
-            if not m:
-                m = re.search(r'<meta[^>]*name=["\']title["\'][^>]*content=["\']([^"\']+)["\']', text, re.I)
-            if m:
-                title = m.group(1)
-            if not title:
-                m = re.search(r'<title[^>]*>([^<]+)</title>', text, re.I)
-                if m:
-                    title = m.group(1).strip()
-            m2 = re.search(r'<meta[^>]*name=["\']author["\'][^>]*content=["\']([^"\']+)["\']', text, re.I)
-            if m2:
-                uploader = m2.group(1)
-        return (title or '', uploader or '', final_url)
-    except Exception:
-        return ('', '', '')
+            dt = datetime.datetime.fromisoformat(text[:-1] if text.endswith('Z') else text)
+    except (ValueError, OverflowError, OSError):
+        return text
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 
-def write_aggregated_excel(csv_path: Path, agg_path: Path):
-    """生成聚合 Excel：按 `bili_title` 合并行，发送者列表合并为分号分隔。
-    输出列顺序：time, sender, link, link_type, video_id, bili_title, bili_uploader, context
-    返回 True on success, False on failure（例如缺少 pandas）"""
-    try:
-        import pandas as pd
-    except Exception:
-        print("生成聚合 Excel 失败（未安装 pandas）。请安装：pip install pandas openpyxl")
-        return False
+_DATE_PREFIXES = {4: '%Y', 7: '%Y-%m', 10: '%Y-%m-%d'}
+_TIME_KEY_RE = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
 
-    df = pd.read_csv(csv_path, dtype=str).fillna('')
-    cols = ['time', 'sender', 'link', 'link_type', 'video_id', 'bili_title', 'bili_uploader', 'context']
-    missing = [c for c in cols if c not in df.columns]
-    if missing:
-        print(f"生成聚合 Excel 失败：缺少列 {missing}，无法聚合。")
-        return False
 
-    grouped_rows = []
-    # 保持原顺序：按第一次出现的 bili_title 的顺序分组
-    seen_titles = []
-    for _, row in df.iterrows():
-        t = (row.get('bili_title') or '').strip()
-        if t not in seen_titles:
-            seen_titles.append(t)
-
-    for title in seen_titles:
-        sub = df[df['bili_title'].fillna('') == title]
-        if title == '':
-            # 对于无标题的行，保留原行（不合并）
-            for _, r in sub.iterrows():
-                grouped_rows.append({c: r.get(c, '') for c in cols})
-            continue
+def time_bound(value: str) -> str:
+    """把命令行给出的时间范围端点转成 time_sort_key 的形式；只写到年/月/日的值保留为前缀。
+    既不是日期前缀、time_sort_key 也无法识别的值抛出 ValueError。"""
+    text = str(value).strip()
+    fmt = _DATE_PREFIXES.get(len(text))
+    if fmt:
+        try:
+            datetime.datetime.strptime(text, fmt)
+            return text
+        except ValueError:
+            pass
+    key = time_sort_key(text)
+    if not _TIME_KEY_RE.fullmatch(key):
+        raise ValueError(f"无法识别的时间：{value!r}（应写成 2026、2026-03、2026-03-01 或 2026-03-01 08:00:00）")
+    return key
 
-        def combine(col, sep='; '):
-            vals = [str(x).strip() for x in sub[col].astype(str).fillna('') if str(x).strip()]
-            uniq = []
-            for v in vals:
-                if v not in uniq:
-                    uniq.append(v)
-            return sep.join(uniq)
-
-        time_val = ''
-        times = [t for t in sub['time'].astype(str).fillna('') if t]
-        if times:
-            time_val = sorted(times)[0]
-        grouped_rows.append({
-            'time': time_val,
-            'sender': combine('sender', '; '),
-            'link': combine('link', '; '),
-            'link_type': combine('link_type', '; '),
-            'video_id': combine('video_id', '; '),
-            'bili_title': title,
-            'bili_uploader': combine('bili_uploader', '; '),
-            'context': ' || '.join([c for c in pd.unique(sub['context'].astype(str)) if c and c != 'nan']),
-        })
-
-    out_df = __import__('pandas').DataFrame(grouped_rows, columns=cols)
-    try:
-        out_df.to_excel(agg_path, index=False)
-        print(f"已生成聚合 Excel：{agg_path}")
+
+def _check_time_args(ap: argparse.ArgumentParser, args):
+    """命令行的 --since / --until 无法识别时报错退出，而不是按原样参与字符串比较。"""
+    for opt in ('since', 'until'):
+        value = getattr(args, opt)
+        if value:
+            try:
+                time_bound(value)
+            except ValueError as e:
+                ap.error(f"--{opt}：{e}")
+
+
+class MessageFilter:
+    """--since / --until / --sender 的过滤条件。调用实例判断单条消息是否保留：
+    先比较发送者（sender_candidates 中任一值命中即可），再比较 guess_time 规范化后的时间；
+    设置了时间范围时，无法确定时间的消息会被排除。chunk_may_match 用于按 chunk 的时间范围整体跳过。"""
+
+    __slots__ = ('since', 'until', 'senders')
+
+    def __init__(self, since: str = None, until: str = None, senders: Iterable[str] = None):
+        self.since = time_bound(since) if since else None
+        # until 按前缀包含：'2026-03' 包含整个三月
+        self.until = time_bound(until) + '\uffff' if until else None
+        self.senders = frozenset(str(x) for x in senders) if senders else None
+
+    def __bool__(self):
+        return bool(self.since or self.until or self.senders)
+
+    def describe(self) -> dict:
+        return {'since': self.since, 'until': self.until, 'senders': sorted(self.senders) if self.senders else None}
+
+    def __call__(self, msg: Dict[str, Any]) -> bool:
+        if self.senders is not None:
+            if not any(isinstance(c, (str, int)) and str(c) in self.senders for c in sender_candidates(msg)):
+                return False
+        if self.since or self.until:
+            key = time_sort_key(guess_time(msg))
+            if not key or (self.since and key < self.since) or (self.until and key > self.until):
+                return False
         return True
-    except Exception as e:
-        print(f"写入聚合 Excel 失败：{e}")
-        return False
 
+    def chunk_may_match(self, bounds) -> bool:
+        """bounds 为 (最早, 最晚) 的 time_sort_key；未知（None）时不能跳过。"""
+        if not bounds or not (self.since or self.until):
+            return True
+        lo, hi = bounds
+        return not ((self.since and hi < self.since) or (self.until and lo > self.until))
 
-def process_export_dir(export_dir: Path, out_csv: Path, excel_path: Path = None, fetch_meta: bool = False):
-    manifest_path = export_dir / 'manifest.json'
-    if not manifest_path.exists():
-        print(f"找不到 manifest.json (期望在 {manifest_path})，请确认你传入了正确的导出目录。")
-        return 1
 
-    with manifest_path.open('r', encoding='utf-8') as f:
-        manifest = json.load(f)
+# manifest 的 chunk 条目中可能记录时间范围的字段（值可以是时间字符串、时间戳或 {"time"/"timestamp": ...}）
+_MANIFEST_BOUND_KEYS = (('startTime', 'endTime'), ('start', 'end'), ('firstTime', 'lastTime'),
+                        ('minTime', 'maxTime'), ('beginTime', 'endTime'), ('timeStart', 'timeEnd'))
 
-    chat_name = manifest.get('chatInfo', {}).get('name') or export_dir.name
-    chunked = manifest.get('chunked') or {}
-    chunks_dir = export_dir / chunked.get('chunksDir', 'chunks')
 
-    # 获取 chunk 列表（优先使用 manifest 中列出的顺序）
-    chunk_files = []
-    for c in chunked.get('chunks', []):
-        p = chunks_dir / c.get('fileName')
-        chunk_files.append(p)
+def _bound_value(value):
+    if isinstance(value, dict):
+        value = value.get('time') or value.get('timestamp') or value.get('date')
+    return time_sort_key(value) if value not in (None, '') else ''
 
-    # 若 manifest 没有列出则回退为查找目录中的 .jsonl 文件（按名排序）
-    if not chunk_files:
-        if chunks_dir.exists():
-            chunk_files = sorted(chunks_dir.glob('*.jsonl'))
 
-    if not chunk_files:
-        print(f"未找到任何 chunk jsonl 文件，检查 {chunks_dir} 是否存在。")
-        return 1
+def manifest_chunk_bounds(entry: Dict[str, Any]):
+    """从 manifest 的 chunk 条目中读取时间范围，返回 (最早, 最晚) 的 time_sort_key，没有记录时返回 None。"""
+    if not isinstance(entry, dict):
+        return None
+    for lo_key, hi_key in _MANIFEST_BOUND_KEYS:
+        lo, hi = _bound_value(entry.get(lo_key)), _bound_value(entry.get(hi_key))
+        if lo and hi:
+            return (lo, hi) if lo <= hi else (hi, lo)
+    return None
 
-    # 输出 CSV
-    out_csv.parent.mkdir(parents=True, exist_ok=True)
-    with out_csv.open('w', encoding='utf-8', newline='') as csvf:
-        # 新增列：link_type（分类：short/video/mobile/other），保持向后兼容，放在 link 后面
-        # 新增列：bili_title, bili_uploader，video_id（如未启用元数据抓取则留空）
-        writer = csv.DictWriter(csvf, fieldnames=['chat_name', 'chunk', 'time', 'sender', 'link', 'link_type', 'video_id', 'bili_title', 'bili_uploader', 'context', 'raw_message'])
-        writer.writeheader()
 
-        total_found = 0
-        for chunk_path in chunk_files:
-            if not chunk_path.exists():
-                print(f"跳过不存在的文件: {chunk_path}")
-                continue
-            print(f"处理 {chunk_path} ...")
-            try:
-                for msg in iter_jsonl_messages(chunk_path):
-                    links = find_links_in_message(msg)
-                    if not links:
-                        continue
-                    time = guess_time(msg)
-                    sender = guess_sender(msg)
-                    raw = json.dumps(msg, ensure_ascii=False)
-                    for link, ctx, ltype in links:
-                        video_id = extract_video_id(link)
-                        bili_title = ''
-                        bili_uploader = ''
-                        if fetch_meta:
-                            t, u, resolved = fetch_bilibili_metadata(link)
-                            bili_title = t
-                            bili_uploader = u
-                            # 如果未直接从 URL 提取到视频 ID，尝试从重定向后的 URL 提取
-                            if not video_id and resolved:
-                                video_id = extract_video_id(resolved)
-                        writer.writerow({
-                            'chat_name': chat_name,
-                            'chunk': chunk_path.name,
-                            'time': time,
-                            'sender': sender,
-                            'link': link,
-                            'link_type': ltype,
-                            'video_id': video_id,
-                            'bili_title': bili_title,
-                            'bili_uploader': bili_uploader,
-                            'context': ctx,
-                            'raw_message': raw[:2000],
-                        })
-                        total_found += 1
-            except Exception as e:
-                print(f"处理 {chunk_path} 时出错: {e}")
-        print(f"完成：共找到 {total_found} 条包含 bilibili 链接的消息，已写入 {out_csv}")
+class ChunkTimeRange:
+    """扫描 chunk 时顺带记录的时间范围：所有解析过的消息（过滤之前）中最早/最晚的 time_sort_key。
+    快速路径只解析可能含链接的行，得到的范围覆盖所有可能产出链接的消息，按它跳过 chunk 不会漏掉链接。"""
+
+    __slots__ = ('lo', 'hi')
+
+    def __init__(self, bounds=None):
+        self.lo, self.hi = bounds or (None, None)
+
+    def add(self, msg: Dict[str, Any]):
+        key = time_sort_key(guess_time(msg))
+        if not key:
+            return
+        if self.lo is None or key < self.lo:
+            self.lo = key
+        if self.hi is None or key > self.hi:
+            self.hi = key
 
-    if excel_path:
+    def bounds(self):
+        return (self.lo, self.hi) if self.lo is not None else None
+
+
+class ChunkTimeCache:
+    """每个 chunk 的时间范围缓存（JSON，默认位于输出 CSV 旁），按文件大小与修改时间判断是否仍有效。
+    用于 manifest 没有记录时间范围时，按 --since/--until 跳过整个 chunk。不会为此单独扫描 chunk：
+    范围在正常扫描时顺带收集（见 ChunkTimeRange），由 record 写入，供之后的运行使用。"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._dirty = False
         try:
-            import pandas as pd
-            df = pd.read_csv(out_csv)
-            df.to_excel(excel_path, index=False)
-            print(f"已导出 Excel：{excel_path}")
-        except Exception as e:
-            print(f"生成 Excel 失败（未安装 pandas 或出错）：{e}。可以用 `pip install pandas openpyxl` 后重试。")
+            self._data = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self._data = {}
 
-    # 可选：生成聚合 Excel（按 bili_title 合并并合并发送者）
-    agg_path = export_dir and None
-    # 由 CLI 设置的全局变量会在 main 中传入；如果存在环境变量 AGGREGATE_EXCEL 则也支持
-    try:
-        agg_arg = getattr(process_export_dir, '_aggregate_excel_arg', None)
-    except Exception:
-        agg_arg = None
-    if agg_arg:
-        write_aggregated_excel(out_csv, Path(agg_arg))
+    def bounds(self, chunk_path: Path):
+        """缓存的时间范围；没有记录或 chunk 已变化时返回 None（不能跳过）。"""
+        st = chunk_path.stat()
+        entry = self._data.get(str(chunk_path.resolve()))
+        if entry and entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+            return tuple(entry['bounds']) if entry.get('bounds') else None
+        return None
 
-    return 0
+    def record(self, chunk_path: Path, st, bounds):
+        """记录扫描 chunk 时收集到的时间范围；st 为扫描前的 stat 结果。"""
+        self._data[str(chunk_path.resolve())] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                                 'bounds': list(bounds) if bounds else None}
+        self._dirty = True
 
+    def save(self):
+        if self._dirty:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(self._data, ensure_ascii=False), encoding='utf-8')
+            self._dirty = False
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument('-i', '--input', required=True, help='导出目录（chunked-jsonl 的文件夹）路径')
-    ap.add_argument('-o', '--output', default='bilibili_links.csv', help='输出 CSV 文件路径')
-    ap.add_argument('--excel', help='可选：输出 Excel 文件路径 (.xlsx)')
-    ap.add_argument('--fetch-meta', action='store_true', help='可选：为每个 bilibili 链接抓取标题与投稿人（依赖 requests & beautifulsoup4，可能较慢）')
-    ap.add_argument('--aggregate-excel', help='可选：生成按标题聚合的 Excel 文件（按 bili_title 合并并合并发送者）')
-    args = ap.parse_args()
 
-    input_dir = Path(args.input)
-    out_csv = Path(args.output)
-    excel_path = Path(args.excel) if args.excel else None
+def prune_chunks(chunk_files, message_filter: MessageFilter, manifest_bounds: Dict[Path, tuple] = None,
+                 time_cache: ChunkTimeCache = None):
+    """按时间范围跳过整个 chunk：优先使用 manifest 中记录的范围，其次使用 time_cache 中之前的运行记录的范围。
+    返回 (保留的 chunk 列表, 跳过的数量)。"""
+    if not (message_filter.since or message_filter.until):
+        return list(chunk_files), 0
+    kept = []
+    for p in chunk_files:
+        bounds = (manifest_bounds or {}).get(p)
+        if bounds is None and time_cache is not None:
+            try:
+                bounds = time_cache.bounds(p)
+            except OSError:
+                bounds = None
+        if message_filter.chunk_may_match(bounds):
+            kept.append(p)
+    return kept, len(chunk_files) - len(kept)
+
+
+HTTP_HEADERS = {"User-Agent": "qq-bili-extractor/1.0"}
+_HTTP_SESSION = None
+_HTTP_POOL_SIZE = 0
+_HTTP_SESSION_LOCK = threading.Lock()
+
+
+def get_http_session(pool_size: int = 10):
+    """返回进程内共享的 requests.Session（keep-alive 连接池），需要更大的连接池时重建。"""
+    global _HTTP_SESSION, _HTTP_POOL_SIZE
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None or _HTTP_POOL_SIZE < pool_size:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _HTTP_SESSION, _HTTP_POOL_SIZE = session, pool_size
+        return _HTTP_SESSION
+
+
+# 流式解析页面时最多读取的字符数，防止超大页面拖慢抓取
+MAX_META_HTML_CHARS = 1 << 20
+_UPLOADER_CLASSES = {'username', 'user-name', 'up-name'}
+_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+
+class _HeadMetaParser(HTMLParser):
+    """增量解析页面元数据，字段与取值规则与原先的 BeautifulSoup 实现一致：
+    标题取 og:title（没有则 meta name=title），为空时退回 <title>；投稿人取 meta name=author，
+    没有则取第一个 class 含 username/user-name/up-name 的元素文本。
+    meta 与 <title> 只在 <head> 中查找；只有缺少投稿人时才继续扫描 <body>。"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.og_title = None
+        self.meta_title = None
+        self.author = None
+        self.title_parts = None
+        self.title_done = False
+        self.head_done = False
+        self.class_uploader = None
+        self._in_title = False
+        self._capture_depth = 0
+        self._capture_parts = []
+        self._capture_text = []
+
+    def _flush_capture_text(self):
+        # HTMLParser 可能把一个文本节点拆成多次 handle_data，按节点整体 strip（同 get_text(strip=True)）
+        s = ''.join(self._capture_text).strip()
+        self._capture_text = []
+        if s:
+            self._capture_parts.append(s)
+
+    def handle_starttag(self, tag, attrs):
+        if self._capture_depth:
+            self._flush_capture_text()
+            if tag not in _VOID_TAGS:
+                self._capture_depth += 1
+            return
+        if tag == 'body':
+            self.head_done = True
+        a = dict(attrs)
+        if not self.head_done:
+            if tag == 'meta':
+                if self.og_title is None and a.get('property') == 'og:title':
+                    self.og_title = a.get('content') or ''
+                elif self.meta_title is None and a.get('name') == 'title':
+                    self.meta_title = a.get('content') or ''
+                elif self.author is None and a.get('name') == 'author':
+                    self.author = a.get('content') or ''
+            elif tag == 'title' and self.title_parts is None:
+                self.title_parts = []
+                self._in_title = True
+        if self.class_uploader is None and not self.author and _UPLOADER_CLASSES.intersection((a.get('class') or '').split()):
+            if tag not in _VOID_TAGS:
+                self._capture_depth = 1
+                self._capture_parts = []
+            else:
+                self.class_uploader = ''
+
+    def handle_endtag(self, tag):
+        if self._capture_depth:
+            self._flush_capture_text()
+            self._capture_depth -= 1
+            if self._capture_depth == 0:
+                self.class_uploader = ''.join(self._capture_parts)
+            return
+        if tag == 'title' and self._in_title:
+            self._in_title = False
+            self.title_done = True
+        elif tag == 'head':
+            self.head_done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title_parts.append(data)
+        if self._capture_depth:
+            self._capture_text.append(data)
+
+    def result(self):
+        title = self.og_title if self.og_title is not None else (self.meta_title or '')
+        if not title and self.title_parts:
+            title = ''.join(self.title_parts).strip()
+        uploader = self.author or self.class_uploader or ''
+        return title, uploader
+
+    def complete(self) -> bool:
+        """后续内容已不可能改变结果时返回 True。"""
+        title_final = bool(self.og_title) or self.head_done
+        return title_final and bool(self.author or self.class_uploader)
+
+
+def parse_html_metadata(chunks: Iterable[str], max_chars: int = MAX_META_HTML_CHARS):
+    """从逐块到达的 HTML 文本中提取 (title, uploader)。拿到所需字段后立即停止消费 chunks，
+    读取超过 max_chars 时也会停止。"""
+    parser = _HeadMetaParser()
+    seen = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        seen += len(chunk)
+        if parser.complete() or seen >= max_chars:
+            break
+    return parser.result()
+
+
+def _iter_response_text(resp, chunk_size: int = 16384) -> Iterable[str]:
+    # 响应头未声明编码时按 utf-8 解码（bilibili 页面均为 utf-8）；
+    # requests 对没有 charset 的 text/* 响应会把 resp.encoding 设为 ISO-8859-1，不能直接使用
+    content_type = (getattr(resp, 'headers', None) or {}).get('Content-Type') or ''
+    encoding = resp.encoding if 'charset' in content_type.lower() else None
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for block in resp.iter_content(chunk_size=chunk_size):
+        text = decoder.decode(block)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+# bilibili 限流时返回 412（风控）或 429
+THROTTLE_STATUSES = frozenset({412, 429})
+
+
+class FetchError(Exception):
+    """可重试的抓取失败：被限流（412/429，throttled=True）或临时错误（超时、连接失败、5xx）。
+    retry_after 为服务端 Retry-After 头给出的等待秒数（没有时为 None）。"""
+
+    def __init__(self, message: str, status: int = None, throttled: bool = False, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.throttled = throttled
+        self.retry_after = retry_after
+
+
+def _check_retryable_status(resp, url: str):
+    """限流或 5xx 响应抛出 FetchError；其它状态码交给调用方处理。"""
+    status = getattr(resp, 'status_code', 200)
+    if status in THROTTLE_STATUSES or status >= 500:
+        try:
+            retry_after = float(resp.headers.get('Retry-After'))
+        except (AttributeError, TypeError, ValueError):
+            retry_after = None
+        raise FetchError(f"{url} 返回 {status}", status=status, throttled=status in THROTTLE_STATUSES,
+                         retry_after=retry_after)
+
+
+def _is_transient_error(e: Exception) -> bool:
+    """超时与连接错误（包括 requests 的对应异常）视为临时错误。"""
+    try:
+        import requests
+        if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+            return True
+    except ImportError:
+        pass
+    return isinstance(e, (TimeoutError, ConnectionError))
+
+
+def fetch_bilibili_metadata(link: str):
+    """Try to fetch and extract title and uploader from a bilibili link.
+    Returns (title, uploader, final_url) or ('','','') if not available or on a permanent error (e.g. 404).
+    Raises FetchError when throttled (412/429) or on transient errors (timeouts, connection errors, 5xx),
+    so that callers such as MetadataFetcher can back off and retry.
+    Uses a short timeout and streams the page through parse_html_metadata (og:title, meta name=author, <title>),
+    closing the connection as soon as the fields are found.
+    final_url is the resolved URL after redirects (useful for short links like b23.tv).
+    Requests go through the shared keep-alive session from get_http_session()."""
+    try:
+        resp = get_http_session().get(link, timeout=6, headers=HTTP_HEADERS, allow_redirects=True, stream=True)
+        try:
+            _check_retryable_status(resp, link)
+            resp.raise_for_status()
+            final_url = getattr(resp, 'url', link)
+            title, uploader = parse_html_metadata(_iter_response_text(resp))
+        finally:
+            resp.close()
+        return (title or '', uploader or '', final_url)
+    except FetchError:
+        raise
+    except Exception as e:
+        if _is_transient_error(e):
+            raise FetchError(f"{link}: {e}") from e
+        return ('', '', '')
+
+
+def resolve_short_link(link: str, max_hops: int = 5) -> str:
+    """轻量解析短链（如 b23.tv）：只跟随重定向、不下载页面正文。
+    一旦某一跳的地址中能用 extract_video_id 提取到 BV/AV，就立即停止并返回该地址；
+    否则返回最终不再重定向的地址。最终状态码为 4xx 等永久错误时返回 ''；
+    被限流（412/429）或遇到临时错误（超时、连接失败、5xx）时抛出 FetchError。"""
+    try:
+        session = get_http_session()
+        url = link
+        for _ in range(max_hops):
+            resp = session.head(url, timeout=6, headers=HTTP_HEADERS, allow_redirects=False)
+            if resp.status_code in (405, 501):
+                # 不支持 HEAD 的服务：用流式 GET 只读响应头
+                resp.close()
+                resp = session.get(url, timeout=6, headers=HTTP_HEADERS, allow_redirects=False, stream=True)
+            try:
+                _check_retryable_status(resp, url)
+                status = resp.status_code
+                location = resp.headers.get('Location') if resp.is_redirect else None
+            finally:
+                resp.close()
+            if not location:
+                return url if status < 400 else ''
+            url = urljoin(url, location)
+            if extract_video_id(url):
+                return url
+        return url
+    except FetchError:
+        raise
+    except Exception as e:
+        if _is_transient_error(e):
+            raise FetchError(f"{link}: {e}") from e
+        return ''
+
+
+def apply_metadata(row: Dict[str, Any], meta) -> Dict[str, Any]:
+    """把 fetch_bilibili_metadata 的结果 (title, uploader, final_url) 填入输出行。"""
+    title, uploader, resolved = meta
+    row['bili_title'] = title
+    row['bili_uploader'] = uploader
+    apply_resolved_url(row, resolved)
+    return row
+
+
+def apply_resolved_url(row: Dict[str, Any], resolved: str) -> Dict[str, Any]:
+    """用重定向后的地址补全输出行：未直接从 URL 提取到视频 ID 时从该地址提取；
+    短链解析到视频页时，canonical_url 改为视频页的规范地址，使短链与直接分享的链接可以一起去重/聚合。"""
+    if not resolved:
+        return row
+    info = analyze_bili_link(resolved)
+    if not row.get('video_id'):
+        row['video_id'] = info.video_id
+    if info.video_id and row.get('link_type') == 'short':
+        row['canonical_url'] = info.canonical_url
+    return row
+
+
+def metadata_cache_key(link: str, video_id: str = '') -> str:
+    """元数据的缓存/去重键：能确定视频 ID 时用规范 ID（同一视频的不同链接共用一条），否则用链接本身。"""
+    video_id = video_id or extract_video_id(link)
+    return f'vid:{video_id}' if video_id else f'url:{link}'
+
+
+class MetadataCache:
+    """SQLite 持久化的元数据缓存，映射 metadata_cache_key -> (title, uploader, resolved_url)。
+    成功结果按 ttl 过期，失败结果（负缓存）按较短的 negative_ttl 过期；
+    条目超过 max_entries 时按最近访问时间淘汰。只应在创建它的线程中使用。"""
+
+    def __init__(self, path: Path, ttl: float = 7 * 86400, negative_ttl: float = 3600, max_entries: int = 200000):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path))
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS meta ('
+            ' key TEXT PRIMARY KEY, title TEXT, uploader TEXT, resolved_url TEXT,'
+            ' ok INTEGER, fetched_at REAL, accessed_at REAL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS meta_accessed ON meta(accessed_at)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS resolved (url TEXT PRIMARY KEY, resolved_url TEXT, fetched_at REAL)')
+        self._conn.commit()
+
+    def get(self, key: str):
+        """返回未过期的 (title, uploader, resolved_url)，否则返回 None。"""
+        now = time.time()
+        row = self._conn.execute('SELECT title, uploader, resolved_url, ok, fetched_at FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            title, uploader, resolved, ok, fetched_at = row
+            if now - fetched_at <= (self.ttl if ok else self.negative_ttl):
+                self._conn.execute('UPDATE meta SET accessed_at = ? WHERE key = ?', (now, key))
+                self.hits += 1
+                return (title, uploader, resolved)
+            self._conn.execute('DELETE FROM meta WHERE key = ?', (key,))
+        self.misses += 1
+        return None
+
+    def put(self, keys: Iterable[str], meta):
+        """写入一次抓取结果；resolved_url 为空视为失败（负缓存）。"""
+        title, uploader, resolved = meta
+        now = time.time()
+        ok = 1 if resolved else 0
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO meta (key, title, uploader, resolved_url, ok, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(k, title, uploader, resolved, ok, now, now) for k in keys],
+        )
+
+    def get_resolved(self, url: str):
+        """返回未过期的短链解析结果（解析失败记录为 ''），没有记录时返回 None。"""
+        row = self._conn.execute('SELECT resolved_url, fetched_at FROM resolved WHERE url = ?', (url,)).fetchone()
+        if row is not None:
+            resolved, fetched_at = row
+            if time.time() - fetched_at <= (self.ttl if resolved else self.negative_ttl):
+                self.hits += 1
+                return resolved
+        self.misses += 1
+        return None
+
+    def put_resolved(self, url: str, resolved: str):
+        self._conn.execute('INSERT OR REPLACE INTO resolved (url, resolved_url, fetched_at) VALUES (?, ?, ?)',
+                           (url, resolved, time.time()))
+
+    def evict(self):
+        """超过 max_entries 时删除最久未访问的条目。"""
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM meta').fetchone()
+        extra = count - self.max_entries
+        if extra > 0:
+            self._conn.execute(
+                'DELETE FROM meta WHERE key IN (SELECT key FROM meta ORDER BY accessed_at LIMIT ?)', (extra,))
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM resolved').fetchone()
+        extra = count - self.max_entries
+        if extra > 0:
+            self._conn.execute(
+                'DELETE FROM resolved WHERE url IN (SELECT url FROM resolved ORDER BY fetched_at LIMIT ?)', (extra,))
+
+    def close(self):
+        self.evict()
+        self._conn.commit()
+        self._conn.close()
+
+
+# 抓取调度的默认参数：每秒请求数（令牌桶速率）、单个链接的最大重试次数与退避的初始/最大等待（秒）
+FETCH_RATE = 10.0
+FETCH_MAX_RETRIES = 4
+FETCH_BACKOFF = 1.0
+FETCH_MAX_BACKOFF = 60.0
+
+
+class FetchScheduler:
+    """元数据请求的调度：令牌桶限速 + 自适应并发上限 + 指数退避重试，可被多个线程同时使用。
+    rate 为每秒请求数（None 或 0 表示不限），令牌桶容量 burst 默认为一秒的量。
+    并发上限从 max_concurrency 开始：请求被限流或遇到临时错误时减半（同一批并发请求的失败只减一次），
+    连续成功的请求数达到当前上限后加一，直到回到 max_concurrency。
+    FetchError 按 backoff * 2^n 指数退避（一半固定、一半随机抖动，最多 max_backoff 秒）后重试，
+    服务端给出 Retry-After 时所有请求至少暂停这么久；重试 max_retries 次仍失败时抛出最后的 FetchError。"""
+
+    def __init__(self, max_concurrency: int = 8, rate: float = FETCH_RATE, burst: float = None,
+                 max_retries: int = FETCH_MAX_RETRIES, backoff: float = FETCH_BACKOFF, max_backoff: float = FETCH_MAX_BACKOFF):
+        self.max_concurrency = max(1, int(max_concurrency or 1))
+        self.limit = self.max_concurrency
+        self.rate = rate or None
+        self.burst = max(1.0, burst or (rate or 1.0))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.retries = 0
+        self.failed = 0
+        self.min_limit = self.limit
+        self._active = 0
+        self._streak = 0
+        self._epoch = 0
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _acquire(self) -> int:
+        """等待并发名额与令牌，返回当前的并发调整轮次。"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0 and self._active < self.limit:
+                    if self.rate is None:
+                        break
+                    self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                    self._refilled = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    wait = (1 - self._tokens) / self.rate
+                self._cond.wait(wait if wait > 0 else None)
+            self._active += 1
+            self.requests += 1
+            return self._epoch
+
+    def _release(self, epoch: int, error: FetchError = None):
+        with self._cond:
+            self._active -= 1
+            if error is None:
+                self._streak += 1
+                if self._streak >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._streak = 0
+            else:
+                if error.throttled:
+                    self.throttled += 1
+                else:
+                    self.errors += 1
+                self._streak = 0
+                if epoch == self._epoch:
+                    # 同一轮中先后失败的请求只让上限减半一次
+                    self._epoch += 1
+                    self.limit = max(1, self.limit // 2)
+                    self.min_limit = min(self.min_limit, self.limit)
+                if error.retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + error.retry_after)
+            self._cond.notify_all()
+
+    def backoff_delay(self, attempt: int, error: FetchError = None) -> float:
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if error is not None and error.retry_after:
+            delay = max(delay, min(error.retry_after, self.max_backoff))
+        return delay
+
+    def call(self, func, *args, retries: int = None):
+        """在调度下调用 func(*args)；func 抛出 FetchError 时退避重试（最多 retries 次，默认 max_retries）。"""
+        max_retries = self.max_retries if retries is None else retries
+        attempt = 0
+        while True:
+            epoch = self._acquire()
+            try:
+                result = func(*args)
+            except FetchError as e:
+                self._release(epoch, e)
+                if attempt >= max_retries:
+                    with self._cond:
+                        self.failed += 1
+                    raise
+                time.sleep(self.backoff_delay(attempt, e))
+                attempt += 1
+                with self._cond:
+                    self.retries += 1
+                continue
+            except BaseException:
+                self._release(epoch)
+                raise
+            self._release(epoch)
+            return result
+
+    def summary(self) -> str:
+        return (f"请求调度：请求 {self.requests} 次，被限流 {self.throttled} 次，临时错误 {self.errors} 次，"
+                f"重试 {self.retries} 次，放弃 {self.failed} 个；并发上限最低降到 {self.min_limit}（最大 {self.max_concurrency}）")
+
+
+class RetryQueue:
+    """多次重试后仍然失败（被限流或临时错误）的链接，以 JSONL 保存，供之后的运行或 retry 子命令重新抓取。
+    这些失败不写入负缓存。之后成功抓取的链接会从队列中移除；save() 重写文件（队列为空时删除文件）。
+    只应在创建它的线程中使用。"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries = {}
+        self.added = 0
+        self.drained = 0
+        self._failed = set()
+        try:
+            with self.path.open('r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get('link'):
+                        self.entries[entry['link']] = entry
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, link: str):
+        return link in self.entries
+
+    def links(self) -> list:
+        return list(self.entries)
+
+    def add(self, link: str, error: FetchError):
+        """记录一次失败；同一次运行中重复出现的同一链接（共享一次抓取结果）只计一次。"""
+        if link in self._failed:
+            return
+        self._failed.add(link)
+        prev = self.entries.get(link)
+        if prev is None:
+            self.added += 1
+        self.entries[link] = {'link': link, 'error': str(error), 'status': error.status,
+                              'failures': (prev.get('failures', 0) if prev else 0) + 1, 'failed_at': round(time.time())}
+
+    def discard(self, link: str):
+        if self.entries.pop(link, None) is not None:
+            self.drained += 1
+
+    def save(self):
+        if not self.entries:
+            if self.path.exists():
+                self.path.unlink()
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(str(tmp), str(self.path))
+
+    def summary(self) -> str:
+        return f"重试队列 {self.path}：新增 {self.added} 个，成功移出 {self.drained} 个，剩余 {len(self.entries)} 个"
+
+
+def _done_future(value) -> Future:
+    fut = Future()
+    fut.set_result(value)
+    return fut
+
+
+class MetadataFetcher:
+    """有界并发的元数据抓取器：线程池 + 共享的 keep-alive 连接池。
+    concurrency 同时限制并发请求数与连接池大小。传入 cache 时先查持久化缓存；
+    同一次运行中每个去重键（见 metadata_cache_key）最多请求一次。
+    短链先用 resolve_short_link 轻量解析，解析出视频 ID 后按视频去重/缓存；
+    fetch_meta=False 时只解析短链（补全 video_id），不抓取标题与投稿人。
+    每个请求都经过 scheduler（FetchScheduler，默认按 concurrency 与 FETCH_RATE 创建）限速、调整并发并退避重试；
+    重试后仍失败的链接留空，不写入缓存，传入 retry_queue（RetryQueue）时记入其中。
+    传入 stats（RunStats）时记录每次请求的延迟（含重试）与等待结果的时间。"""
+
+    def __init__(self, concurrency: int = 8, cache: MetadataCache = None, fetch_meta: bool = True, stats=None,
+                 scheduler: FetchScheduler = None, retry_queue: RetryQueue = None):
+        self.concurrency = max(1, int(concurrency or 1))
+        self.cache = cache
+        self.fetch_meta = fetch_meta
+        self.stats = stats
+        self.scheduler = scheduler or FetchScheduler(self.concurrency)
+        self.retry_queue = retry_queue
+        self.fetched = 0
+        self.resolved = 0
+        self.deduped = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='bili-meta')
+        self._memo = {}
+        self._resolved = {}
+        self._unsaved = set()
+        try:
+            get_http_session(self.concurrency)
+        except Exception:
+            # 未安装 requests 时 fetch_bilibili_metadata 会返回空结果
+            pass
+
+    def submit(self, link: str) -> Future:
+        return self._pool.submit(self._fetch, link)
+
+    def _fetch(self, link: str):
+        t0 = time.perf_counter()
+        try:
+            return self.scheduler.call(fetch_bilibili_metadata, link), None
+        except FetchError:
+            raise
+        except Exception:
+            return ('', '', ''), None
+        finally:
+            if self.stats is not None:
+                self.stats.add_latency('fetch', time.perf_counter() - t0)
+
+    def _resolve_then_fetch(self, link: str):
+        t0 = time.perf_counter()
+        try:
+            # 还要抓取页面时，解析只是捷径：失败就不再重试解析，直接抓取短链（GET 会跟随重定向）
+            resolved = self.scheduler.call(resolve_short_link, link, retries=None if not self.fetch_meta else 0)
+        except FetchError:
+            if not self.fetch_meta:
+                raise
+            resolved = None
+        except Exception:
+            resolved = ''
+        if self.stats is not None:
+            self.stats.add_latency('resolve', time.perf_counter() - t0)
+        if not self.fetch_meta:
+            return ('', '', resolved), resolved
+        if resolved:
+            meta, _ = self._fetch(resolved)
+        else:
+            meta, _ = self._fetch(link)
+        return meta, resolved
+
+    def _lookup_meta(self, link: str, video_id: str):
+        key = metadata_cache_key(link, video_id)
+        fut = self._memo.get(key)
+        if fut is not None:
+            self.deduped += 1
+            return key, fut
+        cached = self.cache.get(key) if self.cache else None
+        if cached is not None:
+            fut = _done_future((cached, None))
+        else:
+            fut = self.submit(link)
+            self.fetched += 1
+            self._unsaved.add(key)
+        self._memo[key] = fut
+        return key, fut
+
+    def lookup(self, link: str, video_id: str = ''):
+        """返回 (key, Future)：依次查本次运行的记录、持久化缓存，都没有才真正发起请求。
+        Future 的结果为 ((title, uploader, final_url) 或 None, 本次短链解析结果或 None)。"""
+        if not video_id and classify_bili_link(link) == 'short':
+            resolved = self._resolved.get(link)
+            if resolved is None and self.cache:
+                resolved = self.cache.get_resolved(link)
+                if resolved is not None:
+                    self._resolved[link] = resolved
+            if resolved is not None:
+                if not self.fetch_meta:
+                    return None, _done_future((('', '', resolved), None))
+                vid = extract_video_id(resolved) if resolved else ''
+                if vid:
+                    return self._lookup_meta(resolved, vid)
+                return self._lookup_meta(link, '')
+            key = f'url:{link}'
+            fut = self._memo.get(key)
+            if fut is not None:
+                self.deduped += 1
+                return key, fut
+            fut = self._pool.submit(self._resolve_then_fetch, link)
+            self.resolved += 1
+            if self.fetch_meta:
+                self.fetched += 1
+                self._unsaved.add(key)
+            self._memo[key] = fut
+            return key, fut
+        if not self.fetch_meta:
+            return None, _done_future((None, None))
+        return self._lookup_meta(link, video_id)
+
+    def _finish(self, row, key, fut):
+        link = row['link']
+        try:
+            meta, resolved = fut.result()
+        except FetchError as e:
+            # 重试后仍失败：不写负缓存，留给之后的运行
+            if self.retry_queue is not None:
+                self.retry_queue.add(link, e)
+            return row
+        if self.retry_queue is not None:
+            self.retry_queue.discard(link)
+        if resolved is not None and link not in self._resolved:
+            self._resolved[link] = resolved
+            if self.cache:
+                self.cache.put_resolved(link, resolved)
+        if meta is None:
+            return row
+        if key in self._unsaved:
+            self._unsaved.discard(key)
+            final = resolved or meta[2]
+            resolved_vid = extract_video_id(final) if final else ''
+            keys = [key]
+            # 短链解析出视频 ID 后，同时以视频 ID 记录，后续同一视频的链接也能命中
+            if resolved_vid and f'vid:{resolved_vid}' != key:
+                keys.append(f'vid:{resolved_vid}')
+                self._memo.setdefault(f'vid:{resolved_vid}', _done_future((meta, None)))
+            if self.cache:
+                self.cache.put(keys, meta)
+        apply_resolved_url(row, resolved)
+        if not self.fetch_meta:
+            return row
+        return apply_metadata(row, meta)
+
+    def enrich(self, rows: Iterable[Dict[str, Any]], window: int = None) -> Iterable[Dict[str, Any]]:
+        """边消费上游行边提交抓取，按原顺序产出补全元数据后的行。
+        最多有 window 行（默认 4 倍并发数）在等待结果，避免一个慢链接阻塞提取或无限占用内存。"""
+        window = window or self.concurrency * 4
+        finish = self._finish if self.stats is None else self._finish_timed
+        pending = deque()
+        for row in rows:
+            key, fut = self.lookup(row['link'], row.get('video_id', ''))
+            pending.append((row, key, fut))
+            while len(pending) > window or (pending and pending[0][2].done()):
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+
+    def _finish_timed(self, row, key, fut):
+        t0 = time.perf_counter()
+        fut.exception()
+        self.stats.add('fetch_wait', time.perf_counter() - t0)
+        return self._finish(row, key, fut)
+
+    def summary(self) -> str:
+        parts = [f"短链解析 {self.resolved}", f"本次运行去重 {self.deduped}"]
+        if self.fetch_meta:
+            parts.insert(0, f"实际抓取 {self.fetched}")
+        if self.cache:
+            parts.insert(0, f"缓存命中 {self.cache.hits}，未命中 {self.cache.misses}")
+        lines = ["元数据抓取：" + "，".join(parts), self.scheduler.summary()]
+        if self.retry_queue is not None:
+            lines.append(self.retry_queue.summary())
+        return "\n".join(lines)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self.cache:
+            self.cache.close()
+        if self.retry_queue is not None:
+            self.retry_queue.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# 聚合输出的列，以及 --aggregate-by 可选的分组依据对应的列
+AGG_COLUMNS = ['time', 'sender', 'link', 'link_type', 'video_id', 'bili_title', 'bili_uploader', 'context']
+AGG_GROUP_KEYS = {'title': 'bili_title', 'video_id': 'video_id', 'url': 'canonical_url'}
+# 分组列为空时改用的列（旧版本的输出没有 canonical_url 列），聚合结果中分组键也显示在这一列
+_AGG_KEY_FALLBACK = {'canonical_url': 'link'}
+
+
+def iter_csv_columns(csv_path: Path, columns) -> Iterable[Dict[str, str]]:
+    """流式读取 CSV，只保留 columns 中的列（raw_message 等大字段不会常驻内存）。"""
+    with csv_path.open('r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            yield {c: row.get(c) or '' for c in columns}
+
+
+def csv_header(csv_path: Path):
+    with csv_path.open('r', encoding='utf-8', newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def is_parquet_path(path: Path) -> bool:
+    return Path(path).suffix.lower() in ('.parquet', '.pq')
+
+
+def iter_parquet_columns(parquet_path: Path, columns, batch_size: int = 65536) -> Iterable[Dict[str, str]]:
+    """按批读取 Parquet，只解码 columns 中的列（列投影，未请求的列不会被读取）。
+    文件中缺少的列填空字符串。需要 pyarrow。"""
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(str(parquet_path))
+    present = [c for c in columns if c in pf.schema_arrow.names]
+    for batch in pf.iter_batches(batch_size=batch_size, columns=present):
+        for row in batch.to_pylist():
+            yield {c: row.get(c) or '' for c in columns}
+
+
+def parquet_header(parquet_path: Path):
+    import pyarrow.parquet as pq
+    return list(pq.ParquetFile(str(parquet_path)).schema_arrow.names)
+
+
+def iter_output_columns(path: Path, columns) -> Iterable[Dict[str, str]]:
+    """按扩展名读取输出文件（CSV 或 Parquet）中的指定列。"""
+    return iter_parquet_columns(path, columns) if is_parquet_path(path) else iter_csv_columns(path, columns)
+
+
+def output_header(path: Path):
+    return parquet_header(path) if is_parquet_path(path) else csv_header(path)
+
+
+class _AggGroup:
+    __slots__ = ('time', 'values', 'contexts', 'rows')
+
+    def __init__(self):
+        self.time = None
+        # dict 作为保持插入顺序的集合
+        self.values = {c: {} for c in AGG_COLUMNS if c not in ('time', 'context')}
+        self.contexts = {}
+        self.rows = None
+
+
+def aggregate_rows(rows: Iterable[Dict[str, str]], group_by: str = 'title'):
+    """单遍哈希聚合：按分组键第一次出现的顺序输出分组。
+    组内 time 取最早的非空值，context 以 ' || ' 连接，其余列为去重后的非空值（'; ' 连接）；
+    分组键为空的行不合并，按原样保留在该空组第一次出现的位置。
+    按 url 分组时使用 canonical_url（为空时用 link），同一视频的不同分享链接合并为一组。"""
+    key_col = AGG_GROUP_KEYS[group_by]
+    fallback = _AGG_KEY_FALLBACK.get(key_col)
+    groups = {}
+    for row in rows:
+        key = (row.get(key_col) or (row.get(fallback) if fallback else '') or '').strip()
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = _AggGroup()
+        if key == '':
+            if g.rows is None:
+                g.rows = []
+            g.rows.append({c: row.get(c, '') for c in AGG_COLUMNS})
+            continue
+        t = row.get('time') or ''
+        if t and (g.time is None or t < g.time):
+            g.time = t
+        for c, seen in g.values.items():
+            v = str(row.get(c) or '').strip()
+            if v:
+                seen[v] = None
+        ctx = row.get('context') or ''
+        if ctx:
+            g.contexts[ctx] = None
+
+    out = []
+    for key, g in groups.items():
+        if key == '':
+            out.extend(g.rows)
+            continue
+        merged = {c: '; '.join(seen) for c, seen in g.values.items()}
+        merged[fallback or key_col] = key
+        merged['time'] = g.time or ''
+        merged['context'] = ' || '.join(g.contexts)
+        out.append({c: merged[c] for c in AGG_COLUMNS})
+    return out
+
+
+def write_aggregated_excel(csv_path: Path, agg_path: Path, group_by: str = 'title'):
+    """生成聚合 Excel：默认按 `bili_title` 合并行（group_by 也可为 'video_id' 或 'url'），发送者列表合并为分号分隔。
+    csv_path 也可以是 --parquet 写出的 .parquet 文件（只读取需要的列）。
+    输出列顺序：time, sender, link, link_type, video_id, bili_title, bili_uploader, context
+    返回 True on success, False on failure（例如缺少 pandas）"""
+    try:
+        import pandas as pd
+    except Exception:
+        print("生成聚合 Excel 失败（未安装 pandas）。请安装：pip install pandas openpyxl")
+        return False
+
+    try:
+        header = output_header(csv_path)
+    except ImportError:
+        print("生成聚合 Excel 失败（读取 Parquet 需要 pyarrow）。请安装：pip install pyarrow")
+        return False
+    missing = [c for c in AGG_COLUMNS if c not in header]
+    if missing:
+        print(f"生成聚合 Excel 失败：缺少列 {missing}，无法聚合。")
+        return False
+
+    columns = AGG_COLUMNS + [c for c in (AGG_GROUP_KEYS[group_by],) if c not in AGG_COLUMNS]
+    grouped_rows = aggregate_rows(iter_output_columns(csv_path, columns), group_by)
+    out_df = pd.DataFrame(grouped_rows, columns=AGG_COLUMNS)
+    try:
+        out_df.to_excel(agg_path, index=False)
+        print(f"已生成聚合 Excel：{agg_path}")
+        return True
+    except Exception as e:
+        print(f"写入聚合 Excel 失败：{e}")
+        return False
+
+
+# 输出 CSV 列（新增列：link_type（分类：short/video/mobile/other），保持向后兼容，放在 link 后面；
+# 新增列：bili_title, bili_uploader，video_id（如未启用元数据抓取则留空）；
+# canonical_url 为规范化后的链接（见 analyze_bili_link），用于去重与按地址聚合）
+CSV_FIELDS = ['chat_name', 'chunk', 'time', 'sender', 'link', 'link_type', 'video_id', 'canonical_url', 'bili_title',
+              'bili_uploader', 'context', 'raw_message']
+_RECORD_KEYS = dict.fromkeys(CSV_FIELDS).keys()
+# 分片与增量状态文件中每行保存的字段：CSV 列之后多一列消息 ID（供去重使用，不写入输出）
+_STORED_FIELDS = CSV_FIELDS + ['message_id']
+# raw_message 列保留的最大字符数
+RAW_MESSAGE_CHARS = 2000
+
+
+class _LinkMessage:
+    """同一条消息产出的多条链接共享的数据：原始消息、拼接后的正文，以及按需计算一次的 raw_message。"""
+
+    __slots__ = ('msg', 'text', 'raw')
+
+    def __init__(self, msg: Dict[str, Any], text: str):
+        self.msg = msg
+        self.text = text
+        self.raw = None
+
+
+class LinkRecord:
+    """一条链接记录（iter_bilibili_links / iter_chunk_rows 的产出），字段同 CSV_FIELDS。
+    context 与 raw_message 在第一次访问时才计算（同一消息的多条链接共享一次 json.dumps）；
+    message 为原始消息 dict（从分片或状态文件读回的记录为 None）；message_id 为消息 ID（没有时为空串），不属于 CSV 列。
+    也支持 record['link']、record.get(...) 等 dict 式访问，可以直接交给 csv.DictWriter 和各输出写出器。"""
+
+    __slots__ = ('chat_name', 'chunk', 'time', 'sender', 'link', 'link_type', 'video_id', 'canonical_url', 'bili_title',
+                 'bili_uploader', 'message_id', '_context', '_raw', '_source', '_span')
+
+    def __init__(self, chat_name='', chunk='', time='', sender='', link='', link_type='', video_id='', canonical_url='',
+                 bili_title='', bili_uploader='', context=None, raw_message=None, message_id='',
+                 source: _LinkMessage = None, span: tuple = None):
+        self.chat_name = chat_name
+        self.chunk = chunk
+        self.time = time
+        self.sender = sender
+        self.link = link
+        self.link_type = link_type
+        self.video_id = video_id
+        self.canonical_url = canonical_url
+        self.bili_title = bili_title
+        self.bili_uploader = bili_uploader
+        self.message_id = message_id
+        self._context = context
+        self._raw = raw_message
+        self._source = source
+        self._span = span
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> 'LinkRecord':
+        return cls(*(row.get(f) or '' for f in _STORED_FIELDS))
+
+    @property
+    def context(self) -> str:
+        if self._context is None:
+            self._context = link_context(self._source.text, *self._span)
+        return self._context
+
+    @context.setter
+    def context(self, value: str):
+        self._context = value
+
+    @property
+    def raw_message(self) -> str:
+        """原始消息的 JSON（截断到 RAW_MESSAGE_CHARS 个字符）。"""
+        if self._raw is None:
+            source = self._source
+            if source.raw is None:
+                source.raw = json.dumps(source.msg, ensure_ascii=False)[:RAW_MESSAGE_CHARS]
+            self._raw = source.raw
+        return self._raw
+
+    @raw_message.setter
+    def raw_message(self, value: str):
+        self._raw = value
+
+    @property
+    def message(self):
+        return self._source.msg if self._source is not None else None
+
+    def keys(self):
+        return _RECORD_KEYS
+
+    def __getitem__(self, key: str):
+        if key not in _RECORD_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in _RECORD_KEYS else default
+
+    def __setitem__(self, key: str, value):
+        if key not in _RECORD_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def values(self) -> list:
+        """按 CSV_FIELDS 顺序排列的字段值（可直接交给 csv.writer）。"""
+        return [self.chat_name, self.chunk, self.time, self.sender, self.link, self.link_type, self.video_id,
+                self.canonical_url, self.bili_title, self.bili_uploader, self.context, self.raw_message]
+
+    def stored_values(self) -> list:
+        """values() 之后加上 message_id（分片与状态文件的行格式，见 _STORED_FIELDS）。"""
+        values = self.values()
+        values.append(self.message_id)
+        return values
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(zip(CSV_FIELDS, self.values()))
+
+    def __eq__(self, other):
+        if not isinstance(other, LinkRecord):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"LinkRecord(link={self.link!r}, chunk={self.chunk!r}, time={self.time!r}, sender={self.sender!r})"
+
+
+def _add_stage(stages: dict, name: str, seconds: float, calls: int = 1):
+    entry = stages.get(name)
+    if entry is None:
+        stages[name] = [seconds, calls]
+    else:
+        entry[0] += seconds
+        entry[1] += calls
+
+
+def peak_rss_mb(children: bool = False):
+    """本进程（children=True 时为已结束的子进程中最大者）的峰值 RSS（MB）；Windows 上返回 None。"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def _percentile(sorted_values, q: float):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[idx]
+
+
+class RunStats:
+    """--stats 的运行统计：各阶段累计耗时与调用次数、每个 chunk 的字节/行数/吞吐/链接数、
+    抓取延迟分位数与峰值内存。未启用时不会创建，提取热路径保持原样。
+    progress 为文本流（如 sys.stderr）时每处理完一个 chunk 打印一行进度。"""
+
+    def __init__(self, progress=None):
+        self.stages = {}
+        self.chunks = []
+        self.latencies = {}
+        self.total_chunks = 0
+        self.progress = progress
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, calls: int = 1):
+        with self._lock:
+            _add_stage(self.stages, name, seconds, calls)
+
+    def add_latency(self, kind: str, seconds: float):
+        with self._lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+
+    def add_chunk(self, chunk_path: Path, profile: dict = None, links: int = 0, reused: bool = False, error: str = None):
+        """记录一个 chunk 的统计；profile 为 iter_chunk_rows(profile=...) 填写的字典。"""
+        profile = profile or {}
+        for name, (seconds, calls) in profile.get('stages', {}).items():
+            self.add(name, seconds, calls)
+        seconds = sum(v[0] for v in profile.get('stages', {}).values())
+        try:
+            size = chunk_path.stat().st_size
+        except OSError:
+            size = 0
+        lines = profile.get('lines', 0)
+        entry = {
+            'chunk': chunk_path.name,
+            'bytes': size,
+            'lines': lines,
+            'parsed': profile.get('parsed', 0),
+            'links': profile.get('links', links),
+            'seconds': round(seconds, 6),
+            'messages_per_sec': round(lines / seconds, 1) if seconds else None,
+            'mb_per_sec': round(size / (1 << 20) / seconds, 2) if seconds else None,
+        }
+        if reused:
+            entry['reused'] = True
+        if error:
+            entry['error'] = error
+        self.chunks.append(entry)
+        if self.progress is not None:
+            mps = f"{entry['messages_per_sec']:.0f} msg/s" if entry['messages_per_sec'] else '-'
+            state = '复用' if reused else ('出错' if error else f'{seconds:.2f}s {mps}')
+            self.progress.write(f"[{len(self.chunks)}/{self.total_chunks or '?'}] {chunk_path.name} "
+                                f"{size / (1 << 20):.1f} MB {lines} 行 链接 {entry['links']} {state} "
+                                f"已用 {time.perf_counter() - self._t0:.1f}s\n")
+            self.progress.flush()
+
+    def report(self) -> dict:
+        wall = time.perf_counter() - self._t0
+        total_bytes = sum(c['bytes'] for c in self.chunks)
+        total_lines = sum(c['lines'] for c in self.chunks)
+        latency = {}
+        for kind, values in self.latencies.items():
+            values = sorted(values)
+            latency[kind] = {'count': len(values), 'mean': sum(values) / len(values),
+                             'p50': _percentile(values, 50), 'p90': _percentile(values, 90),
+                             'p99': _percentile(values, 99), 'max': values[-1]}
+        return {
+            'wall_seconds': round(wall, 4),
+            'chunks': len(self.chunks),
+            'bytes': total_bytes,
+            'lines': total_lines,
+            'links': sum(c['links'] for c in self.chunks),
+            'messages_per_sec': round(total_lines / wall, 1) if wall else None,
+            'mb_per_sec': round(total_bytes / (1 << 20) / wall, 2) if wall else None,
+            'stages': {k: {'seconds': round(v[0], 6), 'calls': v[1]}
+                       for k, v in sorted(self.stages.items(), key=lambda kv: -kv[1][0])},
+            'fetch_latency': latency,
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_rss_children_mb': peak_rss_mb(children=True),
+            'per_chunk': self.chunks,
+        }
+
+    def summary(self, report: dict = None) -> str:
+        r = report or self.report()
+        lines = [f"统计：{r['chunks']} 个 chunk，{r['bytes'] / (1 << 20):.1f} MB，{r['lines']} 行，链接 {r['links']}，"
+                 f"总耗时 {r['wall_seconds']:.2f}s（{r['messages_per_sec'] or 0:.0f} 消息/秒，{r['mb_per_sec'] or 0:.1f} MB/秒）"]
+        if sum(st['seconds'] for st in r['stages'].values()) > r['wall_seconds']:
+            lines.append("  （多进程时各阶段耗时为所有工作进程累计，占比可能超过 100%）")
+        for name, st in r['stages'].items():
+            share = st['seconds'] / r['wall_seconds'] * 100 if r['wall_seconds'] else 0
+            lines.append(f"  {name:<16}{st['seconds']:>10.3f}s {share:>6.1f}%  调用 {st['calls']}")
+        for kind, lat in r['fetch_latency'].items():
+            lines.append(f"  {kind} 延迟：{lat['count']} 次，p50 {lat['p50'] * 1000:.0f}ms，p90 {lat['p90'] * 1000:.0f}ms，"
+                         f"p99 {lat['p99'] * 1000:.0f}ms，最大 {lat['max'] * 1000:.0f}ms")
+        if r['peak_rss_mb'] is not None:
+            children = f"，工作进程 {r['peak_rss_children_mb']} MB" if r['peak_rss_children_mb'] else ''
+            lines.append(f"  峰值内存 {r['peak_rss_mb']} MB{children}")
+        return "\n".join(lines)
+
+
+def _link_records(chunk_name: str, chat_name: str, msg_time, sender, message_id: str, source: _LinkMessage,
+                  spans) -> Iterable[LinkRecord]:
+    for link, start, end, info in spans:
+        yield LinkRecord(chat_name, chunk_name, msg_time, sender, link, info.link_type, info.video_id, info.canonical_url,
+                         message_id=message_id, source=source, span=(start, end))
+
+
+def iter_chunk_rows(chunk_path: Path, chat_name: str, prefilter: bool = True, profile: dict = None,
+                    message_filter: MessageFilter = None, time_range: ChunkTimeRange = None) -> Iterable[LinkRecord]:
+    """逐条产出某个 chunk 中的 bilibili 链接记录（LinkRecord，字段见 CSV_FIELDS，元数据列留空）。
+    prefilter=True 时使用字节级预筛的快速路径（结果相同）。
+    传入 profile（dict）时改走带计时的路径，把各阶段耗时与行数等写入其中（见 RunStats.add_chunk）。
+    传入 message_filter 时，不满足条件的消息在查找链接与 json.dumps 之前就被丢弃。
+    传入 time_range（ChunkTimeRange）时顺带记录解析过的消息的时间范围（过滤之前）。"""
+    if not message_filter:
+        message_filter = None
+    if profile is not None:
+        yield from _iter_chunk_rows_profiled(chunk_path, chat_name, prefilter, profile, message_filter, time_range)
+        return
+    messages = iter_candidate_messages(chunk_path) if prefilter else iter_jsonl_messages(chunk_path)
+    yield from _iter_message_rows(messages, chunk_path.name, chat_name, message_filter, time_range)
+
+
+def _iter_message_rows(messages: Iterable[Dict[str, Any]], chunk_name: str, chat_name: str,
+                       message_filter: MessageFilter = None, time_range: ChunkTimeRange = None) -> Iterable[LinkRecord]:
+    for msg in messages:
+        if time_range is not None:
+            time_range.add(msg)
+        if message_filter is not None and not message_filter(msg):
+            continue
+        text = "\n".join(message_texts(msg))
+        spans = find_link_spans(text)
+        if not spans:
+            continue
+        yield from _link_records(chunk_name, chat_name, guess_time(msg), guess_sender(msg), guess_message_id(msg),
+                                 _LinkMessage(msg, text), spans)
+
+
+def _iter_chunk_rows_profiled(chunk_path: Path, chat_name: str, prefilter: bool, profile: dict,
+                              message_filter: MessageFilter = None, time_range: ChunkTimeRange = None):
+    """与 iter_chunk_rows 结果相同，但分别累计 read / json_loads / filter / extract_strings / regex /
+    fields / json_dumps 各阶段的耗时（产出行之后下游消耗的时间不计入）。
+    为了统计 json_dumps，这里会预先计算 raw_message，而不是等到第一次访问。
+    prefilter=False 时读取与解析无法分开，全部计入 json_loads。"""
+    perf = time.perf_counter
+    stages = profile.setdefault('stages', {})
+    profile.setdefault('lines', 0)
+    profile.setdefault('parsed', 0)
+    profile.setdefault('links', 0)
+    if prefilter:
+        source = iter(iter_candidate_raw_lines(chunk_path, profile))
+    else:
+        source = iter(iter_jsonl_messages(chunk_path))
+    while True:
+        t0 = perf()
+        item = next(source, None)
+        t1 = perf()
+        if item is None:
+            _add_stage(stages, 'read' if prefilter else 'json_loads', t1 - t0, 0)
+            break
+        if prefilter:
+            _add_stage(stages, 'read', t1 - t0)
+            line = item.decode('utf-8', errors='ignore').strip()
+            if not line:
+                continue
+            try:
+                msg = json.loads(line)
+            except Exception:
+                msg = None
+            t2 = perf()
+            _add_stage(stages, 'json_loads', t2 - t1)
+            if msg is None:
+                continue
+        else:
+            msg = item
+            profile['lines'] += 1
+            _add_stage(stages, 'json_loads', t1 - t0)
+            t2 = t1
+        profile['parsed'] += 1
+        if time_range is not None:
+            time_range.add(msg)
+        if message_filter is not None:
+            keep = message_filter(msg)
+            t = perf()
+            _add_stage(stages, 'filter', t - t2)
+            t2 = t
+            if not keep:
+                continue
+        text = "\n".join(message_texts(msg))
+        t3 = perf()
+        _add_stage(stages, 'extract_strings', t3 - t2)
+        spans = find_link_spans(text)
+        t4 = perf()
+        _add_stage(stages, 'regex', t4 - t3)
+        if not spans:
+            continue
+        msg_time, sender, message_id = guess_time(msg), guess_sender(msg), guess_message_id(msg)
+        t5 = perf()
+        _add_stage(stages, 'fields', t5 - t4)
+        link_msg = _LinkMessage(msg, text)
+        link_msg.raw = json.dumps(msg, ensure_ascii=False)[:RAW_MESSAGE_CHARS]
+        _add_stage(stages, 'json_dumps', perf() - t5)
+        profile['links'] += len(spans)
+        yield from _link_records(chunk_path.name, chat_name, msg_time, sender, message_id, link_msg, spans)
+
+
+def _profile_path(shard_path: Path) -> Path:
+    return shard_path.with_name(shard_path.name + '.stats.json')
+
+
+def _partial_shard_path(shard_path: Path) -> Path:
+    return shard_path.with_name(shard_path.name + '.tmp')
+
+
+def _discard_shard(shard_path: Path):
+    """删除崩溃的任务留下的分片及其旁边的文件（写了一半的内容不能交给输出）。"""
+    for p in (shard_path, _partial_shard_path(shard_path), _profile_path(shard_path)):
+        try:
+            p.unlink()
+        except OSError:
+            pass
+
+
+def _scan_chunk_to_shard(chunk_path: Path, chat_name: str, shard_path: Path, profile: bool = False,
+                         message_filter: MessageFilter = None, collect_times: bool = False):
+    """工作进程入口：把一个 chunk 的结果写入独立的分片 CSV（不含表头）。
+    返回 (写入行数, 错误信息或 None, 时间范围或 None)；出错时保留已写入的行，与串行处理时的行为一致。
+    collect_times=True 时顺带收集该 chunk 的时间范围（见 ChunkTimeRange）。
+    profile=True 时把该 chunk 的计时统计写到分片旁的 .stats.json，由主进程读回。
+    分片先写到临时文件，返回前才改名为 shard_path：工作进程中途崩溃时不会留下只写了一部分（可能截断在一行中间）的分片。"""
+    count = 0
+    prof = {} if profile else None
+    time_range = ChunkTimeRange() if collect_times else None
+    err = None
+    partial_path = _partial_shard_path(shard_path)
+    with partial_path.open('w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        try:
+            for row in iter_chunk_rows(chunk_path, chat_name, profile=prof, message_filter=message_filter,
+                                       time_range=time_range):
+                writer.writerow(row.stored_values())
+                count += 1
+        except Exception as e:
+            err = str(e)
+    if prof is not None:
+        _profile_path(shard_path).write_text(json.dumps(prof), encoding='utf-8')
+    # 旁边的统计文件先写完，分片存在即表示整个任务已完成
+    os.replace(str(partial_path), str(shard_path))
+    return count, err, time_range.bounds() if time_range is not None else None
+
+
+def _run_isolated(job):
+    """在单独的进程池中重跑一个 chunk，用于定位导致工作进程崩溃的 chunk。"""
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        try:
+            return pool.submit(_scan_chunk_to_shard, *job).result()
+        except BrokenProcessPool:
+            _discard_shard(job[2])
+            return 0, '工作进程异常退出', None
+        except Exception as e:
+            _discard_shard(job[2])
+            return 0, str(e), None
+
+
+def iter_parallel_chunk_results(jobs, workers: int):
+    """用进程池并行处理 chunk，并按 jobs 的顺序产出 (job, (count, error, 时间范围))。
+    job 为 _scan_chunk_to_shard 的参数元组。某个 chunk 出错或工作进程崩溃只影响该 chunk：
+    进程池损坏时，先单独重跑当前 chunk 以确认是否由它引起，再用新进程池继续处理其余 chunk。"""
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = [pool.submit(_scan_chunk_to_shard, *job) for job in jobs]
+        for i, job in enumerate(jobs):
+            try:
+                result = futures[i].result()
+            except BrokenProcessPool:
+                pool.shutdown(wait=True)
+                result = _run_isolated(job)
+                pool = ProcessPoolExecutor(max_workers=workers)
+                for j in range(i + 1, len(jobs)):
+                    f = futures[j]
+                    if not (f.done() and f.exception() is None):
+                        futures[j] = pool.submit(_scan_chunk_to_shard, *jobs[j])
+            except Exception as e:
+                _discard_shard(job[2])
+                result = (0, str(e), None)
+            yield job, result
+    finally:
+        pool.shutdown(wait=True)
+
+
+def file_sha256(path: Path, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ChunkState:
+    """增量运行的状态文件（JSONL，默认位于输出 CSV 旁）。
+    首行为表头；之后每处理完一个 chunk 追加两行：先是该 chunk 的提取结果（按 _STORED_FIELDS 排列的行，
+    不含元数据抓取结果），再是 {"chunk", "size", "mtime_ns", "sha256", "count"} 作为提交标记。
+    只有带提交标记的记录才会被采用，因此中断的运行可以从最后完成的 chunk 继续；
+    正常结束后 compact() 把文件重写为只包含本次 chunk 列表的记录。"""
+
+    VERSION = 1
+
+    def __init__(self, path: Path, chat_name: str, filters: dict = None):
+        self.path = Path(path)
+        self.header = {'version': self.VERSION, 'chat_name': chat_name, 'fields': _STORED_FIELDS}
+        if filters:
+            # 过滤条件不同则记录的结果不可复用
+            self.header['filters'] = filters
+        self.reused = 0
+        self.recorded = 0
+        self._index = {}
+        self._used = {}
+        fresh = not self._load()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._out = self.path.open('wb' if fresh else 'ab')
+        if fresh:
+            self._write_line(self.header)
+        elif self._out.tell() and not self._ends_with_newline():
+            # 上次运行在写一行时被中断：先补上换行，避免新记录与残行粘连
+            self._out.write(b'\n')
+        self._out.flush()
+        self._reader = self.path.open('rb')
+
+    def _ends_with_newline(self) -> bool:
+        with self.path.open('rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _load(self) -> bool:
+        """读取已有状态（只解析提交标记，不解析行数据）。表头不匹配时返回 False 并从头开始。"""
+        if not self.path.exists():
+            return False
+        with self.path.open('rb') as f:
+            try:
+                if json.loads(f.readline()) != self.header:
+                    return False
+            except Exception:
+                return False
+            pos = f.tell()
+            rows_offset = None
+            for line in f:
+                offset, pos = pos, pos + len(line)
+                if line.startswith(b'['):
+                    rows_offset = offset
+                elif line.startswith(b'{') and rows_offset is not None:
+                    try:
+                        meta = json.loads(line)
+                    except Exception:
+                        continue
+                    self._index[meta['chunk']] = (rows_offset, meta)
+                    rows_offset = None
+        return True
+
+    def _write_line(self, obj) -> int:
+        offset = self._out.tell()
+        self._out.write(json.dumps(obj, ensure_ascii=False).encode('utf-8') + b'\n')
+        return offset
+
+    def lookup(self, chunk_path: Path, st: os.stat_result):
+        """chunk 未变化（大小与 mtime 相同，或 mtime 变了但内容哈希相同）时返回记录句柄，否则返回 None。"""
+        entry = self._index.get(chunk_path.name)
+        if entry is None:
+            return None
+        offset, meta = entry
+        if meta['size'] != st.st_size:
+            return None
+        if meta['mtime_ns'] != st.st_mtime_ns:
+            if file_sha256(chunk_path) != meta['sha256']:
+                return None
+            meta = dict(meta, mtime_ns=st.st_mtime_ns)
+        self._used[chunk_path.name] = (offset, meta)
+        self.reused += 1
+        return offset
+
+    def load_rows(self, offset: int) -> Iterable[LinkRecord]:
+        self._reader.seek(offset)
+        for values in json.loads(self._reader.readline()):
+            yield LinkRecord(*values)
+
+    def record(self, chunk_path: Path, rows, st: os.stat_result):
+        """记录一个 chunk 的处理结果（rows 为 LinkRecord.stored_values() 的列表）；
+        若处理期间文件发生变化则不记录（下次会重新扫描）。"""
+        now = chunk_path.stat()
+        if (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return
+        meta = {'chunk': chunk_path.name, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                'sha256': file_sha256(chunk_path), 'count': len(rows)}
+        offset = self._write_line(rows)
+        self._write_line(meta)
+        self._out.flush()
+        self._index[chunk_path.name] = self._used[chunk_path.name] = (offset, meta)
+        self.recorded += 1
+
+    def compact(self, chunk_files):
+        """重写状态文件，只保留本次运行复用或记录的 chunk（按 chunk 列表顺序）。"""
+        self._out.close()
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('wb') as out:
+            out.write(json.dumps(self.header, ensure_ascii=False).encode('utf-8') + b'\n')
+            for p in chunk_files:
+                entry = self._used.get(p.name)
+                if entry is None:
+                    continue
+                offset, meta = entry
+                self._reader.seek(offset)
+                out.write(self._reader.readline())
+                out.write(json.dumps(meta, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._reader.close()
+        os.replace(str(tmp), str(self.path))
+
+    def close(self):
+        self._out.close()
+        self._reader.close()
+
+    def summary(self) -> str:
+        return f"增量处理：复用 {self.reused} 个未变化的 chunk，新扫描并记录 {self.recorded} 个"
+
+
+def _shard_rows(shard_path: Path, err, profile: dict = None):
+    # 只有完整写完的任务才会留下 shard_path（见 _scan_chunk_to_shard）
+    if shard_path.exists():
+        with shard_path.open('r', encoding='utf-8', newline='') as sf:
+            for row in csv.DictReader(sf, fieldnames=_STORED_FIELDS):
+                yield LinkRecord.from_row(row)
+        shard_path.unlink()
+        prof_path = _profile_path(shard_path)
+        if profile is not None and prof_path.exists():
+            profile.update(json.loads(prof_path.read_text(encoding='utf-8')))
+            prof_path.unlink()
+    if err:
+        raise RuntimeError(err)
+
+
+def _iter_scanned_chunks(chunk_files, chat_name: str, workers: int, shard_dir: Path, profile: bool = False,
+                         message_filter: MessageFilter = None, collect_times: bool = False):
+    """按顺序产出 (chunk_path, rows, profile, time_range)；rows 为可迭代的行，chunk 出错时在迭代中抛出异常。
+    profile=True 时 profile 为一个字典，rows 迭代完后填有该 chunk 的计时统计；否则为 None。
+    collect_times=True 时 time_range 为 ChunkTimeRange，rows 迭代完后记录有该 chunk 的时间范围；否则为 None。"""
+    if workers and workers > 1:
+        jobs = [(p, chat_name, shard_dir / f'{idx:06d}.csv', profile, message_filter, collect_times)
+                for idx, p in enumerate(chunk_files)]
+        for job, (_, err, bounds) in iter_parallel_chunk_results(jobs, workers):
+            prof = {} if profile else None
+            time_range = ChunkTimeRange(bounds) if collect_times else None
+            yield job[0], _shard_rows(job[2], err, prof), prof, time_range
+    else:
+        for chunk_path in chunk_files:
+            prof = {} if profile else None
+            time_range = ChunkTimeRange() if collect_times else None
+            rows = iter_chunk_rows(chunk_path, chat_name, profile=prof, message_filter=message_filter, time_range=time_range)
+            yield chunk_path, rows, prof, time_range
+
+
+def iter_export_rows(chunk_files, chat_name: str, workers: int = 1, tmp_dir: Path = None,
+                     state: ChunkState = None, stats: RunStats = None, message_filter: MessageFilter = None,
+                     time_cache: ChunkTimeCache = None) -> Iterable[Dict[str, Any]]:
+    """按 chunk 顺序产出所有链接行，同时打印进度和每个 chunk 的错误（出错的 chunk 不会中断整个流程）。
+    workers > 1 时用进程池并行扫描：每个工作进程写自己的分片，这里再按顺序读回，
+    因此产出的行（以及据此写出的 CSV）与串行运行完全一致。
+    传入 state 时，未变化的 chunk 直接复用上次记录的行，只扫描新增或修改过的 chunk。
+    传入 stats 时记录每个 chunk 的计时与吞吐（见 RunStats）。
+    传入 message_filter 时只产出满足条件的消息中的链接（state 记录的也是过滤后的结果）。
+    传入 time_cache（ChunkTimeCache）时把扫描中顺带收集的各 chunk 时间范围记录到其中，供之后按时间跳过 chunk。"""
+    file_stats = {}
+    for p in chunk_files:
+        try:
+            file_stats[p] = p.stat()
+        except OSError:
+            pass
+    reused = {}
+    if state is not None:
+        for p, st in file_stats.items():
+            offset = state.lookup(p, st)
+            if offset is not None:
+                reused[p] = offset
+    to_scan = [p for p in chunk_files if p in file_stats and p not in reused]
+
+    shard_dir = None
+    if workers and workers > 1 and to_scan:
+        shard_dir = Path(tempfile.mkdtemp(prefix='bili-shards-', dir=str(tmp_dir) if tmp_dir else None))
+    try:
+        scanned = _iter_scanned_chunks(to_scan, chat_name, workers, shard_dir, profile=stats is not None,
+                                       message_filter=message_filter, collect_times=time_cache is not None)
+        for chunk_path in chunk_files:
+            if chunk_path not in file_stats:
+                print(f"跳过不存在的文件: {chunk_path}")
+                continue
+            if chunk_path in reused:
+                print(f"复用未变化的 {chunk_path}")
+                if stats is None:
+                    yield from state.load_rows(reused[chunk_path])
+                else:
+                    t0 = time.perf_counter()
+                    rows = list(state.load_rows(reused[chunk_path]))
+                    stats.add('state_load', time.perf_counter() - t0)
+                    stats.add_chunk(chunk_path, links=len(rows), reused=True)
+                    yield from rows
+                continue
+            _, rows, prof, time_range = next(scanned)
+            print(f"处理 {chunk_path} ...")
+            collected = [] if state is not None else None
+            try:
+                for row in rows:
+                    if collected is not None:
+                        # 在交给下游（可能补全元数据）之前保存提取结果
+                        collected.append(row.stored_values())
+                    yield row
+            except Exception as e:
+                print(f"处理 {chunk_path} 时出错: {e}")
+                if stats is not None:
+                    stats.add_chunk(chunk_path, prof, error=str(e))
+                continue
+            if stats is not None:
+                stats.add_chunk(chunk_path, prof)
+            if state is not None:
+                state.record(chunk_path, collected, file_stats[chunk_path])
+            if time_cache is not None:
+                time_cache.record(chunk_path, file_stats[chunk_path], time_range.bounds())
+    finally:
+        if shard_dir is not None:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def resolve_chunk_file(chunks_dir: Path, file_name: str):
+    """manifest 中列出的 chunk 文件；不存在时依次尝试导出后单独压缩的 .gz / .zst 文件。"""
+    p = chunks_dir / file_name
+    if not p.exists():
+        for suffix in ('.gz', '.zst'):
+            alt = chunks_dir / (file_name + suffix)
+            if alt.exists():
+                return alt
+    return p
+
+
+def list_chunk_files(chunks_dir: Path) -> list:
+    """chunks 目录（或归档中的目录）下的 .jsonl / .jsonl.gz / .jsonl.zst 文件，按名排序。"""
+    if isinstance(chunks_dir, ArchiveMember):
+        prefix = chunks_dir.member.rstrip('/') + '/' if chunks_dir.member else ''
+        names = sorted(n[len(prefix):] for n in _zip_infos(chunks_dir.archive) if n.startswith(prefix))
+        return [chunks_dir / n for n in names if '/' not in n and n.endswith(CHUNK_SUFFIXES)]
+    if not chunks_dir.exists():
+        return []
+    return sorted(p for p in chunks_dir.iterdir() if p.name.endswith(CHUNK_SUFFIXES))
+
+
+def find_export_manifest(export_dir: Path):
+    """导出目录中的 manifest.json；export_dir 为 zip 归档时返回归档中层级最浅的 manifest.json（ArchiveMember）。
+    找不到时返回 None。"""
+    export_dir = Path(export_dir)
+    if is_export_archive(export_dir):
+        names = [n for n in _zip_infos(export_dir) if posixpath.basename(n) == 'manifest.json']
+        if not names:
+            return None
+        member = min(names, key=lambda n: (n.count('/'), n))
+        return ArchiveMember(export_dir, member, member[:-len('manifest.json')])
+    path = export_dir / 'manifest.json'
+    return path if path.exists() else None
+
+
+def export_chunk_path(export_dir: Path, name: str):
+    """按相对导出目录（或归档中 manifest 所在目录）的路径定位 chunk。"""
+    manifest_path = find_export_manifest(export_dir) if is_export_archive(export_dir) else None
+    if manifest_path is not None:
+        return ArchiveMember(manifest_path.archive, manifest_path.root + name, manifest_path.root)
+    return Path(export_dir) / name
+
+
+def read_manifest_bounds(manifest: Dict[str, Any], chunks_dir: Path) -> Dict[Path, tuple]:
+    """manifest 中记录了时间范围的 chunk：{chunk 路径: (最早, 最晚)}。"""
+    out = {}
+    for c in (manifest.get('chunked') or {}).get('chunks', []):
+        bounds = manifest_chunk_bounds(c)
+        if bounds and c.get('fileName'):
+            out[resolve_chunk_file(chunks_dir, c['fileName'])] = bounds
+    return out
+
+
+def read_export_manifest(export_dir: Path):
+    """读取导出目录（或其 zip 归档）的 manifest.json，返回 (manifest, chat_name, chunks_dir, chunk_files)。
+    归档中的 chunks_dir 与 chunk_files 为 ArchiveMember。"""
+    manifest_path = find_export_manifest(export_dir)
+    if manifest_path is None:
+        raise FileNotFoundError(f"{export_dir} 中找不到 manifest.json")
+    with manifest_path.open('rb') as f:
+        manifest = json.load(f)
+
+    archived = isinstance(manifest_path, ArchiveMember)
+    chat_name = manifest.get('chatInfo', {}).get('name') or (export_dir.stem if archived else export_dir.name)
+    chunked = manifest.get('chunked') or {}
+    if archived:
+        base = ArchiveMember(manifest_path.archive, manifest_path.root.rstrip('/'), manifest_path.root)
+    else:
+        base = export_dir
+    chunks_dir = base / chunked.get('chunksDir', 'chunks')
+
+    # 获取 chunk 列表（优先使用 manifest 中列出的顺序）
+    chunk_files = []
+    for c in chunked.get('chunks', []):
+        chunk_files.append(resolve_chunk_file(chunks_dir, c.get('fileName')))
+
+    # 若 manifest 没有列出则回退为查找目录中的 chunk 文件（按名排序）
+    if not chunk_files:
+        chunk_files = list_chunk_files(chunks_dir)
+    return manifest, chat_name, chunks_dir, chunk_files
+
+
+def iter_bilibili_links(export_dir: Path, workers: int = 1, message_filter: MessageFilter = None,
+                        state_path: Path = None, chunk_times: Path = None, stats: RunStats = None,
+                        tmp_dir: Path = None) -> Iterable[LinkRecord]:
+    """库接口：按 manifest 顺序产出导出目录（或其 zip 归档）中的所有 bilibili 链接（LinkRecord）。
+    不写任何输出文件；context 与 raw_message 只在访问时计算，只需要链接等字段的调用方不必为 json.dumps 付出代价。
+    workers > 1 时用进程池并行扫描（分片写在 tmp_dir 中，记录的 context / raw_message 已经算好）；
+    message_filter、state_path（增量状态文件）、chunk_times（chunk 时间范围缓存）与 stats 的含义同 process_export_dir。
+    元数据列留空，需要时用 MetadataFetcher.enrich 补全。找不到 manifest.json 时抛出 FileNotFoundError。"""
+    export_dir = Path(export_dir)
+    manifest, chat_name, chunks_dir, chunk_files = read_export_manifest(export_dir)
+    if workers is not None and workers <= 0:
+        workers = os.cpu_count() or 1
+
+    time_cache = None
+    if message_filter:
+        # 先按时间范围整块跳过 chunk（manifest 记录的范围或之前的运行缓存在 chunk_times 中的范围）
+        if chunk_times and (message_filter.since or message_filter.until):
+            time_cache = ChunkTimeCache(chunk_times)
+        chunk_files, pruned = prune_chunks(chunk_files, message_filter, read_manifest_bounds(manifest, chunks_dir), time_cache)
+        if pruned:
+            print(f"按时间范围跳过 {pruned} 个 chunk，剩余 {len(chunk_files)} 个")
+    else:
+        message_filter = None
+
+    if stats is not None:
+        stats.total_chunks += len(chunk_files)
+
+    # 增量模式：state_path 记录每个 chunk 的签名与提取结果，未变化的 chunk 直接复用
+    state = None
+    if state_path:
+        state = ChunkState(state_path, chat_name, filters=message_filter.describe() if message_filter else None)
+    finished = False
+    try:
+        yield from iter_export_rows(chunk_files, chat_name, workers=workers, tmp_dir=tmp_dir, state=state, stats=stats,
+                                    message_filter=message_filter, time_cache=time_cache)
+        finished = True
+    finally:
+        if time_cache is not None:
+            time_cache.save()
+        if state is not None:
+            if finished:
+                state.compact(chunk_files)
+                print(state.summary())
+            else:
+                # 中断或调用方提前停止：保留已追加的记录，下次从最后完成的 chunk 继续
+                state.close()
+
+
+# 去重：精确集合最多保存的键数，超过后换成 Bloom 过滤器
+DEDUP_EXACT_LIMIT = 1 << 20
+# Bloom 过滤器按此容量（预计不重复的链接数）与误判率分配位数组：5000 万、0.1% 约 86 MB
+DEDUP_CAPACITY = 5 * 10 ** 7
+DEDUP_ERROR_RATE = 0.001
+
+
+def dedup_key(record: LinkRecord) -> bytes:
+    """去重键：有消息 ID 时为 (消息 ID, 规范链接)，否则为 (发送者, 时间, 规范链接)。
+    同一条消息中的不同链接各自保留；规范链接为空时使用原始链接。"""
+    link = record.canonical_url or record.link
+    if record.message_id:
+        key = f"id\x00{record.message_id}\x00{link}"
+    else:
+        key = f"msg\x00{record.sender}\x00{record.time}\x00{link}"
+    return key.encode('utf-8', 'surrogatepass')
+
+
+class LinkDeduper:
+    """跨导出、跨群转发的链接去重（键见 dedup_key）。
+    前 exact_limit 个键以 128 位哈希保存在集合中；超过后全部转入按 capacity 与 error_rate 分配的 Bloom 过滤器，
+    之后内存不再增长，代价是约 error_rate 的概率把新链接误判为重复而丢弃（不会漏掉真正的重复）。"""
+
+    def __init__(self, exact_limit: int = DEDUP_EXACT_LIMIT, capacity: int = DEDUP_CAPACITY,
+                 error_rate: float = DEDUP_ERROR_RATE):
+        self.exact_limit = exact_limit
+        self.capacity = max(capacity, exact_limit + 1)
+        self.error_rate = error_rate
+        self.kept = 0
+        self.dropped = 0
+        self._exact = set()
+        self._bits = None
+        self._nbits = 0
+        self._hashes = 0
+
+    @property
+    def using_bloom(self) -> bool:
+        return self._bits is not None
+
+    def _switch_to_bloom(self):
+        n, p = self.capacity, self.error_rate
+        self._nbits = max(8, int(math.ceil(-n * math.log(p) / (math.log(2) ** 2))))
+        self._hashes = max(1, round(self._nbits / n * math.log(2)))
+        self._bits = bytearray((self._nbits + 7) >> 3)
+        for h in self._exact:
+            self._bloom_add(h)
+        self._exact = None
+
+    def _bloom_add(self, h: int) -> bool:
+        """把哈希值加入 Bloom 过滤器（双重哈希取 k 个位置），返回加入前是否已全部置位。"""
+        bits, nbits = self._bits, self._nbits
+        h1, h2 = h & 0xFFFFFFFFFFFFFFFF, (h >> 64) | 1
+        present = True
+        for i in range(self._hashes):
+            pos = (h1 + i * h2) % nbits
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                present = False
+        return present
+
+    def add(self, record: LinkRecord) -> bool:
+        """记录一条链接；之前出现过时返回 False 并计入 dropped。"""
+        h = int.from_bytes(hashlib.blake2b(dedup_key(record), digest_size=16).digest(), 'little')
+        if self._bits is None:
+            if h in self._exact:
+                self.dropped += 1
+                return False
+            self._exact.add(h)
+            if len(self._exact) > self.exact_limit:
+                self._switch_to_bloom()
+        elif self._bloom_add(h):
+            self.dropped += 1
+            return False
+        self.kept += 1
+        return True
+
+    def filter(self, rows: Iterable[LinkRecord]) -> Iterable[LinkRecord]:
+        """只产出第一次出现的链接。"""
+        add = self.add
+        for row in rows:
+            if add(row):
+                yield row
+
+    def summary(self) -> str:
+        text = f"去重：丢弃 {self.dropped} 条重复链接，保留 {self.kept} 条"
+        if self._bits is not None:
+            text += (f"（超过精确去重上限 {self.exact_limit}，已改用 {len(self._bits) / (1 << 20):.0f} MB 的 Bloom 过滤器，"
+                     f"误判率约 {self.error_rate:g}）")
+            if self.kept > self.capacity:
+                text += f"；不重复的链接数已超过容量 {self.capacity}，误判率会升高，可调大 --dedup-capacity"
+        return text
+
+
+# --report：输出前多少名，Space-Saving 跟踪的候选数为其 REPORT_SKETCH_FACTOR 倍；Count-Min 的宽度与行数
+REPORT_TOP = 20
+REPORT_SKETCH_FACTOR = 10
+REPORT_CM_WIDTH = 2048
+REPORT_CM_DEPTH = 4
+_DAY_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+@functools.lru_cache(maxsize=LINK_MEMO_SIZE)
+def _sketch_hashes(item: str) -> tuple:
+    """Count-Min 用的两个哈希值。用稳定的哈希（内置 hash() 每个进程不同），不同进程中统计的 sketch 才能合并；
+    热门的视频与发送者反复出现，缓存后大多不必重新计算。"""
+    h = int.from_bytes(hashlib.blake2b(item.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+    return h & 0xFFFFFFFF, (h >> 32) | 1
+
+
+class CountMinSketch:
+    """Count-Min 频数估计：估计值只会偏大（不超过 总数 * e / width 的概率约为 1 - e^-depth）。
+    相同尺寸的两个 sketch 可以逐格相加合并，结果与在一个 sketch 中统计全部数据完全相同。"""
+
+    def __init__(self, width: int = REPORT_CM_WIDTH, depth: int = REPORT_CM_DEPTH, table: list = None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else [[0] * width for _ in range(depth)]
+
+    def _indexes(self, item: str):
+        # 双重哈希得到每行的位置
+        h1, h2 = _sketch_hashes(item)
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, item: str, count: int = 1):
+        h, step = _sketch_hashes(item)
+        width = self.width
+        for row in self.table:
+            row[h % width] += count
+            h += step
+
+    def estimate(self, item: str) -> int:
+        return min(row[idx] for row, idx in zip(self.table, self._indexes(item)))
+
+    def merge(self, other: 'CountMinSketch'):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Count-Min sketch 尺寸不同，无法合并')
+        for row, other_row in zip(self.table, other.table):
+            for i, v in enumerate(other_row):
+                if v:
+                    row[i] += v
+
+
+class SpaceSaving:
+    """Space-Saving 高频项统计：最多跟踪 capacity 个项，每项记录 [计数, 可能多算的部分, 标签]。
+    计数是上界、计数减去误差是下界；真实出现次数超过 总数 / capacity 的项一定在其中。
+    合并（merge）采用可合并摘要的做法：一方没有跟踪的项按该方的最小计数补上界，再保留计数最大的 capacity 项。"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.total = 0
+        self.counters = {}
+        self._heap = []
+
+    def _min_count(self) -> int:
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(entry[0] for entry in self.counters.values())
+
+    def _rebuild_heap(self):
+        self._heap = [(entry[0], item) for item, entry in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def add(self, item: str, count: int = 1, label: str = None):
+        self.total += count
+        entry = self.counters.get(item)
+        if entry is not None:
+            # 只改计数，堆中的记录变成偏小的旧值，替换时再修正
+            entry[0] += count
+            if label:
+                entry[2] = label
+            return
+        heap = self._heap
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0, label]
+            heapq.heappush(heap, (count, item))
+            return
+        # 替换当前计数最小的项：弹出的记录已过期时按实际计数放回
+        while True:
+            low, victim = heapq.heappop(heap)
+            actual = self.counters[victim][0]
+            if actual == low:
+                break
+            heapq.heappush(heap, (actual, victim))
+        del self.counters[victim]
+        self.counters[item] = [low + count, low, label]
+        heapq.heappush(heap, (low + count, item))
+
+    def merge(self, other: 'SpaceSaving'):
+        m1, m2 = self._min_count(), other._min_count()
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            c1, e1, l1 = self.counters.get(item, (m1, m1, None))
+            c2, e2, l2 = other.counters.get(item, (m2, m2, None))
+            merged[item] = [c1 + c2, e1 + e2, l2 or l1]
+        keep = sorted(merged.items(), key=lambda kv: (-kv[1][0], kv[0]))[:self.capacity]
+        self.counters = dict(keep)
+        self.total += other.total
+        self._rebuild_heap()
+
+    def top(self, n: int) -> list:
+        """按计数从大到小返回前 n 个 (项, 计数, 误差, 标签)。"""
+        items = sorted(self.counters.items(), key=lambda kv: (-kv[1][0], kv[0]))[:n]
+        return [(item, c, e, label) for item, (c, e, label) in items]
+
+
+class LinkReport:
+    """--report 的流式统计：链接总数、链接类型、各聊天、每天的链接数（精确计数），
+    以及被分享最多的视频与分享最多的发送者（Space-Saving 找候选 + Count-Min 收紧计数，内存固定）。
+    两份统计可以用 merge 合并（例如分别统计的几批导出），to_state / from_state 用于保存或在进程间传递。"""
+
+    def __init__(self, top: int = REPORT_TOP, cm_width: int = REPORT_CM_WIDTH, cm_depth: int = REPORT_CM_DEPTH):
+        self.top_n = top
+        self.links = 0
+        self.link_types = {}
+        self.chats = {}
+        self.per_day = {}
+        capacity = max(1, top) * REPORT_SKETCH_FACTOR
+        self.videos = SpaceSaving(capacity)
+        self.senders = SpaceSaving(capacity)
+        self.video_counts = CountMinSketch(cm_width, cm_depth)
+        self.sender_counts = CountMinSketch(cm_width, cm_depth)
+
+    def add(self, row: LinkRecord):
+        self.links += 1
+        link_type = row.link_type or 'unknown'
+        self.link_types[link_type] = self.link_types.get(link_type, 0) + 1
+        self.chats[row.chat_name] = self.chats.get(row.chat_name, 0) + 1
+        t = row.time
+        if isinstance(t, str) and _DAY_RE.match(t):
+            day = t[:10]
+        else:
+            day = time_sort_key(t)[:10] or 'unknown'
+        self.per_day[day] = self.per_day.get(day, 0) + 1
+        if row.video_id:
+            self.videos.add(row.video_id, label=row.bili_title or None)
+            self.video_counts.add(row.video_id)
+        sender = str(row.sender) if row.sender != '' else ''
+        if sender:
+            self.senders.add(sender)
+            self.sender_counts.add(sender)
+
+    def count(self, rows: Iterable[LinkRecord]) -> Iterable[LinkRecord]:
+        """边统计边原样产出 rows。"""
+        for row in rows:
+            self.add(row)
+            yield row
+
+    def merge(self, other: 'LinkReport') -> 'LinkReport':
+        self.links += other.links
+        for mine, theirs in ((self.link_types, other.link_types), (self.chats, other.chats),
+                             (self.per_day, other.per_day)):
+            for k, v in theirs.items():
+                mine[k] = mine.get(k, 0) + v
+        self.videos.merge(other.videos)
+        self.senders.merge(other.senders)
+        self.video_counts.merge(other.video_counts)
+        self.sender_counts.merge(other.sender_counts)
+        return self
+
+    def to_state(self) -> dict:
+        return {
+            'top': self.top_n, 'links': self.links, 'link_types': self.link_types, 'chats': self.chats,
+            'per_day': self.per_day,
+            'videos': [self.videos.total, list(self.videos.counters.items())],
+            'senders': [self.senders.total, list(self.senders.counters.items())],
+            'cm': [self.video_counts.width, self.video_counts.depth, self.video_counts.table, self.sender_counts.table],
+        }
+
+    def spec(self) -> tuple:
+        """在工作进程中创建同样配置的空统计所需的参数。"""
+        return self.top_n, self.video_counts.width, self.video_counts.depth
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'LinkReport':
+        width, depth, video_table, sender_table = state['cm']
+        report = cls(state['top'], width, depth)
+        report.links = state['links']
+        report.link_types = state['link_types']
+        report.chats = state['chats']
+        report.per_day = state['per_day']
+        for sketch, (total, counters) in ((report.videos, state['videos']), (report.senders, state['senders'])):
+            sketch.total = total
+            sketch.counters = {item: list(entry) for item, entry in counters}
+            sketch._rebuild_heap()
+        report.video_counts.table = video_table
+        report.sender_counts.table = sender_table
+        return report
+
+    def _top(self, sketch: SpaceSaving, counts: CountMinSketch, key: str) -> list:
+        out = []
+        for item, count, error, label in sketch.top(len(sketch.counters)):
+            # 两种估计都是上界，取较小者
+            estimate = min(count, counts.estimate(item))
+            entry = {key: item, 'count': estimate, 'min_count': max(0, count - error)}
+            if label:
+                entry['title'] = label
+            out.append(entry)
+        out.sort(key=lambda e: (-e['count'], e[key]))
+        return out[:self.top_n]
+
+    def report(self) -> dict:
+        by_count = lambda d: dict(sorted(d.items(), key=lambda kv: (-kv[1], kv[0])))
+        return {
+            'links': self.links,
+            'link_types': by_count(self.link_types),
+            'chats': by_count(self.chats),
+            'per_day': dict(sorted(self.per_day.items())),
+            'top_videos': self._top(self.videos, self.video_counts, 'video_id'),
+            'top_sharers': self._top(self.senders, self.sender_counts, 'sender'),
+            # 没有发生过替换时，前几名的计数是精确的
+            'exact_top': all(e[1] == 0 for sk in (self.videos, self.senders) for e in sk.counters.values()),
+        }
+
+    @staticmethod
+    def to_markdown(report: dict) -> str:
+        def esc(value):
+            return str(value).replace('|', '\\|').replace('\n', ' ')
+
+        lines = ['# bilibili 链接统计', '', f"共 {report['links']} 条链接。", '']
+        note = '' if report['exact_top'] else '（近似值：count 为上界，min_count 为下界）'
+        lines += ['## 被分享最多的视频' + note, '', '| # | 视频 ID | 标题 | 次数 | 至少 |', '|---|---|---|---|---|']
+        for i, e in enumerate(report['top_videos'], 1):
+            lines.append(f"| {i} | {esc(e['video_id'])} | {esc(e.get('title', ''))} | {e['count']} | {e['min_count']} |")
+        lines += ['', '## 分享最多的发送者' + note, '', '| # | 发送者 | 次数 | 至少 |', '|---|---|---|---|']
+        for i, e in enumerate(report['top_sharers'], 1):
+            lines.append(f"| {i} | {esc(e['sender'])} | {e['count']} | {e['min_count']} |")
+        for title, key, header in (('链接类型', 'link_types', '类型'), ('各聊天', 'chats', '聊天'),
+                                   ('每天的链接数', 'per_day', '日期')):
+            lines += ['', f'## {title}', '', f'| {header} | 链接数 |', '|---|---|']
+            lines += [f"| {esc(k)} | {v} |" for k, v in report[key].items()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: Path) -> dict:
+        """写出统计结果：.md 写 Markdown，其它扩展名写 JSON。返回统计字典。"""
+        path = Path(path)
+        report = self.report()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix.lower() in ('.md', '.markdown'):
+            path.write_text(self.to_markdown(report), encoding='utf-8')
+        else:
+            path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+        return report
+
+
+# Excel 每个工作表的最大行数（含表头）
+EXCEL_MAX_ROWS = 1048576
+
+
+class ExcelRowWriter:
+    """逐行写出 .xlsx（openpyxl write_only 模式，行直接流式写入，内存占用与行数无关）。
+    工作表达到 max_rows（含表头）时自动新建 Sheet2、Sheet3……，每个工作表都带表头。
+    空字符串写成空单元格；Excel 不允许的控制字符会被去掉。需要 openpyxl，未安装时构造即抛出 ImportError。"""
+
+    def __init__(self, path: Path, fieldnames, max_rows: int = EXCEL_MAX_ROWS):
+        from openpyxl import Workbook
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        self.path = Path(path)
+        self.fieldnames = list(fieldnames)
+        self.max_rows = max(2, int(max_rows))
+        self.rows = 0
+        self.sheets = 0
+        self._illegal = ILLEGAL_CHARACTERS_RE
+        self._wb = Workbook(write_only=True)
+        self._ws = None
+        self._sheet_rows = 0
+
+    def _new_sheet(self):
+        self.sheets += 1
+        self._ws = self._wb.create_sheet(f'Sheet{self.sheets}')
+        self._ws.append(self.fieldnames)
+        self._sheet_rows = 1
+
+    def _cell(self, value):
+        if value is None or value == '':
+            return None
+        if isinstance(value, str):
+            return self._illegal.sub('', value)
+        return value
+
+    def writerow(self, row: Dict[str, Any]):
+        if self._ws is None or self._sheet_rows >= self.max_rows:
+            self._new_sheet()
+        self._ws.append([self._cell(row.get(f)) for f in self.fieldnames])
+        self._sheet_rows += 1
+        self.rows += 1
+
+    def close(self):
+        if self._wb is None:
+            return
+        if self._ws is None:
+            self._new_sheet()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._wb.save(self.path)
+        self._wb = None
+
+
+def open_excel_writer(excel_path: Path, fieldnames=CSV_FIELDS):
+    """创建 ExcelRowWriter；未安装 openpyxl 时打印提示并返回 None。"""
+    try:
+        return ExcelRowWriter(excel_path, fieldnames)
+    except ImportError as e:
+        print(f"生成 Excel 失败（未安装 openpyxl）：{e}。可以用 `pip install openpyxl` 后重试。")
+        return None
+
+
+# Parquet 输出：按列存储的分类列（Arrow 字典类型，读回 pandas 时为 category），
+# 以及另外启用 Parquet 字典编码的高重复列；每攒够 PARQUET_ROW_GROUP 行写出一个 row group
+PARQUET_CATEGORY_COLUMNS = ('chat_name', 'chunk', 'link_type')
+PARQUET_DICT_COLUMNS = PARQUET_CATEGORY_COLUMNS + ('sender', 'video_id', 'canonical_url', 'bili_title', 'bili_uploader')
+PARQUET_ROW_GROUP = 65536
+
+
+class ParquetRowWriter:
+    """把输出行按批写成 Parquet：缓冲 row_group_size 行后写出一个 row group，内存只与批大小有关。
+    所有列都以字符串保存（与 CSV 一致，None 写为空字符串）；include_raw=False 时不写 raw_message 列。
+    需要 pyarrow，未安装时构造即抛出 ImportError。"""
+
+    def __init__(self, path: Path, fieldnames=CSV_FIELDS, include_raw: bool = True,
+                 row_group_size: int = PARQUET_ROW_GROUP):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self.path = Path(path)
+        self.fieldnames = [f for f in fieldnames if include_raw or f != 'raw_message']
+        self.row_group_size = max(1, int(row_group_size))
+        self.rows = 0
+        self.row_groups = 0
+        dict_type = pa.dictionary(pa.int32(), pa.string())
+        self.schema = pa.schema([(f, dict_type if f in PARQUET_CATEGORY_COLUMNS else pa.string()) for f in self.fieldnames])
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._writer = pq.ParquetWriter(str(self.path), self.schema,
+                                        use_dictionary=[f for f in self.fieldnames if f in PARQUET_DICT_COLUMNS])
+        self._columns = [[] for _ in self.fieldnames]
+
+    def writerow(self, row: Dict[str, Any]):
+        for values, f in zip(self._columns, self.fieldnames):
+            v = row.get(f)
+            values.append('' if v is None else v if isinstance(v, str) else str(v))
+        self.rows += 1
+        if len(self._columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._columns or not self._columns[0]:
+            return
+        pa = self._pa
+        arrays = [pa.array(values, type=pa.string()) for values in self._columns]
+        arrays = [a.dictionary_encode() if f in PARQUET_CATEGORY_COLUMNS else a for a, f in zip(arrays, self.fieldnames)]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.row_groups += 1
+        self._columns = [[] for _ in self.fieldnames]
+
+    def close(self):
+        if self._writer is None:
+            return
+        self.flush()
+        self._writer.close()
+        self._writer = None
+
+
+def open_parquet_writer(parquet_path: Path, include_raw: bool = True):
+    """创建 ParquetRowWriter；未安装 pyarrow 时打印提示并返回 None。"""
+    try:
+        return ParquetRowWriter(parquet_path, include_raw=include_raw)
+    except ImportError as e:
+        print(f"生成 Parquet 失败（未安装 pyarrow）：{e}。可以用 `pip install pyarrow` 后重试。")
+        return None
+
+
+def write_excel_from_csv(out_csv: Path, excel_path: Path):
+    """把已有的输出 CSV 流式转成 Excel（只需要 openpyxl，不会把整个 CSV 读入内存）。返回 True on success。"""
+    writer = open_excel_writer(excel_path)
+    if writer is None:
+        return False
+    try:
+        with out_csv.open('r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                writer.writerow(row)
+        writer.close()
+        print(f"已导出 Excel：{excel_path}")
+        return True
+    except Exception as e:
+        print(f"生成 Excel 失败：{e}")
+        return False
+
+
+def open_metadata_fetcher(fetch_meta: bool, resolve_short_links: bool, concurrency: int = 8, meta_cache: Path = None,
+                          meta_cache_ttl: float = 7 * 86400, rate: float = FETCH_RATE, retries: int = FETCH_MAX_RETRIES,
+                          retry_queue: Path = None, stats: RunStats = None):
+    """按命令行选项创建 MetadataFetcher；既不抓取元数据也不解析短链时返回 None。
+    rate 为每秒请求数（0 表示不限），retries 为单个链接被限流或遇到临时错误时的最大重试次数；
+    retry_queue 为重试后仍失败的链接的队列文件（已有的队列中的链接之后抓取成功时会被移出）。"""
+    if not (fetch_meta or resolve_short_links):
+        return None
+    cache = MetadataCache(meta_cache, ttl=meta_cache_ttl) if meta_cache else None
+    return MetadataFetcher(concurrency, cache=cache, fetch_meta=fetch_meta, stats=stats,
+                           scheduler=FetchScheduler(concurrency, rate=rate, max_retries=retries),
+                           retry_queue=RetryQueue(retry_queue) if retry_queue else None)
+
+
+def _iter_exports_links(export_dirs, state_path: Path = None, **kwargs) -> Iterable[LinkRecord]:
+    """依次产出多个导出目录的链接；增量状态按导出分别保存（第 2 个起在 state_path 文件名后加序号）。"""
+    for i, export_dir in enumerate(export_dirs):
+        export_state = state_path
+        if state_path and i:
+            state_path = Path(state_path)
+            export_state = state_path.with_name(f"{state_path.stem}.{i}{state_path.suffix}")
+        yield from iter_bilibili_links(export_dir, state_path=export_state, **kwargs)
+
+
+def process_export_dir(export_dir: Path, out_csv: Path, excel_path: Path = None, fetch_meta: bool = False, workers: int = 1,
+                       fetch_concurrency: int = 8, meta_cache: Path = None, meta_cache_ttl: float = 7 * 86400,
+                       resolve_short_links: bool = False, state_path: Path = None, aggregate_excel: Path = None,
+                       aggregate_by: str = 'title', stats: RunStats = None, parquet_path: Path = None,
+                       parquet_raw: bool = True, message_filter: MessageFilter = None, chunk_times: Path = None,
+                       dedup: LinkDeduper = None, fetch_rate: float = FETCH_RATE, fetch_retries: int = FETCH_MAX_RETRIES,
+                       retry_queue: Path = None, report_path: Path = None, report_top: int = REPORT_TOP):
+    """export_dir 也可以是多个导出目录的列表（按顺序处理，写入同一份输出）；
+    传入 dedup（LinkDeduper）时重复的链接在抓取元数据与写出之前就被丢弃。
+    fetch_rate / fetch_retries / retry_queue 见 open_metadata_fetcher。
+    传入 report_path 时在同一遍处理中统计写出的链接（见 LinkReport），结束后写出 JSON 或 Markdown（.md）报告。"""
+    export_dirs = [Path(p) for p in export_dir] if isinstance(export_dir, (list, tuple)) else [Path(export_dir)]
+    for export_dir in export_dirs:
+        if find_export_manifest(export_dir) is None:
+            print(f"找不到 manifest.json (期望在 {export_dir / 'manifest.json'} 或 zip 归档中)，请确认你传入了正确的导出目录。")
+            return 1
+
+        _, _, chunks_dir, chunk_files = read_export_manifest(export_dir)
+        if not chunk_files:
+            print(f"未找到任何 chunk jsonl 文件，检查 {chunks_dir} 是否存在。")
+            return 1
+
+    # 输出 CSV
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+    with out_csv.open('w', encoding='utf-8', newline='') as csvf:
+        writer = csv.writer(csvf)
+        writer.writerow(CSV_FIELDS)
+
+        total_found = 0
+        # Excel 与 CSV 在同一个循环中逐行写出，不再回读 CSV
+        excel = open_excel_writer(excel_path) if excel_path else None
+        parquet = open_parquet_writer(parquet_path, include_raw=parquet_raw) if parquet_path else None
+        fetcher = open_metadata_fetcher(fetch_meta, resolve_short_links, fetch_concurrency, meta_cache, meta_cache_ttl,
+                                        fetch_rate, fetch_retries, retry_queue, stats=stats)
+        report = LinkReport(report_top) if report_path else None
+        source = _iter_exports_links(export_dirs, workers=workers, message_filter=message_filter, state_path=state_path,
+                                     chunk_times=chunk_times, stats=stats, tmp_dir=out_csv.parent)
+        try:
+            # 去重在抓取之前进行，重复的链接不会发出请求
+            rows = dedup.filter(source) if dedup is not None else source
+            # 启用 --fetch-meta 时，抓取在后台并发进行，提取继续向前推进，行仍按原顺序写出
+            rows = fetcher.enrich(rows) if fetcher else rows
+            # 报告只在这里统计：过滤、去重与补全元数据之后、实际写出的行（与 --workers、--incremental 无关）
+            rows = report.count(rows) if report is not None else rows
+            if stats is None:
+                for row in rows:
+                    writer.writerow(row.values())
+                    if excel is not None:
+                        excel.writerow(row)
+                    if parquet is not None:
+                        parquet.writerow(row)
+                    total_found += 1
+            else:
+                perf = time.perf_counter
+                for row in rows:
+                    t0 = perf()
+                    writer.writerow(row.values())
+                    t1 = perf()
+                    stats.add('csv_write', t1 - t0)
+                    if excel is not None:
+                        excel.writerow(row)
+                        t2 = perf()
+                        stats.add('excel_write', t2 - t1)
+                        t1 = t2
+                    if parquet is not None:
+                        parquet.writerow(row)
+                        stats.add('parquet_write', perf() - t1)
+                    total_found += 1
+        except BaseException:
+            if parquet is not None:
+                parquet.close()
+            raise
+        finally:
+            source.close()
+            if fetcher:
+                fetcher.close()
+        if dedup is not None:
+            print(dedup.summary())
+        if fetcher:
+            print(fetcher.summary())
+        print(f"完成：共找到 {total_found} 条包含 bilibili 链接的消息，已写入 {out_csv}")
+        if report is not None:
+            report.write(report_path)
+            print(f"已写入统计报告：{report_path}")
+
+    if parquet is not None:
+        parquet.close()
+        print(f"已导出 Parquet：{parquet_path}（{parquet.rows} 行，{parquet.row_groups} 个 row group）")
+
+    if excel is not None:
+        t0 = time.perf_counter()
+        try:
+            excel.close()
+            sheets = f"（{excel.sheets} 个工作表）" if excel.sheets > 1 else ''
+            print(f"已导出 Excel：{excel_path}{sheets}")
+        except Exception as e:
+            print(f"生成 Excel 失败：{e}")
+        if stats is not None:
+            stats.add('excel_save', time.perf_counter() - t0)
+
+    # 可选：生成聚合 Excel（按 bili_title 合并并合并发送者）
+    # 兼容旧用法：也支持通过函数属性 _aggregate_excel_arg 传入
+    agg_arg = aggregate_excel or getattr(process_export_dir, '_aggregate_excel_arg', None)
+    if agg_arg:
+        t0 = time.perf_counter()
+        # 有 Parquet 输出时从中按列读取，比逐行解析 CSV 快
+        agg_source = parquet_path if parquet is not None else out_csv
+        write_aggregated_excel(agg_source, Path(agg_arg), group_by=aggregate_by)
+        if stats is not None:
+            stats.add('aggregate', time.perf_counter() - t0)
+
+    return 0
+
+
+# --follow：有新数据后的最短轮询间隔与空闲时逐步放宽到的最长间隔（秒）；使用 inotify 时最长间隔内至少全量检查一次
+FOLLOW_INTERVAL = 0.5
+FOLLOW_MAX_INTERVAL = 5.0
+
+
+class _Inotify:
+    """Linux inotify 的最小封装（通过 ctypes 调用 libc，不需要第三方库）；不可用时构造函数抛出 OSError。"""
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x002 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify 只在 Linux 上可用')
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise OSError(f'inotify 不可用：{e}')
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失败')
+        self.fd = fd
+        self._watches = {}
+
+    def watch(self, directory: Path) -> bool:
+        """监视目录（重复调用无副作用）；目录不存在时返回 False。"""
+        directory = Path(directory)
+        if directory in self._watches.values():
+            return True
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), self.MASK)
+        if wd < 0:
+            return False
+        self._watches[wd] = directory
+        return True
+
+    def read(self, timeout: float):
+        """等待最多 timeout 秒，返回 {目录: {有变化的文件名}}；超时返回空 dict，事件队列溢出时返回 None。"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        events = {}
+        if not ready:
+            return events
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = self._EVENT.unpack_from(data, pos)
+                name = os.fsdecode(data[pos + self._EVENT.size:pos + self._EVENT.size + length].rstrip(b'\0'))
+                pos += self._EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory = self._watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    # 目录被删除或移走，之后需要重新添加监视
+                    del self._watches[wd]
+                events.setdefault(directory, set()).add(name)
+        return None if overflow else events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ExportFollower:
+    """--follow 的增量读取：记录每个 chunk 已处理到的字节偏移，每次只解析新追加的完整行。
+    没有行尾的末行若已是完整的 JSON 对象（最后一行不带换行）就直接处理，否则可能还没写完，留到下次读取；chunk 变小（被截断或替换）时从头重新读取。
+    manifest 中新增或 chunks 目录中新建的 chunk 会被自动加入；manifest 还不存在时按目录名作为聊天名、
+    读取 chunks/ 下的文件。压缩的 chunk 记录的是解压后的偏移，大小在两次检查之间不再变化（或 manifest 已列出）时才读取，
+    跳过已处理的部分，只处理新的完整行。"""
+
+    def __init__(self, export_dir: Path, offsets: Dict[str, int] = None, message_filter: MessageFilter = None):
+        self.export_dir = Path(export_dir)
+        self.offsets = dict(offsets or {})
+        self.message_filter = message_filter or None
+        self.chat_name = self.export_dir.name
+        self.chunks_dir = self.export_dir / 'chunks'
+        self._chunks = {}
+        self._manifest_sig = None
+        # manifest 明确列出的 chunk（已写完）；压缩 chunk 上次看到的大小与已读完时的大小
+        self._listed = set()
+        self._sizes = {}
+        self._read_sizes = {}
+
+    def _refresh_manifest(self):
+        try:
+            st = (self.export_dir / 'manifest.json').stat()
+        except OSError:
+            return
+        sig = (st.st_size, st.st_mtime_ns)
+        if sig == self._manifest_sig:
+            return
+        try:
+            manifest, self.chat_name, self.chunks_dir, chunk_files = read_export_manifest(self.export_dir)
+        except (OSError, ValueError):
+            # 正在被改写，下次再读
+            return
+        self._manifest_sig = sig
+        if (manifest.get('chunked') or {}).get('chunks'):
+            self._listed.update(p.name for p in chunk_files)
+        for p in chunk_files:
+            self._chunks.setdefault(p.name, p)
+
+    def scan(self):
+        """重新读取 manifest（有变化时）并列出 chunks 目录，加入新出现的 chunk。"""
+        self._refresh_manifest()
+        for p in list_chunk_files(self.chunks_dir):
+            self._chunks.setdefault(p.name, p)
+
+    def poll(self, names=None) -> Iterable[LinkRecord]:
+        """产出自上次以来新追加的链接记录。names 为 chunks 目录中有变化的文件名（来自 inotify），
+        为 None 时重新扫描并检查所有 chunk。某个 chunk 的偏移在其新行的记录全部产出后才前移。"""
+        if names is None:
+            self.scan()
+        else:
+            for name in sorted(names):
+                if name.endswith(CHUNK_SUFFIXES):
+                    self._chunks.setdefault(name, self.chunks_dir / name)
+        for name, path in list(self._chunks.items()):
+            if names is None or name in names:
+                yield from self._read_new(path)
+
+    def _read_new(self, path: Path) -> Iterable[LinkRecord]:
+        name = path.name
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        if not _is_plain_file(path):
+            yield from self._read_compressed(path, size)
+            return
+        offset = self.offsets.get(name, 0)
+        if size == offset:
+            return
+        if size < offset:
+            print(f"{path} 变小了（被截断或替换），从头重新读取")
+            offset = self.offsets[name] = 0
+        with path.open('rb') as f:
+            f.seek(offset)
+            yield from self._read_lines(f, name, offset)
+
+    def _read_compressed(self, path: Path, size: int) -> Iterable[LinkRecord]:
+        """压缩的 chunk 无法按文件偏移续读：解压后跳过 offsets 中记录的已处理字节数。
+        还在写入的压缩文件解压时可能报错，也可能（zstd）悄悄截断，所以只在大小稳定或 manifest 已列出时读取。"""
+        name = path.name
+        last = self._sizes.get(name)
+        self._sizes[name] = size
+        if last is not None and size < last:
+            print(f"{path} 变小了（被截断或替换），从头重新读取")
+            self.offsets[name] = 0
+            self._read_sizes.pop(name, None)
+        if self._read_sizes.get(name) == size:
+            return
+        if size != last and name not in self._listed:
+            # 刚出现或还在变大，等下次检查时大小不变再读
+            return
+        offset = self.offsets.get(name, 0)
+        try:
+            with open_chunk(path) as f:
+                skip = offset
+                while skip:
+                    block = f.read(min(skip, _READ_BLOCK))
+                    if not block:
+                        break
+                    skip -= len(block)
+                if skip:
+                    # 解压后的内容比已处理的还短：文件被替换成了别的内容，从头重新读取
+                    print(f"{path} 变小了（被截断或替换），从头重新读取")
+                    self.offsets[name] = 0
+                    return
+                yield from self._read_lines(f, name, offset)
+        except Exception:
+            # 还没写完（EOFError、解压错误等）：已处理的完整行的偏移已记录，下次从那里继续
+            return
+        self._read_sizes[name] = size
+
+    def _read_lines(self, f, name: str, offset: int) -> Iterable[LinkRecord]:
+        """从 f 的当前位置（chunk 内容中的 offset 处）读取新的完整行，每处理完一批就前移 offsets[name]。"""
+        pending = b''
+        for block in iter(lambda: f.read(_READ_BLOCK), b''):
+            data = pending + block if pending else block
+            cut = data.rfind(b'\n') + 1
+            pending = data[cut:]
+            if not cut:
+                continue
+            messages = _decode_candidate_lines(iter_candidate_lines(data[:cut]))
+            yield from _iter_message_rows(messages, name, self.chat_name, self.message_filter)
+            offset += cut
+            self.offsets[name] = offset
+        msg = _parse_complete_line(pending) if pending else None
+        if msg is not None:
+            yield from _iter_message_rows([msg], name, self.chat_name, self.message_filter)
+            self.offsets[name] = offset + len(pending)
+
+
+def _parse_complete_line(raw: bytes):
+    """没有行尾的末行：能解析为完整的 JSON 对象时返回消息，还没写完时返回 None。"""
+    try:
+        msg = json.loads(raw.decode('utf-8'))
+    except ValueError:
+        return None
+    return msg if isinstance(msg, dict) else None
+
+
+def _load_follow_offsets(offsets_path: Path, export_dir: Path, out_csv: Path):
+    """读取上次 --follow 保存的偏移；导出目录或输出列不同、或输出文件已不存在时返回 None（重新开始）。"""
+    try:
+        if not out_csv.stat().st_size:
+            return None
+        saved = json.loads(offsets_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+    if saved.get('export_dir') != str(export_dir.resolve()) or saved.get('fields') != CSV_FIELDS:
+        return None
+    return saved.get('chunks') or {}
+
+
+def _save_follow_offsets(offsets_path: Path, export_dir: Path, offsets: Dict[str, int]):
+    tmp = offsets_path.with_name(offsets_path.name + '.tmp')
+    data = {'export_dir': str(export_dir.resolve()), 'fields': CSV_FIELDS, 'chunks': offsets}
+    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    os.replace(str(tmp), str(offsets_path))
+
+
+def follow_export_dir(export_dir: Path, out_csv: Path, fetch_meta: bool = False, fetch_concurrency: int = 8,
+                      meta_cache: Path = None, meta_cache_ttl: float = 7 * 86400, resolve_short_links: bool = False,
+                      message_filter: MessageFilter = None, dedup: LinkDeduper = None, offsets_path: Path = None,
+                      interval: float = FOLLOW_INTERVAL, max_interval: float = FOLLOW_MAX_INTERVAL,
+                      stop: threading.Event = None, fetch_rate: float = FETCH_RATE,
+                      fetch_retries: int = FETCH_MAX_RETRIES, retry_queue: Path = None):
+    """--follow：持续跟踪仍在写入的导出目录，把新出现的链接追加写入 out_csv（每批写完即 flush）。
+    Linux 上用 inotify 等待 chunks 目录与 manifest.json 的变化，其它平台轮询（空闲时间隔从 interval 逐步放宽到 max_interval）。
+    各 chunk 的偏移保存在 offsets_path（默认 <输出>.follow.json），重新启动时从上次的位置继续追加；
+    按 Ctrl+C 或设置 stop（threading.Event）结束。"""
+    export_dir = Path(export_dir)
+    if is_export_archive(export_dir) or not export_dir.is_dir():
+        print(f"--follow 需要一个导出目录（不支持 zip 归档）：{export_dir}")
+        return 1
+    offsets_path = Path(offsets_path) if offsets_path else out_csv.with_name(out_csv.name + '.follow.json')
+    offsets = _load_follow_offsets(offsets_path, export_dir, out_csv)
+    resume = offsets is not None
+    follower = ExportFollower(export_dir, offsets, message_filter)
+    try:
+        watcher = _Inotify()
+    except OSError:
+        watcher = None
+    fetcher = open_metadata_fetcher(fetch_meta, resolve_short_links, fetch_concurrency, meta_cache, meta_cache_ttl,
+                                    fetch_rate, fetch_retries, retry_queue)
+
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+    total = 0
+    saved = dict(follower.offsets)
+    with out_csv.open('a' if resume else 'w', encoding='utf-8', newline='') as csvf:
+        writer = csv.writer(csvf)
+        if not resume:
+            writer.writerow(CSV_FIELDS)
+            csvf.flush()
+        mode = 'inotify' if watcher is not None else f'轮询（{interval:g}s ~ {max_interval:g}s）'
+        print(f"跟踪 {export_dir}（{mode}），新链接追加到 {out_csv}，按 Ctrl+C 结束")
+        names = None
+        wait = interval
+        try:
+            while stop is None or not stop.is_set():
+                rows = follower.poll(names)
+                if dedup is not None:
+                    rows = dedup.filter(rows)
+                if fetcher is not None:
+                    rows = fetcher.enrich(rows)
+                count = 0
+                for row in rows:
+                    writer.writerow(row.values())
+                    count += 1
+                if count:
+                    csvf.flush()
+                    total += count
+                    print(f"[{datetime.datetime.now():%H:%M:%S}] 追加 {count} 条链接（共 {total} 条）")
+                if follower.offsets != saved:
+                    # 整批写出后才保存偏移：中途退出时重启会重复输出最后一批，但不会丢失
+                    _save_follow_offsets(offsets_path, export_dir, follower.offsets)
+                    saved = dict(follower.offsets)
+
+                if watcher is not None:
+                    watcher.watch(export_dir)
+                    watcher.watch(follower.chunks_dir)
+                    events = watcher.read(max_interval)
+                    # 超时、队列溢出或导出目录本身有变化（manifest、新建 chunks 目录）时全量检查
+                    if events and export_dir not in events:
+                        names = events.get(follower.chunks_dir, set())
+                    else:
+                        names = None
+                else:
+                    wait = interval if count else min(wait * 2, max_interval)
+                    if stop is not None:
+                        stop.wait(wait)
+                    else:
+                        time.sleep(wait)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if watcher is not None:
+                watcher.close()
+            if fetcher is not None:
+                fetcher.close()
+    if dedup is not None:
+        print(dedup.summary())
+    if fetcher is not None:
+        print(fetcher.summary())
+    print(f"停止跟踪：本次共追加 {total} 条链接到 {out_csv}")
+    return 0
+
+
+class LinkIndex:
+    """导出目录的持久化链接索引（SQLite）。每条记录保存 find_links_in_message / guess_sender /
+    guess_time / extract_video_id 的结果，并指向 chunk 文件与消息所在行的字节偏移；
+    原始消息不重复保存，需要时按偏移 seek 读回（见 raw_message）。只应在创建它的线程中使用。"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path))
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);'
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            ' id INTEGER PRIMARY KEY, name TEXT UNIQUE, size INTEGER, mtime_ns INTEGER, indexed_at REAL);'
+            'CREATE TABLE IF NOT EXISTS links ('
+            ' chunk_id INTEGER, offset INTEGER, length INTEGER, time TEXT, time_key TEXT, sender TEXT,'
+            ' link TEXT, link_type TEXT, video_id TEXT);'
+            'CREATE INDEX IF NOT EXISTS links_video ON links(video_id, time_key);'
+            'CREATE INDEX IF NOT EXISTS links_sender ON links(sender, time_key);'
+            'CREATE INDEX IF NOT EXISTS links_time ON links(time_key);'
+            'CREATE INDEX IF NOT EXISTS links_type ON links(link_type, time_key);'
+            'CREATE INDEX IF NOT EXISTS links_chunk ON links(chunk_id);'
+        )
+        self._conn.commit()
+
+    def _info(self, key: str, default: str = '') -> str:
+        row = self._conn.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    @property
+    def export_dir(self) -> Path:
+        value = self._info('export_dir')
+        return Path(value) if value else None
+
+    def build(self, export_dir: Path):
+        """为导出目录建立或更新索引：大小与修改时间未变的 chunk 跳过，变化的重新索引，
+        manifest 中已不存在的 chunk 被删除。返回 (重新索引数, 跳过数, 删除数, 本次写入的链接数)。"""
+        export_dir = Path(export_dir).resolve()
+        _, chat_name, _, chunk_files = read_export_manifest(export_dir)
+        conn = self._conn
+        if self._info('export_dir') not in ('', str(export_dir)):
+            # 换了导出目录：旧记录全部作废
+            conn.execute('DELETE FROM links')
+            conn.execute('DELETE FROM chunks')
+        conn.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', ('export_dir', str(export_dir)))
+        conn.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', ('chat_name', chat_name))
+        conn.commit()
+
+        known = {name: (cid, size, mtime) for cid, name, size, mtime in conn.execute('SELECT id, name, size, mtime_ns FROM chunks')}
+        indexed = skipped = links_added = 0
+        names = set()
+        for chunk_path in chunk_files:
+            if isinstance(chunk_path, ArchiveMember):
+                name = chunk_path.relative_name
+            else:
+                name = Path(os.path.relpath(chunk_path, export_dir)).as_posix()
+            names.add(name)
+            try:
+                st = chunk_path.stat()
+            except OSError:
+                print(f"跳过不存在的文件: {chunk_path}")
+                continue
+            old = known.get(name)
+            if old is not None and old[1:] == (st.st_size, st.st_mtime_ns):
+                skipped += 1
+                continue
+            print(f"索引 {chunk_path} ...")
+            try:
+                records = []
+                for offset, length, msg in iter_candidate_messages_at(chunk_path):
+                    links = find_links_in_message(msg)
+                    if not links:
+                        continue
+                    msg_time = guess_time(msg)
+                    sender = guess_sender(msg)
+                    key = time_sort_key(msg_time)
+                    for link, _, ltype in links:
+                        records.append((offset, length, str(msg_time), key, str(sender), link, ltype, extract_video_id(link)))
+            except Exception as e:
+                print(f"索引 {chunk_path} 时出错: {e}")
+                continue
+            if old is not None:
+                conn.execute('DELETE FROM links WHERE chunk_id = ?', (old[0],))
+                conn.execute('DELETE FROM chunks WHERE id = ?', (old[0],))
+            cur = conn.execute('INSERT INTO chunks (name, size, mtime_ns, indexed_at) VALUES (?, ?, ?, ?)',
+                               (name, st.st_size, st.st_mtime_ns, time.time()))
+            conn.executemany('INSERT INTO links (chunk_id, offset, length, time, time_key, sender, link, link_type, video_id)'
+                             ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [(cur.lastrowid,) + r for r in records])
+            conn.commit()
+            indexed += 1
+            links_added += len(records)
+        removed = [(cid,) for name, (cid, _, _) in known.items() if name not in names]
+        if removed:
+            conn.executemany('DELETE FROM links WHERE chunk_id = ?', removed)
+            conn.executemany('DELETE FROM chunks WHERE id = ?', removed)
+            conn.commit()
+        return indexed, skipped, len(removed), links_added
+
+    @staticmethod
+    def _where(video_id=None, sender=None, since=None, until=None, link_type=None):
+        clauses, params = [], []
+        if video_id:
+            clauses.append('l.video_id = ?')
+            params.append(video_id)
+        if sender:
+            clauses.append('l.sender = ?')
+            params.append(sender)
+        if link_type:
+            clauses.append('l.link_type = ?')
+            params.append(link_type)
+        if since:
+            clauses.append('l.time_key >= ?')
+            params.append(time_bound(since))
+        if until:
+            # until 按前缀包含：'2026-03' 包含整个三月
+            clauses.append('l.time_key <= ?')
+            params.append(time_bound(until) + '\uffff')
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def query(self, video_id: str = None, sender: str = None, since: str = None, until: str = None,
+              link_type: str = None, limit: int = None):
+        """按条件查询，返回按时间排序的记录 dict 列表（含 chunk 名与字节偏移）。
+        since/until 可以是完整时间或前缀（如 '2026-03'），until 包含该前缀对应的整段时间。"""
+        where, params = self._where(video_id, sender, since, until, link_type)
+        sql = ('SELECT c.name, l.offset, l.length, l.time, l.sender, l.link, l.link_type, l.video_id'
+               ' FROM links l JOIN chunks c ON c.id = l.chunk_id' + where + ' ORDER BY l.time_key, c.name, l.offset')
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        keys = ('chunk', 'offset', 'length', 'time', 'sender', 'link', 'link_type', 'video_id')
+        return [dict(zip(keys, row)) for row in self._conn.execute(sql, params)]
+
+    def top_videos(self, limit: int = 10, **filters):
+        """被分享次数最多的视频：[(video_id, 分享次数, 不同发送者数), ...]。"""
+        where, params = self._where(**filters)
+        where = (where + ' AND' if where else ' WHERE') + " l.video_id != ''"
+        sql = ('SELECT l.video_id, COUNT(*) AS n, COUNT(DISTINCT l.sender) FROM links l' + where +
+               ' GROUP BY l.video_id ORDER BY n DESC, l.video_id LIMIT ?')
+        return self._conn.execute(sql, params + [int(limit)]).fetchall()
+
+    def raw_message(self, record: Dict[str, Any]):
+        """按记录中的 chunk 与字节偏移读回原始消息（dict）。chunk 在建立索引后被修改时抛出 RuntimeError。"""
+        row = self._conn.execute('SELECT size, mtime_ns FROM chunks WHERE name = ?', (record['chunk'],)).fetchone()
+        chunk_path = export_chunk_path(self.export_dir, record['chunk'])
+        try:
+            st = chunk_path.stat()
+        except OSError:
+            raise RuntimeError(f"找不到 chunk 文件 {chunk_path}")
+        if row is None or (st.st_size, st.st_mtime_ns) != tuple(row):
+            raise RuntimeError(f"{chunk_path} 在建立索引后已变化，请重新运行 index")
+        # 压缩的 chunk 中 seek 需要从头解压到该位置，比普通文件慢，但不需要额外的存储
+        with open_chunk(chunk_path) as f:
+            f.seek(record['offset'])
+            raw = f.read(record['length'])
+        return json.loads(raw.decode('utf-8', errors='ignore'))
+
+    def close(self):
+        self._conn.close()
+
+
+DEFAULT_INDEX_DB = 'bili_links_index.sqlite'
+
+
+def index_main(argv):
+    ap = argparse.ArgumentParser(prog='extract_bilibili_from_qce.py index', description='为导出目录建立/更新链接索引')
+    ap.add_argument('-i', '--input', required=True, help='导出目录（chunked-jsonl 的文件夹）或其 zip 归档的路径；chunk 可为 .jsonl.gz / .jsonl.zst')
+    ap.add_argument('--db', default=DEFAULT_INDEX_DB, help=f'索引文件路径（默认 {DEFAULT_INDEX_DB}）')
+    args = ap.parse_args(argv)
+
+    export_dir = Path(args.input)
+    if find_export_manifest(export_dir) is None:
+        print(f"找不到 manifest.json (期望在 {export_dir / 'manifest.json'} 或 zip 归档中)，请确认你传入了正确的导出目录。")
+        return 1
+    index = LinkIndex(Path(args.db))
+    try:
+        indexed, skipped, removed, links = index.build(export_dir)
+    finally:
+        index.close()
+    print(f"索引完成：重新索引 {indexed} 个 chunk（{links} 条链接），跳过未变化的 {skipped} 个，删除 {removed} 个；索引文件 {args.db}")
+    return 0
+
+
+def query_main(argv):
+    ap = argparse.ArgumentParser(prog='extract_bilibili_from_qce.py query', description='查询 index 建立的链接索引')
+    ap.add_argument('--db', default=DEFAULT_INDEX_DB, help=f'索引文件路径（默认 {DEFAULT_INDEX_DB}）')
+    ap.add_argument('--video-id', help='按视频 ID（BV/AV）过滤')
+    ap.add_argument('--sender', help='按发送者过滤（精确匹配）')
+    ap.add_argument('--since', help='起始时间（含），如 2026-03-01 或 2026-03-01 08:00:00')
+    ap.add_argument('--until', help='结束时间（含），可写前缀，如 2026-03 表示到三月底')
+    ap.add_argument('--link-type', choices=['video', 'short', 'mobile', 'other'], help='按链接类型过滤')
+    ap.add_argument('--top', type=int, help='改为输出被分享最多的 N 个视频')
+    ap.add_argument('--limit', type=int, default=100, help='最多输出条数（默认 100，0 表示不限）')
+    ap.add_argument('--raw', action='store_true', help='同时按偏移读回并输出原始消息')
+    ap.add_argument('--jsonl', action='store_true', help='以 JSON Lines 输出')
+    args = ap.parse_args(argv)
+    _check_time_args(ap, args)
+
+    if not Path(args.db).exists():
+        print(f"找不到索引文件 {args.db}，请先运行 index。")
+        return 1
+    filters = dict(video_id=args.video_id, sender=args.sender, since=args.since, until=args.until, link_type=args.link_type)
+    index = LinkIndex(Path(args.db))
+    try:
+        t0 = time.perf_counter()
+        if args.top:
+            top = index.top_videos(args.top, **filters)
+            elapsed = (time.perf_counter() - t0) * 1000
+            for video_id, count, senders in top:
+                if args.jsonl:
+                    print(json.dumps({'video_id': video_id, 'count': count, 'senders': senders}, ensure_ascii=False))
+                else:
+                    print(f"{video_id}\t分享 {count} 次\t{senders} 人")
+            print(f"共 {len(top)} 个视频（{elapsed:.1f} ms）", file=sys.stderr)
+            return 0
+        records = index.query(limit=args.limit or None, **filters)
+        elapsed = (time.perf_counter() - t0) * 1000
+        for rec in records:
+            if args.raw:
+                try:
+                    rec['raw_message'] = index.raw_message(rec)
+                except RuntimeError as e:
+                    print(e, file=sys.stderr)
+                    return 1
+            if args.jsonl:
+                print(json.dumps(rec, ensure_ascii=False))
+            else:
+                print(f"{rec['time']}\t{rec['sender']}\t{rec['link_type']}\t{rec['video_id']}\t{rec['link']}\t{rec['chunk']}:{rec['offset']}")
+                if args.raw:
+                    print('    ' + json.dumps(rec['raw_message'], ensure_ascii=False))
+        print(f"共 {len(records)} 条（查询 {elapsed:.1f} ms）", file=sys.stderr)
+    finally:
+        index.close()
+    return 0
+
+
+DEFAULT_RETRY_QUEUE = 'bili_retry_queue.jsonl'
+
+
+def retry_main(argv):
+    ap = argparse.ArgumentParser(prog='extract_bilibili_from_qce.py retry',
+                                 description='重新抓取重试队列中的链接，成功的结果写入元数据缓存并移出队列')
+    ap.add_argument('--queue', default=DEFAULT_RETRY_QUEUE, help=f'重试队列文件（默认 {DEFAULT_RETRY_QUEUE}）')
+    ap.add_argument('--meta-cache', default='bili_meta_cache.sqlite', help='元数据缓存（SQLite）路径，默认 bili_meta_cache.sqlite')
+    ap.add_argument('--resolve-only', action='store_true', help='只解析短链，不抓取标题与投稿人')
+    ap.add_argument('--fetch-concurrency', type=int, default=8, help='最大并发请求数（默认 8）')
+    ap.add_argument('--fetch-rate', type=float, default=FETCH_RATE, help=f'每秒最多发出的请求数（默认 {FETCH_RATE:g}，0 表示不限）')
+    ap.add_argument('--fetch-retries', type=int, default=FETCH_MAX_RETRIES, help=f'每个链接的最大重试次数（默认 {FETCH_MAX_RETRIES}）')
+    args = ap.parse_args(argv)
+
+    queue_path = Path(args.queue)
+    links = RetryQueue(queue_path).links()
+    if not links:
+        print(f"重试队列 {queue_path} 为空")
+        return 0
+    fetcher = open_metadata_fetcher(not args.resolve_only, True, args.fetch_concurrency, Path(args.meta_cache),
+                                    rate=args.fetch_rate, retries=args.fetch_retries, retry_queue=queue_path)
+    with fetcher:
+        rows = ({'link': link, 'link_type': classify_bili_link(link), 'video_id': extract_video_id(link)} for link in links)
+        for _ in fetcher.enrich(rows):
+            pass
+    print(fetcher.summary())
+    return 0 if not len(fetcher.retry_queue) else 2
+
+
+# 子命令：index / query / retry；不带子命令时为原来的提取模式
+SUBCOMMANDS = {'index': index_main, 'query': query_main, 'retry': retry_main}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[0]](argv[1:])
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', required=True, action='append',
+                    help='导出目录（chunked-jsonl 的文件夹）或其 zip 归档的路径；chunk 可为 .jsonl.gz / .jsonl.zst。可重复指定多个导出，写入同一份输出')
+    ap.add_argument('-o', '--output', default='bilibili_links.csv', help='输出 CSV 文件路径')
+    ap.add_argument('--excel', help='可选：输出 Excel 文件路径 (.xlsx)')
+    ap.add_argument('--fetch-meta', action='store_true', help='可选：为每个 bilibili 链接抓取标题与投稿人（依赖 requests，可能较慢）')
+    ap.add_argument('--resolve-short-links', action='store_true', help='可选：只解析 b23.tv 短链（跟随重定向、不下载页面）以补全 video_id，无需 --fetch-meta')
+    ap.add_argument('--fetch-concurrency', type=int, default=8, help='可选：--fetch-meta 时的最大并发请求数（同时也是 keep-alive 连接池大小，默认 8）')
+    ap.add_argument('--meta-cache', help='可选：元数据缓存（SQLite）路径，默认为输出 CSV 同目录下的 bili_meta_cache.sqlite')
+    ap.add_argument('--no-meta-cache', action='store_true', help='可选：不使用持久化元数据缓存')
+    ap.add_argument('--fetch-rate', type=float, default=FETCH_RATE, help=f'可选：抓取/短链解析每秒最多发出的请求数（令牌桶，默认 {FETCH_RATE:g}，0 表示不限）')
+    ap.add_argument('--fetch-retries', type=int, default=FETCH_MAX_RETRIES, help=f'可选：被限流（412/429）或遇到临时错误时每个链接的最大重试次数（指数退避，默认 {FETCH_MAX_RETRIES}）')
+    ap.add_argument('--retry-queue', help=f'可选：重试后仍失败的链接的队列文件，默认为输出 CSV 同目录下的 {DEFAULT_RETRY_QUEUE}（可用 retry 子命令重新抓取）')
+    ap.add_argument('--meta-cache-ttl', type=float, default=7, help='可选：元数据缓存有效期（天，默认 7；失败结果只缓存 1 小时）')
+    ap.add_argument('--incremental', action='store_true', help='可选：增量运行，复用上次运行中未变化 chunk 的结果（状态文件默认为 <输出>.state.jsonl）；中断后重跑可从最后完成的 chunk 继续')
+    ap.add_argument('--state', help='可选：--incremental 使用的状态文件路径')
+    ap.add_argument('--aggregate-excel', help='可选：生成按标题聚合的 Excel 文件（按 bili_title 合并并合并发送者）')
+    ap.add_argument('--aggregate-by', choices=sorted(AGG_GROUP_KEYS), default='title', help='可选：聚合 Excel 的分组依据：title（默认，按 bili_title）、video_id 或 url（按规范化后的链接 canonical_url）')
+    ap.add_argument('--workers', type=int, default=1, help='可选：并行处理 chunk 的进程数（默认 1 为串行；0 表示使用全部 CPU 核心），输出与串行一致')
+    ap.add_argument('--since', help='可选：只保留该时间之后（含）的消息，如 2026-03-01 或 2026-03-01 08:00:00')
+    ap.add_argument('--until', help='可选：只保留该时间之前（含）的消息，可写前缀，如 2026-03 表示到三月底')
+    ap.add_argument('--sender', action='append', help='可选：只保留该发送者（昵称或 QQ 号）的消息，可重复指定')
+    ap.add_argument('--chunk-times', help='可选：chunk 时间范围缓存路径（manifest 未记录时间范围时用于跳过 chunk），默认为输出 CSV 同目录下的 bili_chunk_times.json')
+    ap.add_argument('--parquet', help='可选：同时输出 Parquet 文件（与 CSV 相同的列，分批写 row group，需要 pyarrow）')
+    ap.add_argument('--parquet-no-raw', action='store_true', help='可选：Parquet 输出中不包含 raw_message 列')
+    ap.add_argument('--dedup', action='store_true', help='可选：去掉重复的链接（按消息 ID，或发送者+时间+规范链接），用于重叠的多次导出或群间转发')
+    ap.add_argument('--dedup-exact-limit', type=int, default=DEDUP_EXACT_LIMIT, help=f'可选：--dedup 精确去重的最大键数，超过后改用 Bloom 过滤器（默认 {DEDUP_EXACT_LIMIT}）')
+    ap.add_argument('--dedup-capacity', type=int, default=DEDUP_CAPACITY, help=f'可选：--dedup 的 Bloom 过滤器按此数量的不重复链接分配内存（误判率 {DEDUP_ERROR_RATE:g}，默认 {DEDUP_CAPACITY}）')
+    ap.add_argument('--follow', action='store_true', help='可选：持续跟踪仍在写入的导出目录，把新出现的链接追加到输出 CSV（Ctrl+C 结束；偏移保存在 <输出>.follow.json，重启后继续）')
+    ap.add_argument('--follow-interval', type=float, default=FOLLOW_INTERVAL, help=f'可选：--follow 无法使用 inotify 时的最短轮询间隔（秒，默认 {FOLLOW_INTERVAL:g}，空闲时逐步放宽到 {FOLLOW_MAX_INTERVAL:g}）')
+    ap.add_argument('--report', help='可选：在提取的同一遍中统计链接（类型、各聊天、每天的数量、被分享最多的视频与发送者），结束后写出报告；.md 为 Markdown，其它为 JSON')
+    ap.add_argument('--report-top', type=int, default=REPORT_TOP, help=f'可选：--report 中视频与发送者排行的条数（默认 {REPORT_TOP}）')
+    ap.add_argument('--stats', action='store_true', help='可选：统计各阶段耗时/调用次数、每个 chunk 的吞吐、抓取延迟分位数与峰值内存，结束时打印摘要')
+    ap.add_argument('--stats-json', help='可选：把统计结果写成 JSON 文件（隐含 --stats）')
+    ap.add_argument('--progress', action='store_true', help='可选：在 stderr 上实时打印每个 chunk 的进度（隐含 --stats）')
+    args = ap.parse_args(argv)
+    _check_time_args(ap, args)
+
+    input_dirs = [Path(p) for p in args.input]
+    out_csv = Path(args.output)
+    excel_path = Path(args.excel) if args.excel else None
+    state_path = None
+    if args.incremental or args.state:
+        state_path = Path(args.state) if args.state else out_csv.with_name(out_csv.name + '.state.jsonl')
+    meta_cache = None
+    if not args.no_meta_cache:
+        meta_cache = Path(args.meta_cache) if args.meta_cache else out_csv.parent / 'bili_meta_cache.sqlite'
+    retry_queue = Path(args.retry_queue) if args.retry_queue else out_csv.parent / DEFAULT_RETRY_QUEUE
+    fetch_options = dict(fetch_rate=args.fetch_rate, fetch_retries=args.fetch_retries, retry_queue=retry_queue)
+
+    message_filter = MessageFilter(args.since, args.until, args.sender)
+    chunk_times = Path(args.chunk_times) if args.chunk_times else out_csv.parent / 'bili_chunk_times.json'
+
+    stats = None
+    if args.stats or args.stats_json or args.progress:
+        stats = RunStats(progress=sys.stderr if args.progress else None)
+
+    dedup = LinkDeduper(args.dedup_exact_limit, args.dedup_capacity) if args.dedup else None
 
-    # 将聚合参数暂存到函数属性，方便 process_export_dir 取用（保持 API 向后兼容）
-    if args.aggregate_excel:
-        setattr(process_export_dir, '_aggregate_excel_arg', args.aggregate_excel)
+    if args.follow:
+        unsupported = [opt for opt, value in (('--excel', args.excel), ('--parquet', args.parquet),
+                                              ('--aggregate-excel', args.aggregate_excel), ('--incremental', state_path),
+                                              ('--stats', stats), ('--report', args.report)) if value]
+        if len(input_dirs) > 1 or unsupported:
+            ap.error(f"--follow 只支持单个 -i 和 CSV 输出，不能与 {' '.join(unsupported) or '多个 -i'} 同时使用")
+        return follow_export_dir(input_dirs[0], out_csv, fetch_meta=args.fetch_meta, fetch_concurrency=args.fetch_concurrency,
+                                 meta_cache=meta_cache, meta_cache_ttl=args.meta_cache_ttl * 86400,
+                                 resolve_short_links=args.resolve_short_links, message_filter=message_filter,
+                                 dedup=dedup, interval=args.follow_interval, **fetch_options)
 
-    return process_export_dir(input_dir, out_csv, excel_path, fetch_meta=args.fetch_meta)
+    export_dir = input_dirs if len(input_dirs) > 1 else input_dirs[0]
+    rc = process_export_dir(export_dir, out_csv, excel_path, fetch_meta=args.fetch_meta, workers=args.workers,
+                            fetch_concurrency=args.fetch_concurrency, meta_cache=meta_cache,
+                            meta_cache_ttl=args.meta_cache_ttl * 86400, resolve_short_links=args.resolve_short_links,
+                            state_path=state_path, aggregate_excel=args.aggregate_excel, aggregate_by=args.aggregate_by,
+                            stats=stats, parquet_path=Path(args.parquet) if args.parquet else None,
+                            parquet_raw=not args.parquet_no_raw, message_filter=message_filter, chunk_times=chunk_times,
+                            dedup=dedup, report_path=Path(args.report) if args.report else None,
+                            report_top=args.report_top, **fetch_options)
+    if stats is not None and rc == 0:
+        report = stats.report()
+        print(stats.summary(report))
+        if args.stats_json:
+            Path(args.stats_json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+            print(f"统计已写入 {args.stats_json}")
+    return rc
 
 
 if __name__ == '__main__':
@@ -5,3 +5,133 @@ import os
 ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if ROOT not in sys.path:
     sys.path.insert(0, ROOT)
+
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+
+class StubServer:
+    """本地 HTTP 桩服务：routes 把路径映射为 (status, headers, body, delay) 或 callable(path) -> 同样的元组。
+    peak_in_flight 为同时在处理中的请求数的最大值，用于直接检查客户端的并发度。"""
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, send_body):
+                with stub._lock:
+                    stub.requests.append((self.command, self.path))
+                    stub.in_flight += 1
+                    stub.peak_in_flight = max(stub.peak_in_flight, stub.in_flight)
+                try:
+                    self._send_route(send_body)
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+            def _send_route(self, send_body):
+                route = stub.routes.get(self.path.split('?')[0])
+                if callable(route):
+                    route = route(self.path)
+                if route is None:
+                    route = (404, {}, b'not found', 0)
+                status, headers, body, delay = route
+                if delay:
+                    time.sleep(delay)
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if send_body:
+                    try:
+                        self.wfile.write(body)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+
+            def do_GET(self):
+                self._respond(True)
+
+            def do_HEAD(self):
+                self._respond(False)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self._thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def video_html(title, author):
+        """只带标题与投稿人的最小视频页。"""
+        return (f'<html><head><meta property="og:title" content="{title}">'
+                f'<meta name="author" content="{author}"></head><body></body></html>')
+
+    def route(self, path, body='', status=200, headers=None, delay=0):
+        if headers is None:
+            headers = {'Content-Type': 'text/html; charset=utf-8'}
+        self.routes[path] = (status, headers, body, delay)
+
+    def redirect(self, path, location, status=302):
+        self.routes[path] = (status, {'Location': location}, b'', 0)
+
+    def url(self, path):
+        return self.base + path
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+def _write_export(export_dir, chunks, chat="chat", compress=None, newline="\n"):
+    """在 export_dir 写出一个分块导出：manifest.json 按顺序列出 chunks（{fileName: [msg, ...]}），每条消息一行 JSON。
+    compress='gz' 时 chunk 写成 <fileName>.gz，manifest 仍列出原文件名。返回 export_dir。"""
+    export_dir = Path(export_dir)
+    (export_dir / "chunks").mkdir(parents=True)
+    manifest = {"chatInfo": {"name": chat},
+                "chunked": {"chunksDir": "chunks", "chunks": [{"fileName": name} for name in chunks]}}
+    (export_dir / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False), encoding='utf-8')
+    for name, msgs in chunks.items():
+        data = "".join(json.dumps(m, ensure_ascii=False) + newline for m in msgs).encode('utf-8')
+        if compress == 'gz':
+            (export_dir / "chunks" / (name + ".gz")).write_bytes(gzip.compress(data))
+        else:
+            (export_dir / "chunks" / name).write_bytes(data)
+    return export_dir
+
+
+@pytest.fixture
+def write_export():
+    """返回写出测试用导出目录的函数，参数见 _write_export。"""
+    return _write_export
@@ -1,7 +1,11 @@
-import pandas as pd
-import tempfile
 from pathlib import Path
-from extract_bilibili_from_qce import write_aggregated_excel
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("openpyxl")
+
+from extract_bilibili_from_qce import write_aggregated_excel  # noqa: E402
 
 
 def test_write_aggregated_excel(tmp_path: Path):
@@ -28,3 +32,20 @@ def test_write_aggregated_excel(tmp_path: Path):
     # empty-title row preserved (consider NaN readback from Excel)
     empty_count = int(df['bili_title'].isna().sum()) + int((df['bili_title'] == '').sum())
     assert empty_count == 1
+
+
+def test_write_aggregated_excel_by_video_id(tmp_path: Path):
+    csv_path = tmp_path / 'sample.csv'
+    agg_path = tmp_path / 'agg.xlsx'
+    data = [
+        {'time': '', 'sender': 'Alice', 'link': 'l1', 'link_type': '', 'video_id': 'BV1', 'bili_title': 'T',
+         'bili_uploader': '', 'context': '', 'raw_message': 'x' * 2000},
+        {'time': '', 'sender': 'Bob', 'link': 'l2', 'link_type': '', 'video_id': 'BV1', 'bili_title': 'T',
+         'bili_uploader': '', 'context': '', 'raw_message': 'y'},
+    ]
+    pd.DataFrame(data).to_csv(csv_path, index=False)
+    assert write_aggregated_excel(csv_path, agg_path, group_by='video_id')
+    df = pd.read_excel(agg_path)
+    assert len(df) == 1
+    assert df.iloc[0]['sender'] == 'Alice; Bob'
+    assert 'raw_message' not in df.columns
@@ -0,0 +1,69 @@
+def _row(**kw):
+    base = {'time': '', 'sender': '', 'link': '', 'link_type': '', 'video_id': '', 'bili_title': '', 'bili_uploader': '', 'context': ''}
+    base.update(kw)
+    return base
+
+
+def test_aggregate_rows_order_and_untitled_passthrough():
+    from extract_bilibili_from_qce import aggregate_rows
+    rows = [
+        _row(time='3', sender='A', bili_title='T1', context='c1'),
+        _row(time='5', sender='B', bili_title=''),
+        _row(time='1', sender='C', bili_title='T2'),
+        _row(time='2', sender='A', bili_title=' T1 ', context='c1'),
+        _row(time='4', sender='D', bili_title=''),
+        _row(time='0', sender='E', bili_title='T1', context='c2'),
+    ]
+    out = aggregate_rows(rows)
+    assert [r['bili_title'] for r in out] == ['T1', '', '', 'T2']
+    assert [r['sender'] for r in out] == ['A; E', 'B', 'D', 'C']
+    assert out[0]['time'] == '0'
+    assert out[0]['context'] == 'c1 || c2'
+
+
+def test_aggregate_rows_by_video_id():
+    from extract_bilibili_from_qce import aggregate_rows
+    rows = [
+        _row(sender='A', video_id='BV1', bili_title='X', link='l1'),
+        _row(sender='B', video_id='BV1', bili_title='X (renamed)', link='l2'),
+        _row(sender='C', video_id='', link='l3'),
+    ]
+    out = aggregate_rows(rows, group_by='video_id')
+    assert len(out) == 2
+    assert out[0]['video_id'] == 'BV1'
+    assert out[0]['bili_title'] == 'X; X (renamed)'
+    assert out[0]['link'] == 'l1; l2'
+    assert out[1]['sender'] == 'C'
+
+
+def test_aggregate_rows_many_titles_single_pass():
+    from extract_bilibili_from_qce import aggregate_rows
+    consumed = []
+
+    def rows():
+        # 只能迭代一次的生成器：聚合必须单遍完成
+        for i in range(100000):
+            consumed.append(i)
+            yield _row(time=str(i), sender=f's{i % 97}', bili_title=f't{i % 30000}')
+
+    out = aggregate_rows(rows())
+    assert len(consumed) == 100000
+    assert len(out) == 30000
+    assert [r['bili_title'] for r in out[:3]] == ['t0', 't1', 't2']
+    # t0 出现在第 0、30000、60000、90000 行
+    assert out[0]['sender'] == 's0; s27; s54; s81'
+    assert out[0]['time'] == '0'
+
+
+def test_aggregate_rows_by_url_uses_canonical_url():
+    from extract_bilibili_from_qce import aggregate_rows
+    rows = [
+        dict(_row(sender='A', link='https://m.bilibili.com/video/BV1?share_source=qq'), canonical_url='https://www.bilibili.com/video/BV1'),
+        dict(_row(sender='B', link='https://www.bilibili.com/video/BV1/?spm_id_from=333'), canonical_url='https://www.bilibili.com/video/BV1'),
+        # 旧版本输出没有 canonical_url，回退为 link
+        _row(sender='C', link='https://space.bilibili.com/1'),
+        _row(sender='D', link='https://space.bilibili.com/1'),
+    ]
+    out = aggregate_rows(rows, group_by='url')
+    assert [(r['link'], r['sender']) for r in out] == [('https://www.bilibili.com/video/BV1', 'A; B'),
+                                                        ('https://space.bilibili.com/1', 'C; D')]
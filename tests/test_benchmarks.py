@@ -0,0 +1,43 @@
+import json
+
+import extract_bilibili_from_qce as qce
+from benchmarks.bench_extract import compare_results, run_benchmarks
+from benchmarks.gen_qce_export import generate_export
+
+
+def test_generator_writes_manifest_and_detectable_links(tmp_path):
+    info = generate_export(tmp_path / 'exp', messages=600, chunk_messages=250, link_density=0.1,
+                           nesting_depth=2, card_size=300, seed=1)
+    assert info['chunks'] == 3 and info['messages'] == 600
+    manifest, chat_name, _, chunk_files = qce.read_export_manifest(tmp_path / 'exp')
+    assert [p.name for p in chunk_files] == ['chunk_0001.jsonl', 'chunk_0002.jsonl', 'chunk_0003.jsonl']
+    assert sum(c['messageCount'] for c in manifest['chunked']['chunks']) == 600
+
+    rows = list(qce.iter_export_rows(chunk_files, chat_name))
+    # 每条含链接的消息都能被提取到（同一消息可能有多行：文本与 html 中各出现一次）
+    assert len({r['raw_message'] for r in rows}) == info['link_messages'] > 0
+    times = [json.loads(line)['timestamp'] for p in chunk_files for line in p.open(encoding='utf-8')]
+    assert times == sorted(times)
+
+
+def test_generator_is_deterministic(tmp_path):
+    a = generate_export(tmp_path / 'a', messages=200, seed=7)
+    b = generate_export(tmp_path / 'b', messages=200, seed=7)
+    assert a == b
+    assert (tmp_path / 'a/chunks/chunk_0001.jsonl').read_bytes() == (tmp_path / 'b/chunks/chunk_0001.jsonl').read_bytes()
+
+
+def test_run_benchmarks_reports_stages(tmp_path):
+    generate_export(tmp_path / 'exp', messages=300, link_density=0.2, seed=3)
+    res = run_benchmarks(tmp_path / 'exp', stages=['extract', 'csv', 'end_to_end'], work_dir=tmp_path)
+    json.dumps(res)
+    assert res['export']['messages'] == 300
+    assert set(res['stages']) == {'extract', 'csv', 'end_to_end'}
+    assert res['stages']['extract']['rows'] > 0
+    assert res['stages']['end_to_end']['exit_code'] == 0
+    assert all(s['seconds'] >= 0 and 'mb_per_sec' in s for s in res['stages'].values())
+    # 峰值 RSS 是进程级最高水位，按阶段顺序只增不减
+    peaks = [s['cumulative_peak_rss_mb'] for s in res['stages'].values()]
+    if peaks[0] is not None:
+        assert peaks == sorted(peaks) and peaks[-1] <= res['peak_rss_mb']
+    assert 'extract' in compare_results(res, res)
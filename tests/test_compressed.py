@@ -0,0 +1,118 @@
+import csv
+import gzip
+import json
+import threading
+import zipfile
+
+import pytest
+
+from extract_bilibili_from_qce import (LinkIndex, iter_candidate_line_offsets, iter_candidate_lines, iter_chunk_blocks,
+                                       iter_chunk_rows, iter_line_windows, process_export_dir, read_export_manifest)
+
+
+def _msgs(tag, n=40):
+    out = []
+    for i in range(n):
+        text = f"{tag} {i}"
+        if i % 4 == 0:
+            text += f" https://www.bilibili.com/video/BV{tag}{i}"
+        out.append({"sender": {"name": f"u{i % 3}"}, "time": f"2026-01-01 00:{i:02d}:00", "text": text})
+    return out
+
+
+def _zip_dir(src, zip_path, top="group_chat"):
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for p in sorted(src.rglob("*")):
+            if p.is_file():
+                name = p.relative_to(src).as_posix()
+                zf.write(p, f"{top}/{name}" if top else name)
+    return zip_path
+
+
+def _rows(path):
+    with path.open('r', encoding='utf-8', newline='') as f:
+        return [{k: v for k, v in r.items() if k != 'chunk'} for r in csv.DictReader(f)]
+
+
+CHUNKS = {"c1.jsonl": _msgs("a"), "c2.jsonl": _msgs("b")}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_gzip_and_zip_exports_match_plain(tmp_path, workers, write_export):
+    plain = write_export(tmp_path / "plain", CHUNKS, newline="\r\n")
+    gz = write_export(tmp_path / "gz", CHUNKS, compress='gz', newline="\r\n")
+    archive = _zip_dir(gz, tmp_path / "export.zip")
+
+    outputs = []
+    for src in (plain, gz, archive):
+        out = tmp_path / f"{src.name}.csv"
+        assert process_export_dir(src, out, workers=workers) == 0
+        outputs.append(_rows(out))
+    assert len(outputs[0]) == 20
+    assert outputs[1] == outputs[0]
+    assert outputs[2] == outputs[0]
+
+    _, chat_name, _, chunk_files = read_export_manifest(archive)
+    assert chat_name == "chat"
+    assert [str(p) for p in chunk_files] == [f"{archive}!/group_chat/chunks/c1.jsonl.gz", f"{archive}!/group_chat/chunks/c2.jsonl.gz"]
+    # 不走字节预筛的路径结果相同
+    assert list(iter_chunk_rows(chunk_files[0], "chat", prefilter=False)) == list(iter_chunk_rows(chunk_files[0], "chat"))
+
+
+def test_zip_export_without_manifest_list_and_index(tmp_path, write_export):
+    src = write_export(tmp_path / "src", CHUNKS, newline="\r\n")
+    (src / "manifest.json").write_text(json.dumps({"chatInfo": {"name": "chat"}}), encoding='utf-8')
+    archive = _zip_dir(src, tmp_path / "export.zip", top="")
+    _, _, _, chunk_files = read_export_manifest(archive)
+    assert [p.name for p in chunk_files] == ["c1.jsonl", "c2.jsonl"]
+
+    index = LinkIndex(tmp_path / "idx.sqlite")
+    try:
+        assert index.build(archive)[0] == 2
+        records = index.query(video_id="BVb8")
+        assert [r["chunk"] for r in records] == ["chunks/c2.jsonl"]
+        assert index.raw_message(records[0])["text"] == "b 8 https://www.bilibili.com/video/BVb8"
+        # 归档未变化时不重新索引
+        assert index.build(archive)[:2] == (0, 2)
+    finally:
+        index.close()
+
+
+def test_zstd_chunks(tmp_path, write_export):
+    zstandard = pytest.importorskip("zstandard")
+    plain = write_export(tmp_path / "plain", CHUNKS, newline="\r\n")
+    zst = write_export(tmp_path / "zst", {}, newline="\r\n")
+    for name in CHUNKS:
+        data = (plain / "chunks" / name).read_bytes()
+        half = len(data) // 2
+        cctx = zstandard.ZstdCompressor()
+        # 多个帧首尾相接（pzstd 等工具的输出）
+        (zst / "chunks" / (name + ".zst")).write_bytes(cctx.compress(data[:half]) + cctx.compress(data[half:]))
+    for src in (plain, zst):
+        assert process_export_dir(src, tmp_path / f"{src.name}.csv") == 0
+    assert _rows(tmp_path / "zst.csv") == _rows(tmp_path / "plain.csv")
+
+
+def test_line_windows_match_whole_buffer():
+    data = b"".join(json.dumps(m).encode() + (b"\r\n" if i % 2 else b"\n") for i, m in enumerate(_msgs("x", 200)))
+    blocks = [data[i:i + 97] for i in range(0, len(data), 97)]
+    windows = list(iter_line_windows(iter(blocks), window_size=500))
+    assert len(windows) > 10
+    assert b"".join(w for _, w in windows) == data
+    spans = [(base + off, raw) for base, w in windows for off, raw in iter_candidate_line_offsets(w)]
+    assert spans == list(iter_candidate_line_offsets(data))
+    assert [raw for _, raw in spans] == list(iter_candidate_lines(data))
+
+
+def test_chunk_blocks_reader_thread_stops_early(tmp_path):
+    path = tmp_path / "big.jsonl.gz"
+    path.write_bytes(gzip.compress(b'{"text": "x"}\n' * 200000))
+    before = threading.active_count()
+    blocks = iter_chunk_blocks(path, block_size=1024, read_ahead=2)
+    assert next(blocks)
+    blocks.close()
+    assert threading.active_count() == before
+
+    path.write_bytes(b"not gzip")
+    with pytest.raises(OSError):
+        list(iter_chunk_blocks(path))
@@ -0,0 +1,82 @@
+import csv
+
+import pytest
+
+from extract_bilibili_from_qce import LinkDeduper, LinkRecord, main, process_export_dir
+
+
+def _msg(i, text, **extra):
+    return dict({"sender": {"name": f"u{i}"}, "time": f"2026-01-01 00:00:{i:02d}", "text": text}, **extra)
+
+
+def _links(path):
+    with path.open('r', encoding='utf-8', newline='') as f:
+        return [(r['chat_name'], r['sender'], r['link']) for r in csv.DictReader(f)]
+
+
+V1 = "https://www.bilibili.com/video/BV1aa"
+V2 = "https://www.bilibili.com/video/BV1bb"
+
+# 第一次导出
+OLD = [
+    _msg(1, f"看 {V1}", id="m1"),
+    _msg(2, f"两个 {V1} 和 {V2}", id="m2"),
+    _msg(3, f"无 ID {V2}"),
+]
+# 与第一次重叠的第二次导出，另有一条转发（另一个群、相同发送者与时间、带跟踪参数的同一链接）
+NEW = OLD[1:] + [
+    _msg(4, f"新的 {V2}", id="m4"),
+    _msg(3, f"转发 {V2}?share_source=qq"),
+]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_overlapping_exports_deduplicated(tmp_path, workers, capsys, write_export):
+    old = write_export(tmp_path / "old", {"c1.jsonl": OLD})
+    new = write_export(tmp_path / "new", {"c1.jsonl": NEW}, chat="other")
+    out = tmp_path / "out.csv"
+    dedup = LinkDeduper()
+    assert process_export_dir([old, new], out, workers=workers, dedup=dedup) == 0
+    # 同一消息中的两个链接各自保留；按消息 ID 与按 (发送者, 时间, 规范链接) 的重复都被丢弃
+    assert _links(out) == [("chat", "u1", V1), ("chat", "u2", V1), ("chat", "u2", V2), ("chat", "u3", V2),
+                           ("other", "u4", V2)]
+    assert (dedup.kept, dedup.dropped) == (5, 4)
+    assert "去重：丢弃 4 条重复链接" in capsys.readouterr().out
+
+    # 不去重时两次导出全部输出
+    assert process_export_dir([old, new], out, workers=workers) == 0
+    assert len(_links(out)) == 9
+
+
+def test_dedup_keeps_message_id_through_incremental_state(tmp_path, write_export):
+    old = write_export(tmp_path / "old", {"c1.jsonl": OLD})
+    new = write_export(tmp_path / "new", {"c1.jsonl": NEW})
+    out = tmp_path / "out.csv"
+    state = tmp_path / "out.state.jsonl"
+    for _ in range(2):
+        # 第二次运行时所有 chunk 都从状态文件复用，消息 ID 仍然可用
+        dedup = LinkDeduper()
+        assert process_export_dir([old, new], out, state_path=state, dedup=dedup) == 0
+        assert (dedup.kept, dedup.dropped) == (5, 4)
+    assert (tmp_path / "out.state.1.jsonl").exists()
+
+
+def test_deduper_switches_to_bloom_without_false_negatives():
+    dedup = LinkDeduper(exact_limit=50, capacity=5000)
+    records = [LinkRecord(sender="s", time=str(i), link=f"https://b23.tv/{i}") for i in range(2000)]
+    kept = list(dedup.filter(records))
+    assert dedup.using_bloom
+    # 误判率 0.1%，2000 条中误丢的极少
+    assert len(kept) >= 1990
+    assert list(dedup.filter(records)) == []
+    assert dedup.dropped == 2000 + (2000 - len(kept))
+    assert "Bloom 过滤器" in dedup.summary()
+
+
+def test_cli_multiple_inputs_with_dedup(tmp_path, capsys, write_export):
+    old = write_export(tmp_path / "old", {"c1.jsonl": OLD})
+    new = write_export(tmp_path / "new", {"c1.jsonl": NEW})
+    out = tmp_path / "out.csv"
+    assert main(["-i", str(old), "-i", str(new), "-o", str(out), "--dedup", "--no-meta-cache"]) == 0
+    assert len(_links(out)) == 5
+    assert "去重：丢弃 4 条重复链接，保留 5 条" in capsys.readouterr().out
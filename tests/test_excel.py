@@ -0,0 +1,62 @@
+import csv
+import json
+import sys
+
+import pytest
+
+load_workbook = pytest.importorskip("openpyxl").load_workbook
+
+from extract_bilibili_from_qce import ExcelRowWriter, process_export_dir, write_excel_from_csv  # noqa: E402
+
+
+def _sheet_values(path):
+    wb = load_workbook(path)
+    return {ws.title: [list(r) for r in ws.iter_rows(values_only=True)] for ws in wb.worksheets}
+
+
+def test_excel_row_writer_rolls_over_sheets(tmp_path):
+    path = tmp_path / "out.xlsx"
+    writer = ExcelRowWriter(path, ['a', 'b'], max_rows=3)
+    for i in range(5):
+        writer.writerow({'a': f'v{i}', 'b': '' if i % 2 else 'x\x07y'})
+    writer.close()
+    assert (writer.rows, writer.sheets) == (5, 3)
+
+    sheets = _sheet_values(path)
+    assert list(sheets) == ['Sheet1', 'Sheet2', 'Sheet3']
+    assert all(rows[0] == ['a', 'b'] for rows in sheets.values())
+    data = [r for rows in sheets.values() for r in rows[1:]]
+    # 空字符串为空单元格，控制字符被去掉
+    assert data == [['v0', 'xy'], ['v1', None], ['v2', 'xy'], ['v3', None], ['v4', 'xy']]
+
+
+def test_excel_row_writer_empty_has_header(tmp_path):
+    path = tmp_path / "empty.xlsx"
+    writer = ExcelRowWriter(path, ['a'])
+    writer.close()
+    assert _sheet_values(path) == {'Sheet1': [['a']]}
+
+
+def test_process_export_dir_excel_streamed_without_pandas(tmp_path, monkeypatch):
+    export_dir = tmp_path / "export"
+    (export_dir / "chunks").mkdir(parents=True)
+    (export_dir / "manifest.json").write_text(json.dumps({"chatInfo": {"name": "c"}, "chunked": {"chunks": [{"fileName": "a.jsonl"}]}}), encoding='utf-8')
+    with (export_dir / "chunks" / "a.jsonl").open('w', encoding='utf-8') as f:
+        for i in range(4):
+            f.write(json.dumps({"sender": f"s{i}", "time": f"t{i}", "text": f"看 https://www.bilibili.com/video/BV1x{i}"}, ensure_ascii=False) + "\n")
+    # 逐行写 Excel 不应依赖 pandas（也就不会回读 CSV）
+    monkeypatch.setitem(sys.modules, 'pandas', None)
+    out_csv = tmp_path / "out.csv"
+    xlsx = tmp_path / "out.xlsx"
+    assert process_export_dir(export_dir, out_csv, excel_path=xlsx) == 0
+
+    with out_csv.open('r', encoding='utf-8', newline='') as f:
+        csv_rows = [list(r.values()) for r in csv.DictReader(f)]
+    [rows] = _sheet_values(xlsx).values()
+    assert rows[0][:5] == ['chat_name', 'chunk', 'time', 'sender', 'link']
+    assert [[v if v is not None else '' for v in r] for r in rows[1:]] == csv_rows
+
+    # 由已有 CSV 流式转换得到相同内容
+    again = tmp_path / "again.xlsx"
+    assert write_excel_from_csv(out_csv, again)
+    assert _sheet_values(again) == _sheet_values(xlsx)
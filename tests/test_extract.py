@@ -42,6 +42,23 @@ def test_extract_video_id_from_bv_and_av():
     assert extract_video_id('https://www.bilibili.com/video/av12345') == 'av12345'
     assert extract_video_id('https://m.bilibili.com/video/BV2abc') == 'BV2abc'
     assert extract_video_id('https://www.bilibili.com/watch?v=BV3def') == 'BV3def'
+    # BV 号优先于更靠前的 av 号
+    assert extract_video_id('https://www.bilibili.com/video/av1?from=BV4ghi') == 'BV4ghi'
+
+
+def test_analyze_bili_link_canonical_and_page():
+    from extract_bilibili_from_qce import analyze_bili_link
+    a = analyze_bili_link('https://m.bilibili.com/video/BV1abc/?p=2&spm_id_from=333.999&share_source=qq#reply1')
+    assert a == ('video', 'BV1abc', 'https://www.bilibili.com/video/BV1abc?p=2', 2)
+    assert analyze_bili_link('http://bilibili.com/video/av170001?p=1&vd_source=x').canonical_url == 'https://www.bilibili.com/video/av170001'
+    assert analyze_bili_link('https://www.bilibili.com/video/BV1abc').page == 1
+    assert analyze_bili_link('https://b23.tv/AbC?share_medium=android') == ('short', '', 'https://b23.tv/AbC', None)
+    assert analyze_bili_link('https://live.bilibili.com/22/?broadcast_type=0&spm_id_from=1').canonical_url == \
+        'https://live.bilibili.com/22?broadcast_type=0'
+    # 重复的链接命中缓存
+    before = analyze_bili_link.cache_info().hits
+    analyze_bili_link('https://b23.tv/AbC?share_medium=android')
+    assert analyze_bili_link.cache_info().hits == before + 1
 
 def test_guess_sender_various_fields():
     assert guess_sender({"sender": {"name": "Alice"}}) == "Alice"
@@ -59,18 +76,26 @@ def test_fetch_bilibili_metadata_video(monkeypatch):
     sample_html = '<html><head><meta property="og:title" content="Sample Video Title"><meta name="author" content="UploaderName"></head><body></body></html>'
 
     class DummyResp:
+        encoding = 'utf-8'
         def __init__(self, text):
             self.text = text
         def raise_for_status(self):
             return
+        def iter_content(self, chunk_size=1):
+            data = self.text.encode('utf-8')
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+        def close(self):
+            return
 
-    def fake_get(url, timeout=6, headers=None, allow_redirects=True):
+    def fake_get(url, timeout=6, headers=None, allow_redirects=True, stream=False):
         return DummyResp(sample_html)
 
-    import sys, types
-    fake_requests = types.SimpleNamespace(get=fake_get)
-    monkeypatch.setitem(sys.modules, 'requests', fake_requests)
-    title, uploader = fetch_bilibili_metadata('https://www.bilibili.com/video/ABC')
+    import types
+    import extract_bilibili_from_qce as mod
+    fake_session = types.SimpleNamespace(get=fake_get)
+    monkeypatch.setattr(mod, 'get_http_session', lambda pool_size=10: fake_session)
+    title, uploader, _ = fetch_bilibili_metadata('https://www.bilibili.com/video/ABC')
     assert title == 'Sample Video Title'
     assert uploader == 'UploaderName'
 
@@ -79,17 +104,148 @@ def test_fetch_bilibili_metadata_short_link(monkeypatch):
     sample_html = '<html><head><title>Short Link Title</title><meta name="author" content="ShortUploader"></head><body></body></html>'
 
     class DummyResp:
+        encoding = 'utf-8'
         def __init__(self, text):
             self.text = text
         def raise_for_status(self):
             return
+        def iter_content(self, chunk_size=1):
+            data = self.text.encode('utf-8')
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+        def close(self):
+            return
 
-    def fake_get(url, timeout=6, headers=None, allow_redirects=True):
+    def fake_get(url, timeout=6, headers=None, allow_redirects=True, stream=False):
         return DummyResp(sample_html)
 
-    import sys, types
-    fake_requests = types.SimpleNamespace(get=fake_get)
-    monkeypatch.setitem(sys.modules, 'requests', fake_requests)
-    title, uploader = fetch_bilibili_metadata('https://b23.tv/xyz')
+    import types
+    import extract_bilibili_from_qce as mod
+    fake_session = types.SimpleNamespace(get=fake_get)
+    monkeypatch.setattr(mod, 'get_http_session', lambda pool_size=10: fake_session)
+    title, uploader, _ = fetch_bilibili_metadata('https://b23.tv/xyz')
     assert title == 'Short Link Title'
-    assert uploader == 'ShortUploader'
\ No newline at end of file
+    assert uploader == 'ShortUploader'
+
+def test_iter_candidate_messages_matches_full_parse(tmp_path):
+    from extract_bilibili_from_qce import iter_candidate_messages, iter_jsonl_messages
+    lines = [
+        json.dumps({"text": "plain https://www.bilibili.com/video/BV1aa"}),
+        json.dumps({"text": "no link here"}),
+        '{"text": "escaped https:\\/\\/www.bilibili.com\\/video\\/BV1bb"}',
+        '{"text": "unicode https://\\u0062ilibili.com/video/BV1cc"}',
+        '{"text": "dot https://b23\\u002etv/xyz"}',
+        json.dumps({"text": "upper HTTPS://WWW.BILIBILI.COM/VIDEO/BV1DD"}),
+        json.dumps({"text": "中文 https://b23.tv/abc"}, ensure_ascii=False),
+        json.dumps({"text": "中文 https://b23.tv/def"}, ensure_ascii=True),
+        json.dumps({"text": "dotless https://bılibili.com/x"}, ensure_ascii=False),
+        '{"broken": "https://bilibili.com',
+        '',
+        '   ',
+        '{"a": 1,\r"text": "cr https://bilibili.com/cr"}',
+    ]
+    chunk = tmp_path / "c.jsonl"
+    chunk.write_bytes(("\n".join(lines) + "\r\n" + json.dumps({"text": "crlf https://bilibili.com/v"}) + "\r\n").encode('utf-8'))
+
+    def with_links(msgs):
+        return [(m, find_links_in_message(m)) for m in msgs if find_links_in_message(m)]
+
+    expected = with_links(iter_jsonl_messages(chunk))
+    assert len(expected) == 9
+    assert with_links(iter_candidate_messages(chunk)) == expected
+
+    empty = tmp_path / "empty.jsonl"
+    empty.write_bytes(b"")
+    assert list(iter_candidate_messages(empty)) == []
+
+
+def test_iter_candidate_lines_stream_matches_buffer():
+    from extract_bilibili_from_qce import iter_candidate_lines, iter_candidate_lines_stream
+    import io
+    data = b'{"t": "x"}\n{"t": "https://b23.tv/a"}\r\n{"t": "y"}\r{"t": "https://bilibili.com/b"}\n'
+    assert list(iter_candidate_lines(data)) == list(iter_candidate_lines_stream(io.BytesIO(data)))
+
+
+def test_iter_candidate_lines_small_window(monkeypatch):
+    import extract_bilibili_from_qce as mod
+    data = b''.join(b'{"n": %d, "t": "https://b23.tv/%d"}\n{"n": %d}\r\n' % (i, i, i) for i in range(50))
+    expected = list(mod.iter_candidate_lines(data))
+    assert len(expected) == 50
+    monkeypatch.setattr(mod, "_SCAN_WINDOW", 7)
+    assert list(mod.iter_candidate_lines(data)) == expected
+
+
+def _qce_msg(i, text):
+    return {
+        "id": f"73{i:08d}", "seq": str(i), "timestamp": 1700000000000 + i, "time": "2026-01-01 00:00:00",
+        "sender": {"uid": "u_abc", "uin": str(10000 + i), "name": f"成员{i}"},
+        "type": "normal",
+        "content": {
+            "text": text,
+            "html": f"<span>{text}</span>",
+            "elements": [
+                {"type": "text", "data": {"text": text}},
+                {"type": "image", "data": {"filename": "a.jpg", "size": 123, "url": "https://multimedia.nt.qq.com.cn/x"}},
+                {"type": "json", "data": {"content": json.dumps({"meta": {"detail_1": {"qqdocurl": f"https://b23.tv/c{i}"}}})}},
+                {"type": "reply", "data": {"senderName": "Bob", "content": "原消息 https://www.bilibili.com/video/BV1reply"}},
+                {"type": "unknown_future_type", "data": {"summary": f"https://m.bilibili.com/video/BV1u{i}"}},
+            ],
+            "resources": [{"type": "image", "filename": "a.jpg", "url": "https://multimedia.nt.qq.com.cn/y"}],
+            "mentions": [],
+        },
+        "recalled": False,
+    }
+
+
+def test_find_links_in_message_schema_aware_same_links():
+    for i in range(50):
+        msg = _qce_msg(i, f"看 https://www.bilibili.com/video/BV1x{i}?p=2 好" if i % 2 else "没有链接的文字")
+        fast = find_links_in_message(msg)
+        full = find_links_in_message(msg, schema_aware=False)
+        assert [(l, t) for l, _, t in fast] == [(l, t) for l, _, t in full]
+
+
+def test_find_links_in_message_schema_aware_context_skips_metadata():
+    msg = _qce_msg(7, "看 https://www.bilibili.com/video/BV1ctx")
+    link, ctx, _ = find_links_in_message(msg)[0]
+    assert link == "https://www.bilibili.com/video/BV1ctx"
+    assert "看" in ctx
+    assert "1700000000007" not in ctx
+    # 非 QCE 结构仍走通用递归，上下文与原先一致
+    plain = {"uin": 10007, "text": "看 https://www.bilibili.com/video/BV1ctx"}
+    assert "10007" in find_links_in_message(plain)[0][1]
+    assert find_links_in_message(plain) == find_links_in_message(plain, schema_aware=False)
+
+
+def _links(msg, schema_aware):
+    return [(l, t) for l, _, t in find_links_in_message(msg, schema_aware=schema_aware)]
+
+
+def test_find_links_in_message_schema_aware_matches_full_walk_on_generator_shapes():
+    import random
+    from benchmarks.gen_qce_export import make_message, _BASE_TIME
+    rng = random.Random(3)
+    extra = [
+        {"type": "file", "data": {"filename": "合集 https://www.bilibili.com/video/BV1file 备份.txt", "size": 10}},
+        {"type": "video", "data": {"url": "https://m.bilibili.com/video/BV1vid", "duration": 30}},
+        {"type": "at", "data": {"uin": 1, "name": "https://space.bilibili.com/2"}},
+    ]
+    for seq in range(300):
+        msg = make_message(rng, seq, _BASE_TIME, rng.random() < 0.7, seq % 3, 256, 50)
+        if seq % 4 == 0:
+            msg["content"]["elements"].extend(extra)
+            msg["content"]["resources"].append({"type": "file", "url": "https://b23.tv/res", "size": 1})
+        if seq % 5 == 0:
+            msg["sender"]["name"] = f"个人主页 https://space.bilibili.com/{seq}"
+        assert _links(msg, True) == _links(msg, False)
+        if seq % 20 == 0:
+            # 文件、视频、@、资源与发送者中的链接不会丢
+            assert {"https://www.bilibili.com/video/BV1file", "https://m.bilibili.com/video/BV1vid",
+                    "https://space.bilibili.com/2", "https://b23.tv/res",
+                    f"https://space.bilibili.com/{seq}"} <= {l for l, _ in _links(msg, True)}
+
+
+def test_message_texts_matches_extract_strings_for_unknown_shapes():
+    from extract_bilibili_from_qce import message_texts
+    obj = {"a": ["x", {"b": 1, "c": None, "d": True}], "e": 1.5, "content": "not a dict"}
+    assert message_texts(obj) == list(extract_strings(obj))
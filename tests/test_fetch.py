@@ -0,0 +1,180 @@
+import csv
+import json
+import time
+
+import pytest
+
+# 所有测试都经由 requests 访问本地桩服务
+pytest.importorskip("requests")
+
+import extract_bilibili_from_qce as mod  # noqa: E402
+from extract_bilibili_from_qce import MetadataFetcher, fetch_bilibili_metadata, process_export_dir  # noqa: E402
+
+
+def test_fetch_bilibili_metadata_follows_redirect(stub_server):
+    stub_server.route('/video/BV1abc', stub_server.video_html('Stub Title', 'Stub Up'))
+    stub_server.redirect('/short', stub_server.url('/video/BV1abc'))
+    title, uploader, final_url = fetch_bilibili_metadata(stub_server.url('/short'))
+    assert (title, uploader) == ('Stub Title', 'Stub Up')
+    assert final_url == stub_server.url('/video/BV1abc')
+
+
+def test_fetch_bilibili_metadata_error_returns_empty(stub_server):
+    assert fetch_bilibili_metadata(stub_server.url('/missing')) == ('', '', '')
+
+
+def test_metadata_fetcher_concurrent_and_ordered(stub_server):
+    links = []
+    for i in range(8):
+        # 前面的链接更慢，确认结果仍按原顺序产出
+        stub_server.route(f'/video/BV{i}', stub_server.video_html(f'T{i}', f'U{i}'), delay=0.3 - i * 0.03)
+        links.append(stub_server.url(f'/video/BV{i}'))
+    rows = [{'link': l, 'video_id': ''} for l in links]
+
+    with MetadataFetcher(concurrency=8) as fetcher:
+        out = list(fetcher.enrich(iter(rows)))
+
+    assert [r['bili_title'] for r in out] == [f'T{i}' for i in range(8)]
+    assert [r['video_id'] for r in out] == [f'BV{i}' for i in range(8)]
+    # 请求确实同时进行（串行时桩服务最多只有一个请求在处理），且不超过并发上限
+    assert 1 < stub_server.peak_in_flight <= 8
+    assert stub_server.connections <= 8
+
+
+def test_process_export_dir_fetch_meta_ordered(tmp_path, stub_server, monkeypatch):
+    export_dir = tmp_path / "export"
+    (export_dir / "chunks").mkdir(parents=True)
+    (export_dir / "manifest.json").write_text(json.dumps({"chunked": {"chunks": [{"fileName": "c.jsonl"}]}}), encoding='utf-8')
+    with (export_dir / "chunks" / "c.jsonl").open('w', encoding='utf-8') as f:
+        for i in range(6):
+            stub_server.route(f'/video/BV{i}', stub_server.video_html(f'T{i}', f'U{i}'), delay=0.05 * (6 - i))
+            f.write(json.dumps({"sender": f"s{i}", "text": f"https://www.bilibili.com/video/BV{i}"}) + "\n")
+
+    real_fetch = mod.fetch_bilibili_metadata
+    monkeypatch.setattr(mod, 'fetch_bilibili_metadata',
+                        lambda url: real_fetch(url.replace('https://www.bilibili.com', stub_server.base)))
+    out_csv = tmp_path / "out.csv"
+    assert process_export_dir(export_dir, out_csv, fetch_meta=True, fetch_concurrency=4) == 0
+    with out_csv.open('r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert [r['sender'] for r in rows] == [f's{i}' for i in range(6)]
+    assert [r['bili_title'] for r in rows] == [f'T{i}' for i in range(6)]
+
+
+def test_metadata_cache_ttl_negative_and_eviction(tmp_path):
+    from extract_bilibili_from_qce import MetadataCache
+    cache = MetadataCache(tmp_path / "c.sqlite", ttl=3600, negative_ttl=-1, max_entries=2)
+    cache.put(['vid:BV1'], ('T', 'U', 'https://www.bilibili.com/video/BV1'))
+    cache.put(['url:https://b23.tv/bad'], ('', '', ''))
+    assert cache.get('vid:BV1') == ('T', 'U', 'https://www.bilibili.com/video/BV1')
+    # 失败结果按 negative_ttl 过期
+    assert cache.get('url:https://b23.tv/bad') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    time.sleep(0.01)
+    cache.put(['vid:BV2'], ('T2', 'U2', 'x'))
+    time.sleep(0.01)
+    cache.put(['vid:BV3'], ('T3', 'U3', 'x'))
+    cache.close()
+
+    cache = MetadataCache(tmp_path / "c.sqlite", ttl=3600)
+    # BV1 最久未访问，被淘汰
+    assert cache.get('vid:BV1') is None
+    assert cache.get('vid:BV3') == ('T3', 'U3', 'x')
+    cache.close()
+
+
+def test_metadata_fetcher_dedup_and_persistent_cache(tmp_path, stub_server):
+    from extract_bilibili_from_qce import MetadataCache
+    stub_server.route('/video/BV1same', stub_server.video_html('Same', 'Up'))
+    stub_server.redirect('/short', stub_server.url('/video/BV1same'))
+    rows = lambda: [
+        {'link': stub_server.url('/video/BV1same'), 'video_id': 'BV1same'},
+        {'link': stub_server.url('/video/BV1same?p=2'), 'video_id': 'BV1same'},
+        {'link': stub_server.url('/short'), 'video_id': ''},
+        {'link': stub_server.url('/short'), 'video_id': ''},
+    ]
+
+    cache_path = tmp_path / "meta.sqlite"
+    with MetadataFetcher(concurrency=4, cache=MetadataCache(cache_path)) as fetcher:
+        out = list(fetcher.enrich(iter(rows())))
+    assert [r['bili_title'] for r in out] == ['Same'] * 4
+    assert out[2]['video_id'] == 'BV1same'
+    # 视频链接与短链各请求一次（短链跟随重定向时会再访问视频页）
+    assert fetcher.fetched == 2 and fetcher.deduped == 2
+    first_run_requests = len(stub_server.requests)
+
+    with MetadataFetcher(concurrency=4, cache=MetadataCache(cache_path)) as fetcher:
+        out = list(fetcher.enrich(iter(rows())))
+        assert fetcher.cache.hits == 2 and fetcher.fetched == 0
+    assert [r['bili_title'] for r in out] == ['Same'] * 4
+    assert len(stub_server.requests) == first_run_requests
+
+
+def test_resolve_short_link_stops_at_video_id(stub_server):
+    from extract_bilibili_from_qce import resolve_short_link
+    stub_server.redirect('/s', '/mid')
+    stub_server.redirect('/mid', stub_server.url('/video/BV1abc?share_source=qq'))
+    stub_server.route('/video/BV1abc', stub_server.video_html('never', 'read'))
+    assert resolve_short_link(stub_server.url('/s')) == stub_server.url('/video/BV1abc?share_source=qq')
+    # 只发 HEAD，且拿到视频 ID 后不再请求视频页
+    assert stub_server.requests == [('HEAD', '/s'), ('HEAD', '/mid')]
+
+
+def test_resolve_short_link_failure_and_non_video(stub_server):
+    from extract_bilibili_from_qce import resolve_short_link
+    stub_server.redirect('/s', '/space')
+    stub_server.route('/space', 'x')
+    assert resolve_short_link(stub_server.url('/s')) == stub_server.url('/space')
+    assert resolve_short_link(stub_server.url('/gone')) == ''
+
+
+def test_process_export_dir_resolve_short_links_only(tmp_path, stub_server, monkeypatch):
+    export_dir = tmp_path / "export"
+    (export_dir / "chunks").mkdir(parents=True)
+    (export_dir / "manifest.json").write_text(json.dumps({"chunked": {"chunks": [{"fileName": "c.jsonl"}]}}), encoding='utf-8')
+    stub_server.redirect('/a', stub_server.url('/video/BV1aaa'))
+    stub_server.redirect('/b', stub_server.url('/video/BV1bbb'))
+    lines = [
+        {"sender": "s0", "text": "https://b23.tv/a"},
+        {"sender": "s1", "text": "https://www.bilibili.com/video/BV1direct"},
+        {"sender": "s2", "text": "https://b23.tv/b"},
+        {"sender": "s3", "text": "https://b23.tv/a"},
+    ]
+    with (export_dir / "chunks" / "c.jsonl").open('w', encoding='utf-8') as f:
+        for m in lines:
+            f.write(json.dumps(m) + "\n")
+
+    real_resolve = mod.resolve_short_link
+    monkeypatch.setattr(mod, 'resolve_short_link', lambda url: real_resolve(url.replace('https://b23.tv', stub_server.base)))
+    out_csv = tmp_path / "out.csv"
+    assert process_export_dir(export_dir, out_csv, resolve_short_links=True, meta_cache=tmp_path / "m.sqlite") == 0
+    with out_csv.open('r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert [r['video_id'] for r in rows] == ['BV1aaa', 'BV1direct', 'BV1bbb', 'BV1aaa']
+    # 解析到视频页的短链，canonical_url 为视频页的规范地址
+    canonical = stub_server.url('/video/BV1aaa').replace('http://', 'https://')
+    assert [r['canonical_url'] for r in rows] == [canonical, 'https://www.bilibili.com/video/BV1direct',
+                                                  canonical.replace('BV1aaa', 'BV1bbb'), canonical]
+    assert all(r['bili_title'] == '' for r in rows)
+    assert sorted(stub_server.requests) == [('HEAD', '/a'), ('HEAD', '/b')]
+
+    # 解析结果被缓存，重跑不再发请求
+    assert process_export_dir(export_dir, out_csv, resolve_short_links=True, meta_cache=tmp_path / "m.sqlite") == 0
+    assert len(stub_server.requests) == 2
+
+
+def test_metadata_fetcher_records_latency(stub_server):
+    from extract_bilibili_from_qce import RunStats
+    for i in range(4):
+        stub_server.route(f'/video/BV{i}', stub_server.video_html(f'T{i}', f'U{i}'), delay=0.05)
+    rows = [{'link': stub_server.url(f'/video/BV{i}'), 'video_id': ''} for i in range(4)]
+    stats = RunStats()
+    with MetadataFetcher(concurrency=2, stats=stats) as fetcher:
+        out = list(fetcher.enrich(iter(rows)))
+    assert [r['bili_title'] for r in out] == [f'T{i}' for i in range(4)]
+    lat = stats.report()['fetch_latency']['fetch']
+    assert lat['count'] == 4
+    assert 0.05 <= lat['p50'] <= lat['p90'] <= lat['max']
+    assert stats.stages['fetch_wait'][1] == 4
+    assert 'fetch 延迟：4 次' in stats.summary()
@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from extract_bilibili_from_qce import (FetchError, FetchScheduler, MetadataCache, MetadataFetcher, RetryQueue,
+                                       fetch_bilibili_metadata, main, resolve_short_link)
+
+
+def _throttle_first(n, body, status=429, headers=None):
+    """前 n 次请求返回 status（模拟限流），之后返回 body。"""
+    state = {'count': 0}
+    lock = threading.Lock()
+
+    def route(path):
+        with lock:
+            state['count'] += 1
+            throttled = state['count'] <= n
+        if throttled:
+            return status, dict(headers or {}), b'', 0
+        return 200, {'Content-Type': 'text/html; charset=utf-8'}, body, 0
+    return route
+
+
+def test_throttling_and_server_errors_raise_fetch_error(stub_server):
+    pytest.importorskip("requests")
+    stub_server.route('/video/BV1t', status=429, headers={'Retry-After': '3'})
+    stub_server.route('/video/BV1e', status=503)
+    with pytest.raises(FetchError) as exc:
+        fetch_bilibili_metadata(stub_server.url('/video/BV1t'))
+    assert (exc.value.status, exc.value.throttled, exc.value.retry_after) == (429, True, 3.0)
+    with pytest.raises(FetchError) as exc:
+        fetch_bilibili_metadata(stub_server.url('/video/BV1e'))
+    assert (exc.value.status, exc.value.throttled) == (503, False)
+    # 永久错误仍返回空结果
+    assert fetch_bilibili_metadata(stub_server.url('/missing')) == ('', '', '')
+
+    stub_server.route('/s', status=412)
+    with pytest.raises(FetchError):
+        resolve_short_link(stub_server.url('/s'))
+
+
+def test_scheduler_honours_retry_after(stub_server):
+    pytest.importorskip("requests")
+    stub_server.routes['/video/BV1r'] = _throttle_first(1, stub_server.video_html('T', 'U'), headers={'Retry-After': '0.3'})
+    scheduler = FetchScheduler(2, rate=None, backoff=0.001)
+    start = time.monotonic()
+    assert scheduler.call(fetch_bilibili_metadata, stub_server.url('/video/BV1r'))[0] == 'T'
+    assert time.monotonic() - start >= 0.3
+    assert (scheduler.throttled, scheduler.retries, scheduler.requests) == (1, 1, 2)
+
+
+def test_metadata_fetcher_retries_throttled_requests(stub_server):
+    pytest.importorskip("requests")
+    route = _throttle_first(3, stub_server.video_html('Same', 'Up'), status=412)
+    links = []
+    for i in range(4):
+        stub_server.routes[f'/video/BV{i}'] = route
+        links.append(stub_server.url(f'/video/BV{i}'))
+    scheduler = FetchScheduler(4, rate=None, backoff=0.01)
+    with MetadataFetcher(concurrency=4, scheduler=scheduler) as fetcher:
+        out = list(fetcher.enrich(iter([{'link': l, 'video_id': ''} for l in links])))
+    # 以前被限流的链接会静默留空，现在退避重试后都能拿到标题
+    assert [r['bili_title'] for r in out] == ['Same'] * 4
+    assert (scheduler.throttled, scheduler.retries, scheduler.failed) == (3, 3, 0)
+    assert scheduler.min_limit < 4
+    assert '被限流 3 次' in fetcher.summary()
+
+
+def test_scheduler_halves_concurrency_once_per_round_and_recovers():
+    barrier = threading.Barrier(8)
+    lock = threading.Lock()
+    state = {'calls': 0, 'active': 0, 'peak_after_throttle': 0}
+
+    def func(i):
+        with lock:
+            state['calls'] += 1
+            first_round = state['calls'] <= 8
+            state['active'] += 1
+            if not first_round:
+                state['peak_after_throttle'] = max(state['peak_after_throttle'], state['active'])
+        try:
+            if first_round:
+                # 8 个请求同时在途时一起被限流
+                barrier.wait(5)
+                raise FetchError('throttled', status=429, throttled=True)
+            time.sleep(0.01)
+            return i
+        finally:
+            with lock:
+                state['active'] -= 1
+
+    scheduler = FetchScheduler(8, rate=None, backoff=0.001)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: scheduler.call(func, i), range(8)))
+    assert results == list(range(8))
+    assert scheduler.throttled == 8
+    assert scheduler.min_limit == 4
+    assert state['peak_after_throttle'] <= 4 + 1
+
+    # 持续成功后上限逐步恢复
+    for i in range(40):
+        scheduler.call(lambda: None)
+    assert scheduler.limit == 8
+
+
+def test_scheduler_token_bucket_limits_rate():
+    scheduler = FetchScheduler(4, rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        scheduler.call(lambda: None)
+    assert time.monotonic() - start >= 0.18
+
+
+def test_failed_links_go_to_retry_queue_and_are_drained(tmp_path, stub_server):
+    pytest.importorskip("requests")
+    stub_server.route('/video/BV1q', status=503)
+    link = stub_server.url('/video/BV1q')
+    queue_path = tmp_path / 'queue.jsonl'
+    cache_path = tmp_path / 'meta.sqlite'
+    fetcher = MetadataFetcher(concurrency=2, cache=MetadataCache(cache_path), retry_queue=RetryQueue(queue_path),
+                              scheduler=FetchScheduler(2, rate=None, max_retries=2, backoff=0.001))
+    with fetcher:
+        out = list(fetcher.enrich(iter([{'link': link, 'video_id': 'BV1q'}, {'link': link, 'video_id': 'BV1q'}])))
+    assert [r.get('bili_title') for r in out] == [None, None]
+    # 1 次请求 + 2 次重试，同一链接在本次运行中只抓取一次
+    assert len(stub_server.requests) == 3
+    entries = [json.loads(line) for line in queue_path.read_text(encoding='utf-8').splitlines()]
+    assert [(e['link'], e['status'], e['failures']) for e in entries] == [(link, 503, 1)]
+    # 限流/临时错误不写入负缓存
+    cache = MetadataCache(cache_path)
+    assert cache.get('vid:BV1q') is None
+    cache.close()
+
+    stub_server.route('/video/BV1q', stub_server.video_html('Back', 'Up'))
+    assert main(['retry', '--queue', str(queue_path), '--meta-cache', str(cache_path), '--fetch-rate', '0']) == 0
+    assert not queue_path.exists()
+    cache = MetadataCache(cache_path)
+    assert cache.get('vid:BV1q')[:2] == ('Back', 'Up')
+    cache.close()
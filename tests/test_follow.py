@@ -0,0 +1,195 @@
+import csv
+import gzip
+import json
+import threading
+import time
+
+import pytest
+
+import extract_bilibili_from_qce as mod
+from extract_bilibili_from_qce import ExportFollower, follow_export_dir
+
+
+def _line(i, chat_text="看"):
+    msg = {"id": f"m{i}", "sender": {"name": f"u{i}"}, "time": f"2026-01-01 00:00:{i:02d}",
+           "text": f"{chat_text} https://www.bilibili.com/video/BV1x{i}"}
+    return (json.dumps(msg, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+def _append(path, data):
+    with path.open('ab') as f:
+        f.write(data)
+
+
+def _video_ids(rows):
+    return [r.video_id for r in rows]
+
+
+def test_follower_reads_only_complete_new_lines(tmp_path):
+    export_dir = tmp_path / "group_x"
+    chunks = export_dir / "chunks"
+    chunks.mkdir(parents=True)
+    c1 = chunks / "chunk_0001.jsonl"
+    second = _line(2)
+    c1.write_bytes(_line(1) + b'{"sender": "noise", "text": "hello"}\n' + second[:20])
+
+    follower = ExportFollower(export_dir)
+    rows = list(follower.poll())
+    # 没有 manifest 时以目录名作为聊天名；没写完的末行留到下次
+    assert _video_ids(rows) == ["BV1x1"]
+    assert rows[0].chat_name == "group_x" and rows[0].message_id == "m1"
+    assert follower.offsets["chunk_0001.jsonl"] == c1.stat().st_size - 20
+    assert list(follower.poll()) == []
+
+    _append(c1, second[20:] + _line(3)[:5])
+    assert _video_ids(follower.poll()) == ["BV1x2"]
+
+    # 新出现的 chunk（包括压缩的）与 manifest
+    _append(c1, _line(3)[5:])
+    (chunks / "chunk_0002.jsonl").write_bytes(_line(4))
+    (chunks / "chunk_0003.jsonl.gz").write_bytes(gzip.compress(_line(5)))
+    (export_dir / "manifest.json").write_text(json.dumps({"chatInfo": {"name": "群"}}), encoding='utf-8')
+    rows = list(follower.poll())
+    assert _video_ids(rows) == ["BV1x3", "BV1x4"]
+    # 压缩的 chunk 等到大小不再变化才读取
+    rows += list(follower.poll())
+    assert _video_ids(rows) == ["BV1x3", "BV1x4", "BV1x5"]
+    assert {r.chat_name for r in rows} == {"群"}
+    assert list(follower.poll()) == []
+
+    # 只检查 inotify 报告的文件
+    _append(chunks / "chunk_0002.jsonl", _line(6))
+    assert list(follower.poll({"chunk_0001.jsonl"})) == []
+    assert _video_ids(follower.poll({"chunk_0002.jsonl"})) == ["BV1x6"]
+
+    # 被截断重写的 chunk 从头读取
+    c1.write_bytes(_line(7))
+    assert _video_ids(follower.poll()) == ["BV1x7"]
+
+
+def test_follower_flushes_complete_last_line_without_newline(tmp_path):
+    chunks = tmp_path / "export" / "chunks"
+    chunks.mkdir(parents=True)
+    c1 = chunks / "c.jsonl"
+    c1.write_bytes(_line(1) + _line(2).rstrip(b"\n"))
+    follower = ExportFollower(tmp_path / "export")
+    # 末行没有换行但已是完整的 JSON，不用等到写入方补上换行
+    assert _video_ids(follower.poll()) == ["BV1x1", "BV1x2"]
+    assert follower.offsets["c.jsonl"] == c1.stat().st_size
+    # 之后补上的换行与新行不会让末行重复输出
+    _append(c1, b"\n" + _line(3))
+    assert _video_ids(follower.poll()) == ["BV1x3"]
+    _append(c1, _line(4)[:-10])
+    assert list(follower.poll()) == []
+
+
+def test_follower_retries_incomplete_compressed_chunk(tmp_path):
+    chunks = tmp_path / "export" / "chunks"
+    chunks.mkdir(parents=True)
+    data = gzip.compress(_line(1) + _line(2))
+    path = chunks / "c.jsonl.gz"
+    path.write_bytes(data[:len(data) // 2])
+    follower = ExportFollower(tmp_path / "export")
+    assert list(follower.poll()) == []
+    # 大小没变时读取，但文件还不完整：解压报错，下次再试
+    assert list(follower.poll()) == []
+    path.write_bytes(data)
+    assert list(follower.poll()) == []
+    assert _video_ids(follower.poll()) == ["BV1x1", "BV1x2"]
+    assert list(follower.poll()) == []
+
+
+def test_follower_does_not_repeat_rows_of_growing_compressed_chunk(tmp_path):
+    export_dir = tmp_path / "export"
+    chunks = export_dir / "chunks"
+    chunks.mkdir(parents=True)
+    path = chunks / "c.jsonl.gz"
+    path.write_bytes(gzip.compress(_line(1) + _line(2)))
+    follower = ExportFollower(export_dir)
+    assert list(follower.poll()) == []
+    assert _video_ids(follower.poll()) == ["BV1x1", "BV1x2"]
+    # 追加一个 gzip member：只输出新的行
+    _append(path, gzip.compress(_line(3)))
+    assert list(follower.poll()) == []
+    assert _video_ids(follower.poll()) == ["BV1x3"]
+    assert list(follower.poll()) == []
+
+    # 重新启动时按保存的解压后偏移跳过已处理的行；manifest 已列出的 chunk 不必等待
+    (chunks / "d.jsonl.gz").write_bytes(gzip.compress(_line(4)))
+    (export_dir / "manifest.json").write_text(json.dumps({"chunked": {"chunks": [
+        {"fileName": "c.jsonl"}, {"fileName": "d.jsonl"}]}}), encoding='utf-8')
+    follower = ExportFollower(export_dir, follower.offsets)
+    assert _video_ids(follower.poll()) == ["BV1x4"]
+    assert list(follower.poll()) == []
+
+
+def _read_csv(path):
+    with path.open('r', encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def _wait_for_rows(path, n, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if path.exists() and len(_read_csv(path)) >= n:
+            return _read_csv(path)
+        time.sleep(0.02)
+    return _read_csv(path)
+
+
+def _run_follow(export_dir, out_csv, **kwargs):
+    stop = threading.Event()
+    result = {}
+    t = threading.Thread(target=lambda: result.setdefault(
+        'rc', follow_export_dir(export_dir, out_csv, stop=stop, interval=0.02, max_interval=0.2, **kwargs)))
+    t.start()
+    return stop, t, result
+
+
+@pytest.mark.parametrize("watch", ["inotify", "poll"])
+def test_follow_export_dir_appends_and_resumes(tmp_path, monkeypatch, watch):
+    if watch == "poll":
+        def no_inotify():
+            raise OSError("disabled")
+        monkeypatch.setattr(mod, '_Inotify', no_inotify)
+    elif not mod.sys.platform.startswith('linux'):
+        pytest.skip("inotify 只在 Linux 上可用")
+    export_dir = tmp_path / "export"
+    export_dir.mkdir()
+    out_csv = tmp_path / "out.csv"
+
+    stop, t, result = _run_follow(export_dir, out_csv)
+    try:
+        time.sleep(0.1)
+        # chunks 目录在开始跟踪之后才创建
+        chunks = export_dir / "chunks"
+        chunks.mkdir()
+        c1 = chunks / "c1.jsonl"
+        c1.write_bytes(_line(1) + _line(2)[:10])
+        assert len(_wait_for_rows(out_csv, 1)) == 1
+        _append(c1, _line(2)[10:])
+        (chunks / "c2.jsonl").write_bytes(_line(3))
+        rows = _wait_for_rows(out_csv, 3)
+    finally:
+        stop.set()
+        t.join(5)
+    assert result['rc'] == 0
+    assert [r['video_id'] for r in rows] == ["BV1x1", "BV1x2", "BV1x3"]
+
+    # 停止期间写入的行在重新启动后追加，已输出的不再重复
+    _append(c1, _line(4))
+    stop, t, result = _run_follow(export_dir, out_csv)
+    try:
+        rows = _wait_for_rows(out_csv, 4)
+        time.sleep(0.1)
+    finally:
+        stop.set()
+        t.join(5)
+    assert [r['video_id'] for r in _read_csv(out_csv)] == ["BV1x1", "BV1x2", "BV1x3", "BV1x4"]
+    assert json.loads((tmp_path / "out.csv.follow.json").read_text(encoding='utf-8'))['chunks'] == {
+        "c1.jsonl": c1.stat().st_size, "c2.jsonl": (chunks / "c2.jsonl").stat().st_size}
+
+
+def test_follow_rejects_unsupported_options(tmp_path):
+    with pytest.raises(SystemExit):
+        mod.main(["-i", str(tmp_path), "--follow", "--excel", str(tmp_path / "x.xlsx")])
@@ -0,0 +1,86 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from extract_bilibili_from_qce import fetch_bilibili_metadata, parse_html_metadata
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'html'
+EXPECTED = json.loads((FIXTURES / 'expected.json').read_text(encoding='utf-8'))
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+@pytest.mark.parametrize('chunk_size', [7, 4096, 1 << 20])
+def test_parse_html_metadata_fixtures(name, chunk_size):
+    html = (FIXTURES / name).read_text(encoding='utf-8')
+    assert list(parse_html_metadata(_chunks(html, chunk_size))) == EXPECTED[name]
+
+
+def _bs4_reference(html):
+    """原先基于 BeautifulSoup 的整页解析逻辑，作为回归基准。"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    title = ''
+    uploader = ''
+    t = soup.find('meta', property='og:title') or soup.find('meta', attrs={'name': 'title'})
+    if t and t.get('content'):
+        title = t['content']
+    if not title and soup.title and soup.title.string:
+        title = soup.title.string.strip()
+    a = soup.find('meta', attrs={'name': 'author'})
+    if a and a.get('content'):
+        uploader = a['content']
+    if not uploader:
+        sel = soup.select_one('.username, .user-name, .up-name')
+        if sel:
+            uploader = sel.get_text(strip=True)
+    return [title, uploader]
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+def test_parse_html_metadata_matches_bs4(name):
+    pytest.importorskip('bs4')
+    html = (FIXTURES / name).read_text(encoding='utf-8')
+    assert list(parse_html_metadata(_chunks(html, 512))) == _bs4_reference(html)
+
+
+def test_parse_html_metadata_stops_after_head():
+    html = (FIXTURES / 'video_page.html').read_text(encoding='utf-8')
+    chunks = _chunks(html, 1024)
+    consumed = []
+
+    def gen():
+        for c in chunks:
+            consumed.append(c)
+            yield c
+
+    assert list(parse_html_metadata(gen())) == EXPECTED['video_page.html']
+    assert len(consumed) < 3 < len(chunks)
+
+
+def test_parse_html_metadata_size_cap():
+    html = '<html><head>' + '<meta name="x" content="y">' * 1000 + '<meta property="og:title" content="late"></head></html>'
+    assert parse_html_metadata(_chunks(html, 1000), max_chars=4096) == ('', '')
+    assert parse_html_metadata(_chunks(html, 1000)) == ('late', '')
+
+
+def test_fetch_bilibili_metadata_streams_fixture(stub_server):
+    pytest.importorskip('requests')
+    html = (FIXTURES / 'video_page.html').read_text(encoding='utf-8')
+    stub_server.route('/video/BV1fix', html)
+    title, uploader, final_url = fetch_bilibili_metadata(stub_server.url('/video/BV1fix'))
+    assert [title, uploader] == EXPECTED['video_page.html']
+    assert final_url == stub_server.url('/video/BV1fix')
+
+
+@pytest.mark.parametrize('content_type, encoding', [('text/html', 'utf-8'), ('text/html; charset=gbk', 'gbk')])
+def test_fetch_bilibili_metadata_decodes_by_declared_charset(stub_server, content_type, encoding):
+    pytest.importorskip('requests')
+    html = '<html><head><meta property="og:title" content="中文标题"><meta name="author" content="投稿人"></head></html>'
+    stub_server.route('/video/BV1cs', html.encode(encoding), headers={'Content-Type': content_type})
+    # 没有声明 charset 时按 utf-8 解码，而不是 requests 默认的 ISO-8859-1
+    assert fetch_bilibili_metadata(stub_server.url('/video/BV1cs'))[:2] == ('中文标题', '投稿人')
@@ -0,0 +1,96 @@
+import json
+import os
+
+import pytest
+
+import extract_bilibili_from_qce as mod
+from extract_bilibili_from_qce import LinkIndex, time_bound, time_sort_key
+
+
+MSGS = {
+    "a.jsonl": [
+        {"sender": {"name": "Alice"}, "time": "2026-02-27 10:00:00", "text": "看 https://www.bilibili.com/video/BV1aa"},
+        {"sender": {"name": "Bob"}, "time": "2026-03-01 09:00:00", "text": "无链接"},
+        {"sender": {"name": "Bob"}, "time": "2026-03-02 09:00:00", "text": "https://b23.tv/abc 与 https://www.bilibili.com/video/BV1aa"},
+    ],
+    "b.jsonl": [
+        {"sender": {"name": "Alice"}, "timestamp": 1775000000000, "text": "https://m.bilibili.com/video/BV1bb"},
+        {"sender": {"name": "Carol"}, "time": "2026-03-31T23:59:59", "text": "https://www.bilibili.com/video/BV1aa"},
+    ],
+}
+
+
+def test_time_sort_key_and_bound():
+    assert time_sort_key("2026-03-02T09:00:00Z") == "2026-03-02 09:00:00"
+    assert time_sort_key(1775000000000) == time_sort_key("1775000000") == "2026-03-31 23:33:20"
+    assert time_sort_key("") == ""
+    assert time_sort_key("昨天") == "昨天"
+    assert time_bound("2026-03") == "2026-03"
+    assert time_bound("2026") == "2026"
+    assert time_bound("2026-03-02T09:30") == "2026-03-02 09:30:00"
+    for bad in ("昨天", "2026-13", "2026/03/01", "03-01"):
+        with pytest.raises(ValueError):
+            time_bound(bad)
+
+
+@pytest.mark.parametrize("argv", [["query", "--db", "x.sqlite", "--since", "上周"],
+                                  ["-i", "export", "--until", "2026-3-1"]])
+def test_cli_rejects_unparseable_time_bounds(tmp_path, capsys, argv):
+    with pytest.raises(SystemExit) as exc:
+        mod.main(argv)
+    assert exc.value.code == 2
+    assert "无法识别的时间" in capsys.readouterr().err
+
+
+def test_link_index_build_query_and_raw(tmp_path, write_export):
+    export_dir = write_export(tmp_path / "export", MSGS)
+    index = LinkIndex(tmp_path / "idx.sqlite")
+    assert index.build(export_dir) == (2, 0, 0, 5)
+
+    bv = index.query(video_id="BV1aa")
+    assert [(r['sender'], r['chunk']) for r in bv] == [("Alice", "chunks/a.jsonl"), ("Bob", "chunks/a.jsonl"), ("Carol", "chunks/b.jsonl")]
+    assert [r['sender'] for r in index.query(since="2026-03", until="2026-03")] == ["Bob", "Bob", "Alice", "Carol"]
+    assert [r['link'] for r in index.query(sender="Bob", link_type="short")] == ["https://b23.tv/abc"]
+    assert [r['sender'] for r in index.query(since="2026-03-02 09:00:00", until="2026-03-31 23:59:00")] == ["Bob", "Bob", "Alice"]
+    assert len(index.query(limit=2)) == 2
+    assert index.top_videos(5) == [("BV1aa", 3, 3), ("BV1bb", 1, 1)]
+    assert index.top_videos(5, since="2026-03") == [("BV1aa", 2, 2), ("BV1bb", 1, 1)]
+
+    # 原始消息按偏移读回
+    assert index.raw_message(bv[1]) == MSGS["a.jsonl"][2]
+    assert index.raw_message(bv[2]) == MSGS["b.jsonl"][1]
+    index.close()
+
+
+def test_link_index_incremental_rebuild_and_stale_chunk(tmp_path, write_export):
+    export_dir = write_export(tmp_path / "export", MSGS)
+    index = LinkIndex(tmp_path / "idx.sqlite")
+    index.build(export_dir)
+    assert index.build(export_dir) == (0, 2, 0, 0)
+
+    b = export_dir / "chunks" / "b.jsonl"
+    rec = index.query(sender="Carol")[0]
+    with b.open('a', encoding='utf-8') as f:
+        f.write(json.dumps({"sender": {"name": "Dan"}, "time": "2026-04-01", "text": "https://www.bilibili.com/video/BV1cc"}) + "\n")
+    st = b.stat()
+    os.utime(b, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    with pytest.raises(RuntimeError):
+        index.raw_message(rec)
+
+    assert index.build(export_dir) == (1, 1, 0, 3)
+    assert [r['sender'] for r in index.query(video_id="BV1cc")] == ["Dan"]
+    assert len(index.query()) == 6
+    index.close()
+
+
+def test_index_and_query_cli(tmp_path, capsys, write_export):
+    export_dir = write_export(tmp_path / "export", MSGS)
+    db = str(tmp_path / "idx.sqlite")
+    assert mod.main(["index", "-i", str(export_dir), "--db", db]) == 0
+    capsys.readouterr()
+    assert mod.main(["query", "--db", db, "--video-id", "BV1bb", "--raw", "--jsonl"]) == 0
+    [line] = capsys.readouterr().out.splitlines()
+    rec = json.loads(line)
+    assert rec['sender'] == "Alice" and rec['raw_message'] == MSGS["b.jsonl"][0]
+    assert mod.main(["query", "--db", db, "--top", "1"]) == 0
+    assert capsys.readouterr().out.startswith("BV1aa\t分享 3 次")
@@ -1,7 +1,11 @@
 import csv
 import json
+import multiprocessing
 import os
 from pathlib import Path
+
+import pytest
+
 from extract_bilibili_from_qce import process_export_dir
 
 
@@ -36,7 +40,7 @@ def test_process_export_dir_integration(tmp_path):
     # monkeypatch 函数会在运行时由测试注入
     try:
         # 如果测试环境提供了 monkeypatch fixture in scope
-        fetch_stub = lambda url: (f"Title for {url}", f"Uploader for {url}")
+        fetch_stub = lambda url: (f"Title for {url}", f"Uploader for {url}", url)
         import extract_bilibili_from_qce as mod
         mod.fetch_bilibili_metadata = fetch_stub
     except Exception:
@@ -61,4 +65,325 @@ def test_process_export_dir_integration(tmp_path):
     assert ids['Alice'].startswith('BV') or ids['Alice'].startswith('av')
     titles = {r['sender']: r['bili_title'] for r in rows}
     assert titles['Alice'].startswith('Title for')
-    assert titles['Bob'].startswith('Title for')
\ No newline at end of file
+    assert titles['Bob'].startswith('Title for')
+
+
+def test_process_export_dir_workers_byte_identical(tmp_path, write_export):
+    chunks = {}
+    for c in range(5):
+        msgs = []
+        for i in range(30):
+            text = f"msg {c}-{i}"
+            if i % 3 == 0:
+                text += f" https://www.bilibili.com/video/BV{c}x{i} 和 https://b23.tv/s{c}{i}"
+            msgs.append({"sender": {"name": f"user{i % 4}"}, "time": f"2026-01-0{c + 1}T00:{i:02d}:00", "text": text})
+        chunks[f"chunk{c}.jsonl"] = msgs
+    export_dir = write_export(tmp_path / "export", chunks)
+
+    serial_csv = tmp_path / "serial.csv"
+    parallel_csv = tmp_path / "parallel.csv"
+    assert process_export_dir(export_dir, serial_csv) == 0
+    assert process_export_dir(export_dir, parallel_csv, workers=3) == 0
+    assert serial_csv.read_bytes() == parallel_csv.read_bytes()
+    # 分片目录应被清理
+    assert not list(tmp_path.glob("parallel.csv.shards-*"))
+
+
+def test_process_export_dir_workers_bad_chunk_reported(tmp_path, capsys, write_export):
+    msg = {"sender": {"name": "Alice"}, "time": "2026-01-03T00:00:00", "text": "https://www.bilibili.com/video/BV1ok"}
+    export_dir = write_export(tmp_path / "export", {"a.jsonl": [msg], "bad.jsonl": [], "c.jsonl": [msg]})
+    # 让 bad.jsonl 变成目录，打开时报错
+    bad = export_dir / "chunks" / "bad.jsonl"
+    bad.unlink()
+    bad.mkdir()
+
+    out_csv = tmp_path / "out.csv"
+    assert process_export_dir(export_dir, out_csv, workers=2) == 0
+    out = capsys.readouterr().out
+    assert "bad.jsonl 时出错" in out
+    with out_csv.open('r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert [r['chunk'] for r in rows] == ["a.jsonl", "c.jsonl"]
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason="需要 fork 以便子进程继承 monkeypatch")
+def test_process_export_dir_workers_crash_isolated(tmp_path, monkeypatch, capsys, write_export):
+    import extract_bilibili_from_qce as mod
+    msg = {"sender": {"name": "Alice"}, "time": "2026-01-03T00:00:00", "text": "https://www.bilibili.com/video/BV1ok"}
+    export_dir = write_export(tmp_path / "export", {"a.jsonl": [msg], "crash.jsonl": [msg], "c.jsonl": [msg]})
+
+    orig = mod.iter_candidate_messages
+
+    def crashing(chunk_path):
+        if chunk_path.name == "crash.jsonl":
+            os._exit(1)
+        return orig(chunk_path)
+
+    monkeypatch.setattr(mod, "iter_candidate_messages", crashing)
+    out_csv = tmp_path / "out.csv"
+    assert process_export_dir(export_dir, out_csv, workers=2) == 0
+    out = capsys.readouterr().out
+    assert "crash.jsonl 时出错: 工作进程异常退出" in out
+    with out_csv.open('r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert [r['chunk'] for r in rows] == ["a.jsonl", "c.jsonl"]
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason="需要 fork 以便子进程继承 monkeypatch")
+def test_process_export_dir_workers_crash_discards_partial_shard(tmp_path, monkeypatch, capsys, write_export):
+    import extract_bilibili_from_qce as mod
+    msgs = [{"sender": {"name": f"u{i}"}, "time": "2026-01-03T00:00:00",
+             "text": f"https://www.bilibili.com/video/BV1crash{i:05d}"} for i in range(2000)]
+    msg = {"sender": {"name": "Alice"}, "time": "2026-01-03T00:00:00", "text": "https://www.bilibili.com/video/BV1ok"}
+    export_dir = write_export(tmp_path / "export", {"a.jsonl": [msg], "crash.jsonl": msgs, "c.jsonl": [msg]})
+
+    orig = mod.iter_chunk_rows
+
+    def crashing(chunk_path, *args, **kwargs):
+        for i, row in enumerate(orig(chunk_path, *args, **kwargs)):
+            # 已经写出远多于一个缓冲区的行之后崩溃
+            if chunk_path.name == "crash.jsonl" and i == 1500:
+                os._exit(1)
+            yield row
+
+    monkeypatch.setattr(mod, "iter_chunk_rows", crashing)
+    out_csv = tmp_path / "out.csv"
+    assert process_export_dir(export_dir, out_csv, workers=2) == 0
+    assert "crash.jsonl 时出错: 工作进程异常退出" in capsys.readouterr().out
+    with out_csv.open('r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    # 崩溃的 chunk 写了一半的分片被丢弃，不会有截断的行进入输出
+    assert [(r['chunk'], r['video_id']) for r in rows] == [("a.jsonl", "BV1ok"), ("c.jsonl", "BV1ok")]
+
+
+def _bili_msgs(tag, n=3):
+    return [{"sender": {"name": f"{tag}{i}"}, "time": f"2026-01-01T00:0{i}:00",
+             "text": f"https://www.bilibili.com/video/BV{tag}{i}"} for i in range(n)]
+
+
+def _count_scans(monkeypatch):
+    import extract_bilibili_from_qce as mod
+    scanned = []
+    orig = mod.iter_chunk_rows
+
+    def counting(chunk_path, chat_name, *args, **kwargs):
+        scanned.append(chunk_path.name)
+        return orig(chunk_path, chat_name, *args, **kwargs)
+
+    monkeypatch.setattr(mod, "iter_chunk_rows", counting)
+    return scanned
+
+
+def test_process_export_dir_incremental_reuses_unchanged_chunks(tmp_path, monkeypatch, write_export):
+    export_dir = write_export(tmp_path / "export", {"c1.jsonl": _bili_msgs("a"), "c2.jsonl": _bili_msgs("b")})
+    out_csv = tmp_path / "out.csv"
+    state = tmp_path / "out.csv.state.jsonl"
+    scanned = _count_scans(monkeypatch)
+    assert process_export_dir(export_dir, out_csv, state_path=state) == 0
+    assert scanned == ["c1.jsonl", "c2.jsonl"]
+
+    # 追加消息到 c2，新增 c3，并只改 c1 的 mtime
+    chunks_dir = export_dir / "chunks"
+    with (chunks_dir / "c2.jsonl").open('a', encoding='utf-8') as f:
+        f.write(json.dumps(_bili_msgs("new", 1)[0]) + "\n")
+    (chunks_dir / "c3.jsonl").write_text(json.dumps(_bili_msgs("c", 1)[0]) + "\n", encoding='utf-8')
+    manifest = json.loads((export_dir / "manifest.json").read_text(encoding='utf-8'))
+    manifest["chunked"]["chunks"].append({"fileName": "c3.jsonl"})
+    (export_dir / "manifest.json").write_text(json.dumps(manifest), encoding='utf-8')
+    st = (chunks_dir / "c1.jsonl").stat()
+    os.utime(chunks_dir / "c1.jsonl", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    scanned.clear()
+    assert process_export_dir(export_dir, out_csv, state_path=state) == 0
+    assert scanned == ["c2.jsonl", "c3.jsonl"]
+
+    full_csv = tmp_path / "full.csv"
+    assert process_export_dir(export_dir, full_csv) == 0
+    assert out_csv.read_bytes() == full_csv.read_bytes()
+
+    scanned.clear()
+    assert process_export_dir(export_dir, out_csv, state_path=state, workers=2) == 0
+    assert scanned == []
+    assert out_csv.read_bytes() == full_csv.read_bytes()
+
+
+def test_process_export_dir_incremental_resumes_after_interrupt(tmp_path, monkeypatch, write_export):
+    import extract_bilibili_from_qce as mod
+    export_dir = write_export(tmp_path / "export", {f"c{i}.jsonl": _bili_msgs(f"x{i}") for i in range(4)})
+    out_csv = tmp_path / "out.csv"
+    state = tmp_path / "state.jsonl"
+    orig = mod.iter_chunk_rows
+
+    def interrupting(chunk_path, chat_name, *args, **kwargs):
+        if chunk_path.name == "c2.jsonl":
+            raise KeyboardInterrupt
+        return orig(chunk_path, chat_name, *args, **kwargs)
+
+    monkeypatch.setattr(mod, "iter_chunk_rows", interrupting)
+    with pytest.raises(KeyboardInterrupt):
+        process_export_dir(export_dir, out_csv, state_path=state)
+
+    monkeypatch.setattr(mod, "iter_chunk_rows", orig)
+    scanned = _count_scans(monkeypatch)
+    assert process_export_dir(export_dir, out_csv, state_path=state) == 0
+    assert scanned == ["c2.jsonl", "c3.jsonl"]
+    full_csv = tmp_path / "full.csv"
+    assert process_export_dir(export_dir, full_csv) == 0
+    assert out_csv.read_bytes() == full_csv.read_bytes()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_export_dir_stats_same_output_and_per_chunk(tmp_path, workers, write_export):
+    from extract_bilibili_from_qce import RunStats
+    filler = [{"sender": {"name": "x"}, "time": "2026-01-01T00:00:00", "text": "no link"}] * 5
+    export_dir = write_export(tmp_path / "export", {"a.jsonl": _bili_msgs("A") + filler, "bad.jsonl": [], "c.jsonl": _bili_msgs("C", 2)})
+    bad = export_dir / "chunks" / "bad.jsonl"
+    bad.unlink()
+    bad.mkdir()
+
+    plain_csv = tmp_path / "plain.csv"
+    stats_csv = tmp_path / "stats.csv"
+    assert process_export_dir(export_dir, plain_csv, workers=workers) == 0
+    stats = RunStats()
+    assert process_export_dir(export_dir, stats_csv, workers=workers, stats=stats) == 0
+    assert plain_csv.read_bytes() == stats_csv.read_bytes()
+
+    report = stats.report()
+    json.dumps(report)
+    chunks = {c['chunk']: c for c in report['per_chunk']}
+    assert (chunks['a.jsonl']['lines'], chunks['a.jsonl']['parsed'], chunks['a.jsonl']['links']) == (8, 3, 3)
+    assert chunks['c.jsonl']['links'] == 2
+    assert 'error' in chunks['bad.jsonl']
+    assert report['links'] == 5
+    assert {'read', 'json_loads', 'extract_strings', 'regex', 'json_dumps', 'csv_write'} <= set(report['stages'])
+    assert report['stages']['csv_write']['calls'] == 5
+    assert "统计：3 个 chunk" in stats.summary(report)
+    # 分片旁的统计文件也应被清理
+    assert not list(tmp_path.rglob("*.stats.json"))
+
+
+def test_process_export_dir_stats_incremental_reused(tmp_path, write_export):
+    from extract_bilibili_from_qce import RunStats
+    export_dir = write_export(tmp_path / "export", {"a.jsonl": _bili_msgs("A")})
+    state = tmp_path / "state.jsonl"
+    assert process_export_dir(export_dir, tmp_path / "o1.csv", state_path=state) == 0
+    stats = RunStats()
+    assert process_export_dir(export_dir, tmp_path / "o2.csv", state_path=state, stats=stats) == 0
+    [chunk] = stats.report()['per_chunk']
+    assert chunk['reused'] and chunk['links'] == 3
+
+
+def _monthly_export(write_export, tmp_path, months=6, manifest_bounds=False):
+    chunks = {}
+    for m in range(1, months + 1):
+        msgs = []
+        for d in range(1, 29, 3):
+            sender = "Alice" if d % 2 else "Bob"
+            msgs.append({"sender": {"name": sender, "uin": f"1{d}"}, "time": f"2025-{m:02d}-{d:02d} 12:00:00",
+                         "text": f"https://www.bilibili.com/video/BV{m}x{d}"})
+        chunks[f"c{m}.jsonl"] = msgs
+    export_dir = write_export(tmp_path / "export", chunks)
+    if manifest_bounds:
+        manifest = json.loads((export_dir / "manifest.json").read_text(encoding='utf-8'))
+        for entry, msgs in zip(manifest["chunked"]["chunks"], chunks.values()):
+            entry["start"] = {"time": msgs[0]["time"]}
+            entry["end"] = {"time": msgs[-1]["time"]}
+        (export_dir / "manifest.json").write_text(json.dumps(manifest), encoding='utf-8')
+    return export_dir
+
+
+def _read_rows(path):
+    with path.open('r', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_export_dir_time_filter_prunes_chunks_with_cache(tmp_path, monkeypatch, workers, write_export):
+    import extract_bilibili_from_qce as mod
+    export_dir = _monthly_export(write_export, tmp_path)
+    scanned = _count_scans(monkeypatch)
+    times_cache = tmp_path / "times.json"
+    flt = mod.MessageFilter(since="2025-03-08", until="2025-03-14")
+    out_csv = tmp_path / "out.csv"
+    # 第一次没有缓存也不预先扫描：所有 chunk 正常扫描一遍，顺带记录各自的时间范围
+    assert process_export_dir(export_dir, out_csv, message_filter=flt, chunk_times=times_cache, workers=workers) == 0
+    if workers == 1:
+        assert scanned == [f"c{m}.jsonl" for m in range(1, 7)]
+    assert [r['time'] for r in _read_rows(out_csv)] == ["2025-03-10 12:00:00", "2025-03-13 12:00:00"]
+    cached = json.loads(times_cache.read_text(encoding='utf-8'))
+    assert sorted(tuple(e["bounds"]) for e in cached.values())[2] == ("2025-03-01 12:00:00", "2025-03-28 12:00:00")
+
+    # 之后的运行直接使用缓存的时间范围跳过 chunk
+    scanned.clear()
+    assert process_export_dir(export_dir, out_csv, message_filter=flt, chunk_times=times_cache) == 0
+    assert scanned == ["c3.jsonl"]
+    scanned.clear()
+    assert process_export_dir(export_dir, out_csv, message_filter=mod.MessageFilter(since="2025-05"), chunk_times=times_cache) == 0
+    assert scanned == ["c5.jsonl", "c6.jsonl"]
+
+    # chunk 变化后缓存失效，重新扫描并更新
+    with (export_dir / "chunks" / "c1.jsonl").open('a', encoding='utf-8') as f:
+        f.write(json.dumps({"time": "2025-05-20 00:00:00", "text": "https://b23.tv/late"}) + "\n")
+    scanned.clear()
+    assert process_export_dir(export_dir, out_csv, message_filter=mod.MessageFilter(since="2025-05"), chunk_times=times_cache) == 0
+    assert scanned == ["c1.jsonl", "c5.jsonl", "c6.jsonl"]
+    scanned.clear()
+    assert process_export_dir(export_dir, out_csv, message_filter=mod.MessageFilter(since="2025-05"), chunk_times=times_cache) == 0
+    assert scanned == ["c1.jsonl", "c5.jsonl", "c6.jsonl"]
+    assert "https://b23.tv/late" in [r['link'] for r in _read_rows(out_csv)]
+
+
+def test_process_export_dir_manifest_bounds_and_sender_filter(tmp_path, monkeypatch, write_export):
+    import extract_bilibili_from_qce as mod
+    export_dir = _monthly_export(write_export, tmp_path, manifest_bounds=True)
+    scanned = _count_scans(monkeypatch)
+    searched = []
+    orig_find = mod.find_link_spans
+    monkeypatch.setattr(mod, "find_link_spans", lambda text: searched.append(text) or orig_find(text))
+
+    flt = mod.MessageFilter(until="2025-02", senders=["Bob", "125"])
+    out_csv = tmp_path / "out.csv"
+    assert process_export_dir(export_dir, out_csv, message_filter=flt, chunk_times=tmp_path / "t.json") == 0
+    assert scanned == ["c1.jsonl", "c2.jsonl"]
+    rows = _read_rows(out_csv)
+    # Bob（偶数日）以及 uin 为 125 的 Alice
+    expected = sorted(("Bob", f"2025-{m:02d}-{d:02d} 12:00:00") for m in (1, 2) for d in (4, 10, 16, 22, 28))
+    expected += [("Alice", "2025-01-25 12:00:00"), ("Alice", "2025-02-25 12:00:00")]
+    assert sorted((r['sender'], r['time']) for r in rows) == sorted(expected)
+    # 被过滤的消息不会进入链接查找
+    assert len(searched) == len(rows)
+
+
+def test_chunk_time_range_skips_undated_messages():
+    from extract_bilibili_from_qce import ChunkTimeRange
+    rng = ChunkTimeRange()
+    assert rng.bounds() is None
+    for msg in ({"time": "2025-03-02T10:00:00"}, {"timestamp": 1735689600000}, {"text": "没有时间"},
+                {"date": "2025-06-30T23:00:00Z"}, {"msg_time": 1740000000}):
+        rng.add(msg)
+    assert rng.bounds() == ("2025-01-01 00:00:00", "2025-06-30 23:00:00")
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_iter_bilibili_links_records_match_csv(tmp_path, monkeypatch, workers, write_export):
+    import extract_bilibili_from_qce as mod
+    msgs = _bili_msgs("a") + [{"sender": {"name": "z"}, "time": "2026-01-02T00:00:00",
+                               "text": "两个链接 https://b23.tv/x1 https://www.bilibili.com/video/BV1two"}]
+    export_dir = write_export(tmp_path / "export", {"c1.jsonl": msgs, "c2.jsonl": _bili_msgs("b", 2)})
+    out_csv = tmp_path / "out.csv"
+    assert process_export_dir(export_dir, out_csv, workers=workers) == 0
+
+    dumps = []
+    orig_dumps = mod.json.dumps
+    monkeypatch.setattr(mod.json, "dumps", lambda obj, *a, **k: dumps.append(1) or orig_dumps(obj, *a, **k))
+    records = list(mod.iter_bilibili_links(export_dir, workers=workers))
+    assert all(isinstance(r, mod.LinkRecord) for r in records)
+    assert [r.link for r in records][3:] == ["https://b23.tv/x1", "https://www.bilibili.com/video/BV1two",
+                                             "https://www.bilibili.com/video/BVb0", "https://www.bilibili.com/video/BVb1"]
+    if workers == 1:
+        # 只访问链接字段时不做任何 json.dumps；同一消息的两条链接共享一次
+        assert dumps == []
+        assert records[3].message == msgs[3] and records[3].link_type == "short"
+        assert records[3].raw_message is records[4].raw_message and len(dumps) == 1
+        assert records[4].context == "z 2026-01-02T00:00:00 两个链接 https://b23.tv/x1 https://www.bilibili.com/video/BV1two"
+    assert [r.as_dict() for r in records] == _read_rows(out_csv)
@@ -0,0 +1,111 @@
+import json
+import random
+
+import pytest
+
+from extract_bilibili_from_qce import LinkDeduper, LinkRecord, LinkReport, main, process_export_dir
+
+
+def _msg(sender, day, text, **extra):
+    return dict({"sender": {"name": sender}, "time": f"2026-01-{day:02d} 12:00:00", "text": text}, **extra)
+
+
+def _video(n):
+    return f"https://www.bilibili.com/video/BV1v{n}"
+
+
+CHUNKS = {
+    "c0.jsonl": [_msg("alice", 1, f"{_video(1)} {_video(2)}"), _msg("bob", 1, _video(1)),
+                 _msg("alice", 2, "https://b23.tv/x")],
+    "c1.jsonl": [_msg("carol", 2, _video(1)), _msg("alice", 3, f"https://space.bilibili.com/1 {_video(3)}", id="m5")],
+    "c2.jsonl": [_msg("bob", 3, _video(2)), _msg("alice", 3, _video(1), id="m5")],
+}
+
+
+def _report(tmp_path, name, **kwargs):
+    path = tmp_path / name
+    assert process_export_dir(kwargs.pop("export"), tmp_path / "out.csv", report_path=path, **kwargs) == 0
+    return json.loads(path.read_text(encoding='utf-8'))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_report_counts_links_in_the_same_pass(tmp_path, workers, write_export):
+    export = write_export(tmp_path / "export", CHUNKS)
+    report = _report(tmp_path, "r.json", export=export, workers=workers)
+    assert report["links"] == 9
+    assert report["chats"] == {"chat": 9}
+    assert report["per_day"] == {"2026-01-01": 3, "2026-01-02": 2, "2026-01-03": 4}
+    assert sum(report["link_types"].values()) == 9
+    assert [(v["video_id"], v["count"], v["min_count"]) for v in report["top_videos"]] == [
+        ("BV1v1", 4, 4), ("BV1v2", 2, 2), ("BV1v3", 1, 1)]
+    assert [(s["sender"], s["count"]) for s in report["top_sharers"]] == [("alice", 6), ("bob", 2), ("carol", 1)]
+    assert report["exact_top"]
+    # 工作进程写的分片读回后已删除
+    assert not list(tmp_path.glob("bili-shards-*"))
+
+
+def test_parallel_and_incremental_reports_match_serial(tmp_path, write_export):
+    export = write_export(tmp_path / "export", CHUNKS)
+    serial = _report(tmp_path, "serial.json", export=export)
+    # 报告统计的总是实际写出的行，与并行、增量复用以及（没有重复时的）去重无关
+    assert _report(tmp_path, "parallel.json", export=export, workers=3) == serial
+    assert _report(tmp_path, "dedup.json", export=export, workers=2, dedup=LinkDeduper()) == serial
+    state = tmp_path / "state.jsonl"
+    _report(tmp_path, "first.json", export=export, state_path=state)
+    # 第二次全部从状态文件复用
+    assert _report(tmp_path, "reused.json", export=export, state_path=state, workers=2) == serial
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_report_counts_the_written_rows(tmp_path, workers, write_export):
+    export = write_export(tmp_path / "export", CHUNKS)
+    dup = write_export(tmp_path / "dup", {"c9.jsonl": CHUNKS["c0.jsonl"] + CHUNKS["c2.jsonl"]})
+    path = tmp_path / "r.json"
+    assert process_export_dir([export, dup], tmp_path / "out.csv", report_path=path, workers=workers,
+                              dedup=LinkDeduper()) == 0
+    report = json.loads(path.read_text(encoding='utf-8'))
+    written = (tmp_path / "out.csv").read_text(encoding='utf-8').count("\n") - 1
+    # 第二个导出中的消息全部与第一个重复，去重后不写出，报告也不统计
+    assert report["links"] == written == 9
+
+
+def test_report_counts_rows_after_dedup(tmp_path, capsys, write_export):
+    export = write_export(tmp_path / "export", CHUNKS)
+    out = tmp_path / "out.csv"
+    md = tmp_path / "report.md"
+    assert main(["-i", str(export), "-i", str(export), "-o", str(out), "--dedup", "--no-meta-cache",
+                 "--report", str(md), "--report-top", "2", "--workers", "2"]) == 0
+    text = md.read_text(encoding='utf-8')
+    # 同一导出给了两次，去重后只统计实际写出的 9 条
+    assert "共 9 条链接。" in text
+    assert "| 1 | BV1v1 |  | 4 | 4 |" in text
+    assert "BV1v3" not in text.split("## 分享最多的发送者")[0]
+    assert "| 2026-01-03 | 4 |" in text
+    assert "已写入统计报告" in capsys.readouterr().out
+
+
+def test_sketches_merge_across_shards_with_bounded_memory():
+    rng = random.Random(7)
+    # 偏斜分布：少数视频被大量分享，长尾只出现一两次
+    items = [f"BV{int(rng.paretovariate(1.1))}" for _ in range(20000)]
+    rng.shuffle(items)
+    truth = {}
+    for item in items:
+        truth[item] = truth.get(item, 0) + 1
+
+    parts = [LinkReport(top=5) for _ in range(4)]
+    for i, item in enumerate(items):
+        parts[i % 4].add(LinkRecord(chat_name="c", time="2026-01-01", sender=f"s{i % 3}", video_id=item))
+    merged = parts[0]
+    for part in parts[1:]:
+        merged = LinkReport.from_state(json.loads(json.dumps(merged.merge(part).to_state())))
+    assert len(merged.videos.counters) <= 50
+
+    report = merged.report()
+    assert report["links"] == 20000
+    expected = sorted(truth, key=lambda k: (-truth[k], k))[:5]
+    assert [v["video_id"] for v in report["top_videos"]] == expected
+    for v in report["top_videos"]:
+        assert v["min_count"] <= truth[v["video_id"]] <= v["count"]
+    assert not report["exact_top"]
+    assert {s["sender"]: s["count"] for s in report["top_sharers"]} == {"s0": 6667, "s1": 6667, "s2": 6666}